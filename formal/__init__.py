@@ -14,7 +14,17 @@ from formal.widget import *
 from formal.widgets.restwidget import *
 from formal.widgets.multiselect import *
 from formal.widgets.richtextarea import *
-from formal.form import Form, Field, Group, ResourceMixin, renderForm
+from formal.form import Form, FormSchema, Field, Group, ResourceMixin, renderForm
+from formal.batch import RecordValidator, validateRecords, \
+        validateRecordsInParallel
+from formal.scheduler import ValidationScheduler
+from formal.rendercache import RenderCache
+from formal.options import OptionSet, OptionSource, registerOptionSource, \
+        optionSource, invalidateOptionSource
+from formal.upload import UploadRequest, UploadFieldStorage
+from formal.resourcemanager import ResourceManager, DirectoryStorage, \
+        TempDirectoryStorage, MemoryStorage, SQLiteStorage, ResourceJanitor, \
+        ChunkedUploads
 from formal import iformal
 
 def widgetFactory(widgetClass, *a, **k):
@@ -0,0 +1,241 @@
+"""
+Validation of plain data records, e.g. the rows of a CSV or JSON import,
+against the fields of a form without a request or a Nevow context.
+"""
+
+import itertools
+from collections import deque
+from twisted.internet import defer
+from twisted.python import context
+from formal import validation
+from formal.converters import convertRecordValue
+from formal.form import CompiledField, FormErrors, FormSchema, _iterFields, \
+        _validationContext, _addError, _setValue, _errValue
+
+
+class RecordField(object):
+    """
+    The parts of a form field, i.e. of its CompiledField, needed to convert
+    and validate a record value.
+
+    A widget that checks more than the field's type, e.g. that a choice is
+    one of its options, provides processRecordValue(value), which converts
+    and validates a record value the way its processInput does the request's
+    input. It is used instead of the type's converter when present.
+    """
+
+    def __init__(self, field):
+        self.key = field.key
+        self.type = field.type
+        self.processRecordValue = getattr(field.makeWidget(),
+                'processRecordValue', None)
+        self.converter = field.converter
+        self.itemConverter = field.itemConverter
+
+    def convert(self, value):
+        """
+        Convert a raw record value to the field's type. Strings are converted
+        using the type's IStringConvertible adapter, the items of a sequence
+        using the item type's adapter. Numbers and booleans, e.g. from a JSON
+        record, are converted from their string form, so that they are checked
+        like any other input. Any other value that JSON can hold, i.e. a dict,
+        or a list for a field that is not a sequence, is rejected. Anything
+        else is assumed to already be of the right type.
+        """
+        if isinstance(value, (list, tuple)) and self.itemConverter is not None:
+            converter = self.itemConverter
+            return [convertRecordValue(item, converter) for item in value]
+        return convertRecordValue(value, self.converter)
+
+    def check(self, value):
+        if self.processRecordValue is not None:
+            return self.processRecordValue(value)
+        return self.type.check(self.convert(value))
+
+
+class RecordValidator(object):
+    """
+    Validate records against the fields of a form.
+
+    A record is a dict keyed by field key, exactly like Form.data, i.e. fields
+    inside groups use dotted keys. Missing keys are treated as None. Immutable
+    fields are skipped.
+
+    The form can be a Form or a FormSchema. Everything that does not depend on
+    the record is worked out once, when the validator is created, so a single
+    instance should be reused for all the records of an import.
+
+    If the form has a validationScheduler it limits the validators run at once
+    across all the records being validated. If it has a validatorCache the
+    outcomes of cacheable validators are shared between records.
+    """
+
+    def __init__(self, form):
+        if isinstance(form, FormSchema):
+            fields = form.fields
+        else:
+            fields = [CompiledField(field) for field in
+                    _iterFields(form.items)]
+        self.fields = [RecordField(field) for field in fields
+                if not field.immutable]
+        self.immutableKeys = [field.key for field in fields
+                if field.immutable]
+        self.validationContext = _validationContext(form)
+
+    def validate(self, record):
+        """
+        Validate a single record, returning a (data, errors) tuple or, if any
+        validator was asynchronous, a Deferred that fires with the tuple.
+        """
+        data = {}
+        errors = FormErrors()
+        errors.data = record
+        d = self.validateInto(record, data, errors)
+        if d is not None:
+            return d.addCallback(lambda _: (data, errors))
+        return data, errors
+
+    def validateInto(self, record, data, errors):
+        """
+        Validate a single record, storing the values in data and adding any
+        errors to errors. None is returned unless a validator was asynchronous,
+        in which case a Deferred is returned that fires once it is done.
+        """
+        if self.validationContext is not None:
+            return context.call(self.validationContext, self._validate,
+                    record, data, errors)
+        return self._validate(record, data, errors)
+
+    def _validate(self, record, data, errors):
+        dl = None
+
+        for field in self.fields:
+            key = field.key
+            try:
+                value = field.check(record.get(key))
+            except validation.FieldError, e:
+                _addError(errors, e, key)
+                continue
+            if isinstance(value, defer.Deferred):
+                if dl is None:
+                    dl = []
+                value.addCallbacks(_setValue, _errValue,
+                        callbackArgs=(data, key), errbackArgs=(errors, key))
+                dl.append(value)
+            else:
+                data[key] = value
+
+        if dl is not None:
+            return defer.gatherResults(dl)
+
+    def validateRecords(self, records):
+        """
+        Validate each record from an iterable of records, generating a
+        result, as returned by validate(), per record.
+        """
+        validate = self.validate
+        for record in records:
+            yield validate(record)
+
+
+def validateRecords(form, records):
+    """
+    Validate an iterable of records against the fields of a form (or form
+    schema), generating a (data, errors) result per record.
+    """
+    return RecordValidator(form).validateRecords(records)
+
+
+def validateRecordsInParallel(formFactory, records, processes=None,
+        chunkSize=1000, maxPendingChunks=None, progress=None):
+    """
+    Validate records across a pool of worker processes, generating a
+    (data, errors) result per record in input order.
+
+    formFactory:
+        A picklable callable, i.e. a module-level function, that returns the
+        Form or FormSchema to validate against. It is called once in each
+        worker process.
+    processes:
+        The number of worker processes, defaults to the number of CPUs.
+    chunkSize:
+        The number of records sent to a worker at a time.
+    maxPendingChunks:
+        The maximum number of chunks being validated at once, defaults to
+        twice the number of processes. The records iterable is only consumed
+        as results are consumed so a large, or endless, input is never read
+        ahead by more than this.
+    progress:
+        An optional callable, called with the number of chunks and records
+        completed so far after the results of each chunk have been generated.
+
+    The validators must be synchronous; a Deferred cannot be sent back from a
+    worker process.
+    """
+    import multiprocessing
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if maxPendingChunks is None:
+        maxPendingChunks = processes * 2
+
+    pool = multiprocessing.Pool(processes, _initWorker, (formFactory,))
+    try:
+        pending = deque()
+        chunksDone = recordsDone = 0
+        chunks = _chunked(records, chunkSize)
+        while True:
+            # Keep the workers busy, without reading too far ahead.
+            while len(pending) < maxPendingChunks:
+                chunk = next(chunks, None)
+                if chunk is None:
+                    break
+                pending.append(pool.apply_async(_validateChunk, (chunk,)))
+            if not pending:
+                break
+            results = pending.popleft().get()
+            for result in results:
+                yield result
+            chunksDone += 1
+            recordsDone += len(results)
+            if progress is not None:
+                progress(chunksDone, recordsDone)
+    except:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+
+
+def _chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+# The RecordValidator used by a worker process of validateRecordsInParallel.
+_workerValidator = None
+
+
+def _initWorker(formFactory):
+    global _workerValidator
+    _workerValidator = RecordValidator(formFactory())
+
+
+def _validateChunk(records):
+    validate = _workerValidator.validate
+    results = []
+    for record in records:
+        result = validate(record)
+        if isinstance(result, defer.Deferred):
+            raise TypeError('Asynchronous validators cannot be used in a '
+                    'worker process')
+        results.append(result)
+    return results
+
+
+__all__ = ['RecordValidator', 'validateRecords', 'validateRecordsInParallel']
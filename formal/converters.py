@@ -204,3 +204,24 @@ class SequenceToStringConverter(_Adapter):
         sf.write(value)
         sf.seek(0,0)
         return csvReader.next()    
+
+
+def convertRecordValue(value, converter):
+    """
+    Convert a value of a record, e.g. of a JSON body, using an
+    IStringConvertible converter, or None for no conversion. Strings are
+    converted, as are numbers and booleans from their string form, so that
+    they are checked like any other input. Any other value that JSON can
+    hold, i.e. a dict or list, is rejected. Anything else is assumed to
+    already be of the right type.
+    """
+    if isinstance(value, (bool, int, long)):
+        value = str(value)
+    elif isinstance(value, float):
+        # repr keeps all the digits.
+        value = repr(value)
+    elif isinstance(value, (dict, list, tuple)):
+        raise validation.FieldValidationError('Invalid value')
+    if isinstance(value, basestring) and converter is not None:
+        value = converter.toType(value)
+    return value
@@ -2,11 +2,13 @@
 Form implementation and high-level renderers.
 """
 
+import inspect
 from zope.interface import Interface
 from twisted.internet import defer
 from twisted.internet import reactor
+from twisted.python import context as pycontext, log
 from twisted.python.components import registerAdapter
-from nevow import appserver, context, loaders, inevow, rend, tags as T, url
+from nevow import appserver, context, flat, loaders, inevow, rend, tags as T, url
 from nevow.util import getPOSTCharset
 from formal import iformal, util, validation
 from resourcemanager import ResourceManager
@@ -16,6 +18,8 @@ from zope.interface import implements
 SEPARATOR = '!!'
 FORMS_KEY = '__nevow_form__'
 WIDGET_RESOURCE_KEY = 'widget_resource'
+VALIDATE_KEY = 'validate'
+FIELDS_KEY = '__nevow_form_fields__'
 
 
 
@@ -116,13 +120,25 @@ class Field(object):
         self.label = label
         self.description = description
         self.cssClass = cssClass
+        self._updateKey()
 
 
     def setItemParent(self, itemParent):
         self.itemParent = itemParent
+        self._updateKey()
 
 
-    key = property(lambda self: itemKey(self))
+    def _updateKey(self):
+        """
+        Recompute the key now that the item's position in the form is known.
+        """
+        if self.itemParent is None:
+            key = self.name
+        else:
+            key = '%s.%s' % (self.itemParent.key, self.name)
+        self.key = util.ItemKey(key)
+        self.cssKey = self.key.cssKey
+        self.partNamer = self.key.partNamer
 
 
     def makeWidget(self):
@@ -130,28 +146,27 @@ class Field(object):
 
 
     def process(self, ctx, form, args, errors):
+        key = self.key
+
         # If the type is immutable then copy the original value to args in case
         # another validation error causes this field to be re-rendered.
         if self.type.immutable:
-            args[self.key] = form.data.get(self.key)
+            args[key] = form.data.get(key)
             return
 
         # Process the input using the widget, storing the data back on the form.
+        # Most widgets and validators are synchronous so a Deferred is only
+        # involved if the widget actually returns one.
         widget = self.makeWidget()
-        def _cbProcess(data):
-            form.data[self.key] = data
-
-        def _errProcess(failure):
-            failure.trap(validation.FieldError)
-            e = failure.value
-
-            if e.fieldName is None:
-                e.fieldName = self.key
-            errors.add(e)
-            
-        d = defer.maybeDeferred(widget.processInput, ctx, self.key, args)
-        d.addCallbacks(_cbProcess, _errProcess)
-        return d
+        try:
+            result = widget.processInput(ctx, key, args)
+        except validation.FieldError, e:
+            _addError(errors, e, key)
+            return
+        if isinstance(result, defer.Deferred):
+            return result.addCallbacks(_setValue, _errValue,
+                    callbackArgs=(form.data, key), errbackArgs=(errors, key))
+        form.data[key] = result
 
 
 class FieldFragment(rend.Fragment):
@@ -181,20 +196,45 @@ class FieldFragment(rend.Fragment):
             self.docFactory = self.hiddenDocFactory
 
 
+    def rend(self, ctx, data):
+        # Render the standard templates from their precompiled markup. Any
+        # customisation, or a context without the form's name to hand, takes
+        # the long way round.
+        formName = _formName(ctx)
+        if formName is None or \
+                self.render_field.im_func is not FieldFragment.render_field.im_func:
+            return rend.Fragment.rend(self, ctx, data)
+        cssid = '%s-%s' % (formName, self.field.cssKey)
+        if self.docFactory is FieldFragment.docFactory:
+            slots = self._slots(ctx, cssid, True)
+            slots['fieldId'] = cssid + '-field'
+            return _fieldTemplate.fill(slots)
+        elif self.docFactory is FieldFragment.hiddenDocFactory:
+            return self._renderInputs(ctx, cssid, True)
+        return rend.Fragment.rend(self, ctx, data)
+
+
     def render_field(self, ctx, data):
+        cssid = util.render_cssid(self.field.key)
+        slots = self._slots(ctx, cssid)
+        slots['fieldId'] = [cssid, '-field']
+        tag = ctx.tag
+        for name, value in slots.iteritems():
+            tag.fillSlots(name, value)
+        return ctx.tag
+
+
+    def _slots(self, ctx, cssid, cssidString=False):
+        """
+        Work out what goes in the template's slots, apart from fieldId.
+        cssidString is true if cssid is a string rather than stan.
+        """
 
         # The field we're rendering
         field = self.field
 
-        # Get stuff from the context
-        formData = iformal.IFormData(ctx)
-        formErrors = iformal.IFormErrors(ctx, None)
-
         # Find any error
-        if formErrors is None:
-            error = None
-        else:
-            error = formErrors.getFieldError(field.key)
+        error = self._error(ctx)
 
         # Build the error message
         if error is None:
@@ -218,25 +258,94 @@ class FieldFragment(rend.Fragment):
         if error:
             classes.append('error')
 
-        # Create the widget and decide the method that should be called
-        if field.type.immutable:
-            render = widget.renderImmutable
+        return {
+            'id': cssid,
+            'class': ' '.join(classes),
+            'label': field.label,
+            'inputs': self._renderInputs(ctx, cssid, cssidString),
+            'message': message,
+            'description': T.div(class_='description')[field.description or ''],
+            }
+
+
+    def _error(self, ctx):
+        formErrors = iformal.IFormErrors(ctx, None)
+        if formErrors is None:
+            return None
+        return formErrors.getFieldError(self.field.key)
+
+
+    def _renderInputs(self, ctx, cssid=None, cssidString=False):
+        # Get stuff from the context
+        formData = iformal.IFormData(ctx)
+        formErrors = iformal.IFormErrors(ctx, None)
+        immutable = self.field.type.immutable
+
+        # Render straight to a string if the form asked for it and the
+        # widget can.
+        if cssidString and _rendersString(self.widget) and \
+                getattr(iformal.IForm(ctx, None), 'fastRender', False):
+            try:
+                markup = self.widget.renderString(ctx, self.field.key,
+                        formData, formErrors, cssid, immutable)
+            except util.CannotRenderString:
+                pass
+            else:
+                if isinstance(markup, str):
+                    return T.xml(markup)
+                return markup
+
+        # Decide the method that should be called
+        if immutable:
+            render = self.widget.renderImmutable
         else:
-            render = widget.render
+            render = self.widget.render
+        return render(ctx, self.field.key, formData, formErrors)
 
-        # Fill the slots
-        tag = ctx.tag
-        tag.fillSlots('id', util.render_cssid(field.key))
-        tag.fillSlots('fieldId', [util.render_cssid(field.key), '-field'])
-        tag.fillSlots('class', ' '.join(classes))
-        tag.fillSlots('label', field.label)
-        tag.fillSlots('inputs', render(ctx, field.key, formData,
-            formErrors))
-        tag.fillSlots('message', message)
-        tag.fillSlots('description',
-                T.div(class_='description')[field.description or ''])
 
-        return ctx.tag
+# Whether each widget class's renderString can be used, by class.
+_stringWidgets = {}
+
+
+def _rendersString(widget):
+    """
+    Test if a widget's renderString can stand in for its render and
+    renderImmutable, i.e. it has one and no subclass has changed how the
+    widget renders since.
+    """
+    cls = widget.__class__
+    try:
+        return _stringWidgets[cls]
+    except KeyError:
+        pass
+    mro = inspect.getmro(cls)
+    def definedBy(name):
+        for i, base in enumerate(mro):
+            if name in vars(base):
+                return i
+        return len(mro)
+    owner = definedBy('renderString')
+    result = owner < len(mro) and min([definedBy(name) for name in
+        ('render', 'renderImmutable', '_renderTag')]) >= owner
+    _stringWidgets[cls] = result
+    return result
+
+
+_fieldTemplate = util.StringTemplate(FieldFragment.docFactory.stan)
+
+
+def _formName(ctx):
+    """
+    Return the name of the form being rendered, as filled into the formName
+    slot by FormRenderer, or None if it cannot be found.
+    """
+    try:
+        formName = ctx.locateSlotData('formName')
+    except (AttributeError, KeyError):
+        return None
+    if not isinstance(formName, basestring):
+        return None
+    return formName
 
 
 
@@ -292,18 +401,32 @@ class Group(AddHelperMixin, object):
         # Forward to FormItems methods
         self.add = self.items.add
         self.getItemByName = self.items.getItemByName
-
-
-    key = property(lambda self: itemKey(self))
+        self._updateKey()
     
     
     def setItemParent(self, itemParent):
         self.itemParent = itemParent
+        self._updateKey()
 
 
-    def process(self, ctx, form, args, errors):
+    def _updateKey(self):
+        """
+        Recompute the key of the group, and all of its descendants, now that
+        the group's position in the form is known.
+        """
+        if self.itemParent is None:
+            key = self.name
+        else:
+            key = '%s.%s' % (self.itemParent.key, self.name)
+        self.key = util.ItemKey(key)
+        self.cssKey = self.key.cssKey
+        self.partNamer = self.key.partNamer
         for item in self.items:
-            item.process(ctx, form, args, errors)
+            item._updateKey()
+
+
+    def process(self, ctx, form, args, errors):
+        return _processItems(self.items, ctx, form, args, errors)
 
 
 
@@ -325,7 +448,24 @@ class GroupFragment(rend.Fragment):
         self.group = group
 
 
+    def rend(self, ctx, data):
+        # See FieldFragment.rend
+        formName = _formName(ctx)
+        if formName is None or self.docFactory is not GroupFragment.docFactory \
+                or self.render_group.im_func is not GroupFragment.render_group.im_func:
+            return rend.Fragment.rend(self, ctx, data)
+        return _groupTemplate.fill(self._slots('%s-%s' % (formName,
+            self.group.cssKey)))
+
+
     def render_group(self, ctx, data):
+        tag = ctx.tag
+        for name, value in self._slots(util.render_cssid(self.group.key)).iteritems():
+            tag.fillSlots(name, value)
+        return ctx.tag
+
+
+    def _slots(self, cssid):
 
         # Get a reference to the group, for simpler code.
         group = self.group
@@ -336,15 +476,16 @@ class GroupFragment(rend.Fragment):
             cssClass.append(group.cssClass)
         cssClass = ' '.join(cssClass)
 
-        # Fill the slots
-        tag = ctx.tag
-        tag.fillSlots('id', util.render_cssid(group.key))
-        tag.fillSlots('cssClass', cssClass)
-        tag.fillSlots('label', group.label)
-        tag.fillSlots('description', group.description or '')
-        tag.fillSlots('items', [inevow.IRenderer(item) for item in
-                group.items])
-        return ctx.tag
+        return {
+            'id': cssid,
+            'cssClass': cssClass,
+            'label': group.label,
+            'description': group.description or '',
+            'items': [inevow.IRenderer(item) for item in group.items],
+            }
+
+
+_groupTemplate = util.StringTemplate(GroupFragment.docFactory.stan)
 
 
 
@@ -358,13 +499,52 @@ class Form(AddHelperMixin, object):
 
     callback = None
     actions = None
-
-    def __init__(self, callback=None):
+    schema = None
+    # An IValidationScheduler used to limit the validators run at once while
+    # the form is processed.
+    validationScheduler = None
+    # An IValidatorCache used to remember the outcomes of the form's cacheable
+    # validators.
+    validatorCache = None
+    # An IResourceStorage for the files uploaded to the form, the system's
+    # temporary directory if None.
+    resourceStorage = None
+    # Render the standard widgets straight to markup strings, rather than to
+    # stan for Nevow to flatten. The markup is the same; widgets that cannot
+    # render themselves to a string, and subclasses of the standard widgets
+    # that change their rendering, are always rendered to stan.
+    fastRender = False
+    # An IRenderCache used to remember the markup of the form, if it is made
+    # from a FormSchema.
+    renderCache = None
+
+    def __init__(self, callback=None, schema=None):
+        if schema is not None:
+            # Share the compiled schema's items; only the per-request state
+            # below belongs to this instance.
+            self.schema = schema
+            self.items = schema.items
+            if callback is None:
+                callback = schema.callback
+            if schema.actions:
+                self.actions = list(schema.actions)
+            if schema.validationScheduler is not None:
+                self.validationScheduler = schema.validationScheduler
+            if schema.validatorCache is not None:
+                self.validatorCache = schema.validatorCache
+            if schema.resourceStorage is not None:
+                self.resourceStorage = schema.resourceStorage
+            if schema.fastRender:
+                self.fastRender = True
+            if schema.renderCache is not None:
+                self.renderCache = schema.renderCache
+        else:
+            self.items = FormItems(None)
+            self.items.makeRoot()
         if callback is not None:
             self.callback = callback
-        self.resourceManager = ResourceManager()
+        self.resourceManager = ResourceManager(self.resourceStorage)
         self.data = {}
-        self.items = FormItems(None)
         self.errors = FormErrors()
         # Forward to FormItems methods
         self.add = self.items.add
@@ -380,11 +560,17 @@ class Form(AddHelperMixin, object):
 
     def process(self, ctx):
 
-        request = inevow.IRequest(ctx)
-        charset = getPOSTCharset(ctx)
-
-        # Get the request args and decode the arg names
-        args = dict([(k.decode(charset),v) for k,v in request.args.items()])
+        # A request with a JSON body is mapped straight onto the field keys
+        # and validated without using the widgets.
+        try:
+            record = _jsonRecord(inevow.IRequest(ctx))
+        except validation.FormError, e:
+            self.errors.add(e)
+            return defer.succeed(self.errors)
+        if record is None:
+            args = _requestArgs(ctx)
+        else:
+            args = _flattenRecord(self.items.itemsByKey, record)
 
         # Find the callback to use, defaulting to the form default
         callback, validate = self.callback, True
@@ -421,8 +607,11 @@ class Form(AddHelperMixin, object):
                 return self.errors
 
             def _clearUpResources( r ):
-                if not self.errors:
-                    self.resourceManager.clearUpResources()
+                # Only go to the storage's thread pool if there is
+                # something to remove.
+                if not self.errors and self.resourceManager.widgetToID:
+                    d = self.resourceManager.deferClearUpResources()
+                    return d.addCallback( lambda _: r )
                 return r
 
             d = defer.maybeDeferred(callback, ctx, self, self.data)
@@ -430,82 +619,512 @@ class Form(AddHelperMixin, object):
             d.addErrback(self._cbFormProcessingFailed, ctx)
             return d
 
-        # Iterate the items and collect the form data and/or errors.
-        dl = []
-        for item in self.items:
-            dl.append(defer.maybeDeferred(item.process, ctx, self, args, self.errors))
-
-        d = defer.gatherResults(dl)
+        # Iterate the items and collect the form data and/or errors, only
+        # waiting if the processing of some item was asynchronous.
+        try:
+            validationContext = _validationContext(self)
+            if record is not None:
+                validator = self._recordValidator()
+                # Immutable fields keep their value, as in Field.process.
+                for key in validator.immutableKeys:
+                    args[key] = self.data.get(key)
+                d = validator.validateInto(args, self.data, self.errors)
+            elif validationContext is None:
+                d = _processItems(self.items, ctx, self, args, self.errors)
+            else:
+                d = pycontext.call(validationContext, _processItems,
+                        self.items, ctx, self, args, self.errors)
+        except:
+            return defer.fail()
+        if d is None:
+            return defer.maybeDeferred(_cbProcessingDone, None)
         d.addCallback(_cbProcessingDone)
         return d
 
+    def _recordValidator(self):
+        """
+        Return the RecordValidator of a JSON request's record, the schema's
+        own if the form was made from one.
+        """
+        if self.schema is not None:
+            return self.schema.recordValidator
+        return RecordValidator(self)
+
     def _cbFormProcessingFailed(self, failure, ctx):
         e = failure.value
         failure.trap(validation.FormError, validation.FieldError)
         self.errors.add(failure.value)
         return self.errors
 
+    def validateFields(self, ctx, keys):
+        """
+        Process and validate the request's input for just the fields with the
+        given keys, returning a FormErrors, or a Deferred that fires with one
+        if any validation was asynchronous.
+
+        The form's data and errors are left untouched. Unknown keys, and keys
+        of groups, immutable fields or fields whose widgets cannot be checked
+        on their own, e.g. file uploads, are ignored. A widget says so with a
+        false validatesAlone attribute.
+        """
+        args = _requestArgs(ctx)
+        errors = FormErrors()
+        errors.data = args
+        dl = []
+
+        def _validate():
+            for key in keys:
+                field = _fieldValidatedAlone(self, key)
+                if field is None:
+                    continue
+                try:
+                    result = field.makeWidget().processInput(ctx, key, args)
+                except validation.FieldError, e:
+                    _addError(errors, e, key)
+                    continue
+                except:
+                    log.err(None, 'Validating %r' % (key,))
+                    _addError(errors, _notValidated(), key)
+                    continue
+                if isinstance(result, defer.Deferred):
+                    dl.append(result.addErrback(_errNotValidated, errors, key))
+
+        validationContext = _validationContext(self)
+        if validationContext is None:
+            _validate()
+        else:
+            pycontext.call(validationContext, _validate)
+        if dl:
+            return defer.gatherResults(dl).addCallback(lambda _: errors)
+        return errors
+
+
+
+def _requestArgs(ctx):
+    """
+    Return the request args with the arg names decoded.
+    """
+    request = inevow.IRequest(ctx)
+    charset = getPOSTCharset(ctx)
+    return dict([(k.decode(charset),v) for k,v in request.args.items()])
+
+
+
+class IJSONRecord(Interface):
+    """Marker interface used to remember the decoded JSON body of a request.
+    """
+
+
+
+def _jsonRecord(request):
+    """
+    Return the decoded body of a request with an application/json body, or
+    None for any other request. A FormError is raised if the body is not a
+    JSON object.
+    """
+    record = request.getComponent(IJSONRecord)
+    if record is not None:
+        return record
+    contentType = request.getHeader('content-type')
+    if contentType is None or \
+            contentType.split(';', 1)[0].strip().lower() != 'application/json':
+        return None
+    request.content.seek(0)
+    try:
+        record = util.json.loads(request.content.read())
+    except ValueError:
+        record = None
+    if not isinstance(record, dict):
+        raise validation.FormError('The request is not a valid JSON object')
+    request.setComponent(IJSONRecord, record)
+    return record
+
+
+
+def _flattenRecord(itemsByKey, record, prefix=None, flat=None):
+    """
+    Flatten a JSON record, where a group's fields may be nested in an object,
+    into a dict keyed by the fields' (dotted) keys.
+    """
+    if flat is None:
+        flat = {}
+    for name, value in record.iteritems():
+        if prefix is None:
+            key = name
+        else:
+            key = '%s.%s' % (prefix, name)
+        if isinstance(value, dict) and isinstance(itemsByKey.get(key), Group):
+            _flattenRecord(itemsByKey, value, key, flat)
+        else:
+            flat[key] = value
+    return flat
+
+
+
+def _jsonErrors(errors):
+    """
+    Return the errors of a form in a form that can be encoded as JSON.
+    """
+    fieldErrors = {}
+    for error in errors.getFieldErrors():
+        fieldErrors.setdefault(error.fieldName, error.message)
+    return {
+        'errors': fieldErrors,
+        'formErrors': [error.message for error in errors.getFormLevelErrors()],
+        }
+
+
+
+def _addError(errors, e, key):
+    if e.fieldName is None:
+        e.fieldName = key
+    errors.add(e)
+
+
+
+def _setValue(value, data, key):
+    data[key] = value
+
+
+
+def _errValue(failure, errors, key):
+    failure.trap(validation.FieldError)
+    _addError(errors, failure.value, key)
+
+
+
+def _fieldValidatedAlone(form, key):
+    """
+    Return the field of a form with the key if its input can be validated on
+    its own, otherwise None.
+    """
+    field = form.items.itemsByKey.get(key)
+    if not isinstance(field, Field) or field.type.immutable:
+        return None
+    if not getattr(field.makeWidget(), 'validatesAlone', True):
+        return None
+    return field
+
+
+
+def _notValidated():
+    return validation.FieldValidationError('Could not be validated')
+
+
+
+def _errNotValidated(failure, errors, key):
+    if failure.check(validation.FieldError):
+        e = failure.value
+    else:
+        log.err(failure, 'Validating %r' % (key,))
+        e = _notValidated()
+    _addError(errors, e, key)
+
+
+
+def _validationContext(form):
+    """
+    Return the twisted.python.context entries that validation of the form's
+    (or form schema's) fields needs, or None if there are none.
+    """
+    validationContext = {}
+    scheduler = getattr(form, 'validationScheduler', None)
+    if scheduler is not None:
+        validationContext[iformal.IValidationScheduler] = scheduler
+    cache = getattr(form, 'validatorCache', None)
+    if cache is not None:
+        validationContext[iformal.IValidatorCache] = cache
+    return validationContext or None
+
+
+
+def _processItems(items, ctx, form, args, errors):
+    """
+    Process each of the items, returning a Deferred only if the processing of
+    at least one item was asynchronous.
+    """
+    dl = None
+    for item in items:
+        d = item.process(ctx, form, args, errors)
+        if isinstance(d, defer.Deferred):
+            if dl is None:
+                dl = []
+            dl.append(d)
+    if dl is not None:
+        return defer.gatherResults(dl)
+
 
 
 class FormItems(object):
     """
     A managed collection of form items.
+
+    Items are indexed by name. The collection at the root of a form also keeps
+    a flattened index of every item in the form by key, which is maintained as
+    items are added anywhere in the tree.
     """
 
 
+    frozen = False
+
+
     def __init__(self, itemParent):
         self.items = []
+        self.itemsByName = {}
         self.itemParent = itemParent
+        # The root collection of the form this collection belongs to, if any.
+        self.root = None
+        # Whole-form key -> item index, only kept by the root collection.
+        self.itemsByKey = None
 
 
     def __iter__(self):
         return iter(self.items)
 
 
+    def makeRoot(self):
+        """
+        Make this the root collection of a form, i.e. the one that indexes
+        every item in the form by key.
+        """
+        self.root = self
+        self.itemsByKey = {}
+        for item in self.items:
+            self._index(item)
+
+
+    def _index(self, item):
+        self.itemsByKey[item.key] = item
+        if isinstance(item, Group):
+            item.items.root = self
+            for child in item.items:
+                self._index(child)
+
+
+    def freeze(self):
+        """
+        Stop any more items being added to this collection or to the
+        collections of any child groups.
+        """
+        self.frozen = True
+        for item in self.items:
+            if isinstance(item, Group):
+                item.items.freeze()
+
+
     def add(self, item):
+        if self.frozen:
+            raise TypeError('Cannot add %r to a compiled form schema' %
+                    (item.name,))
         # Check the item name is unique
-        if item.name in [i.name for i in self.items]:
+        if item.name in self.itemsByName:
             raise ValueError('Item named %r already added to %r' %
                     (item.name, self))
         # Add to child items and set self the parent
         self.items.append(item)
+        self.itemsByName[item.name] = item
         item.setItemParent(self.itemParent)
+        # Add the item, and any children, to the form's index
+        if self.root is not None:
+            self.root._index(item)
         return item
 
 
     def getItemByName(self, name):
+        if self.itemsByKey is not None:
+            try:
+                return self.itemsByKey[name]
+            except KeyError:
+                raise KeyError("No item called %r" % name)
         name = name.split('.', 1)
         if len(name) == 1:
             name, rest = name[0], None
         else:
             name, rest = name[0], name[1]
-        for item in self.items:
-            if item.name == name:
-                if rest is None:
-                    return item
-                return item.getItemByName(rest)
-        raise KeyError("No item called %r" % name)
+        item = self.itemsByName.get(name)
+        if item is None:
+            raise KeyError("No item called %r" % name)
+        if rest is None:
+            return item
+        return item.getItemByName(rest)
+
+
+
+class CompiledField(object):
+    """
+    The precomputed, read-only description of a single field in a
+    FormSchema.
+    """
+
+    def __init__(self, field):
+        set = super(CompiledField, self).__setattr__
+        set('field', field)
+        set('key', field.key)
+        set('name', field.name)
+        set('label', field.label)
+        set('description', field.description)
+        set('cssClass', field.cssClass)
+        set('type', field.type)
+        set('immutable', field.type.immutable)
+        set('widgetFactory', field.widgetFactory)
+        set('converter', iformal.IStringConvertible(field.type, None))
+        # The converter of a sequence's items.
+        itemType = getattr(field.type, 'type', None)
+        if itemType is not None:
+            set('itemConverter', iformal.IStringConvertible(itemType, None))
+        else:
+            set('itemConverter', None)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('%s instances are immutable' %
+                (self.__class__.__name__,))
+
+    def makeWidget(self):
+        return self.widgetFactory(self.type)
+
+
+
+class FormSchema(object):
+    """
+    A compiled, immutable form definition.
+
+    A schema is built once, from a fully constructed Form, and can then be
+    shared by any number of Form instances across requests and threads. The
+    items of the source form are frozen so that nothing can be added to them
+    afterwards.
+
+    Typical use is to build the schema at import time and create a thin Form
+    per request::
+
+        def form_example(self, ctx):
+            form = exampleSchema.makeForm()
+            form.addAction(self.submitted)
+            return form
+    """
+
+    def __init__(self, form):
+        set = super(FormSchema, self).__setattr__
+        form.items.freeze()
+        fields = tuple([CompiledField(field) for field in
+                _iterFields(form.items)])
+        set('items', form.items)
+        set('callback', form.callback)
+        set('actions', tuple(form.actions or ()))
+        set('validationScheduler', form.validationScheduler)
+        set('validatorCache', form.validatorCache)
+        set('resourceStorage', form.resourceStorage)
+        set('fastRender', form.fastRender)
+        set('renderCache', form.renderCache)
+        set('fields', fields)
+        set('fieldsByKey', dict([(field.key, field) for field in fields]))
+        set('recordValidator', RecordValidator(self))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('%s instances are immutable' %
+                (self.__class__.__name__,))
+
+    def getField(self, key):
+        """
+        Return the CompiledField with the given key.
+        """
+        try:
+            return self.fieldsByKey[key]
+        except KeyError:
+            raise KeyError("No field called %r" % key)
+
+    def makeForm(self, callback=None):
+        """
+        Create a new Form instance, with its own data and errors, from the
+        schema.
+        """
+        return Form(callback, schema=self)
+
+
+
+def _iterFields(items):
+    """
+    Iterate the fields, in order, of a FormItems collection and all its
+    groups.
+    """
+    for item in items:
+        if isinstance(item, Group):
+            for field in _iterFields(item.items):
+                yield field
+        else:
+            yield item
 
 
 
 class FormErrors(object):
+    """
+    The errors collected while processing a form.
+
+    Field errors are indexed by field name as they are added and counted
+    against every group that contains the field, so that looking up the error
+    for a field, or asking whether a group has any errors, does not depend on
+    how many errors there are.
+    """
     implements( iformal.IFormErrors )
 
     def __init__(self):
         self.errors = []
+        self.formLevelErrors = []
+        self.fieldErrors = []
+        self.fieldErrorsByName = {}
+        self.errorCounts = {}
 
     def add(self, error):
         self.errors.append(error)
+        if not isinstance(error, validation.FieldError):
+            self.formLevelErrors.append(error)
+            return
+        self.fieldErrors.append(error)
+        name = error.fieldName
+        if name not in self.fieldErrorsByName:
+            self.fieldErrorsByName[name] = error
+        if name is None:
+            return
+        # Count the error against the field and each group containing it.
+        counts = self.errorCounts
+        parts = name.split('.')
+        for i in xrange(1, len(parts)+1):
+            key = '.'.join(parts[:i])
+            counts[key] = counts.get(key, 0) + 1
 
     def getFieldError(self, name):
-        fieldErrors = [e for e in self.errors if isinstance(e, validation.FieldError)]
-        for error in fieldErrors:
-            if error.fieldName == name:
-                return error
+        return self.fieldErrorsByName.get(name)
+
+    def getFieldErrors(self):
+        """
+        Return the list of field errors, in the order they were added.
+        """
+        return self.fieldErrors
+
+    def getFormLevelErrors(self):
+        """
+        Return the list of errors that do not relate to a specific field.
+        """
+        return self.formLevelErrors
 
     def getFormErrors(self):
         return self.errors
 
+    def getErrorCount(self, key):
+        """
+        Return the number of field errors for the field or group with the
+        given key. A group's count includes the errors of all its descendants.
+        """
+        return self.errorCounts.get(key, 0)
+
+    def hasErrors(self, key=None):
+        """
+        Test if there are any errors at all or, if key is given, any errors for
+        the field or group with that key.
+        """
+        if key is None:
+            return len(self.errors) != 0
+        return key in self.errorCounts
+
     def __nonzero__(self):
         return len(self.errors) != 0
 
@@ -521,6 +1140,11 @@ class FormResource(object):
             d = locateForm(ctx, formName)
             d.addCallback(self._fileFromWidget, ctx, segments[2:])
             return d
+        if segments[1] == VALIDATE_KEY:
+            # Validate some of the form's fields
+            d = locateForm(ctx, formName)
+            d.addCallback(lambda form: (FieldValidationResource(form), ()))
+            return d
         return appserver.NotFound
 
     def renderHTTP(self, ctx):
@@ -532,6 +1156,47 @@ class FormResource(object):
         return widget.getResource(ctx, segments[0], segments[1:])
 
 
+class FieldValidationResource(object):
+    """
+    Validate the input for some of a form's fields, e.g. as the user moves
+    from one field to the next, without processing the whole form.
+
+    The keys of the fields to validate are passed as (possibly repeated)
+    FIELDS_KEY request args alongside the fields' input. The response is a
+    JSON object mapping each key to its error message, or null if the input
+    is valid.
+    """
+    implements(inevow.IResource)
+
+    def __init__(self, form):
+        self.form = form
+
+    def locateChild(self, ctx, segments):
+        return appserver.NotFound
+
+    def renderHTTP(self, ctx):
+        ctx.remember(self.form, iformal.IForm)
+        request = inevow.IRequest(ctx)
+        charset = getPOSTCharset(ctx)
+        keys = [key.decode(charset) for key in request.args.get(FIELDS_KEY, [])]
+        d = defer.maybeDeferred(self.form.validateFields, ctx, keys)
+        d.addCallback(self._cbValidated, ctx, keys)
+        return d
+
+    def _cbValidated(self, errors, ctx, keys):
+        result = {}
+        for key in keys:
+            if _fieldValidatedAlone(self.form, key) is None:
+                continue
+            error = errors.getFieldError(key)
+            if error is not None:
+                result[key] = error.message
+            else:
+                result[key] = None
+        return util.JSONResource(result).renderHTTP(ctx)
+
+
+
 class FormsResourceBehaviour(object):
     """
     I provide the IResource behaviour needed to process and render a page
@@ -557,6 +1222,13 @@ class FormsResourceBehaviour(object):
             return None
         # Try to find the form name
         formName = request.args.get(FORMS_KEY, [None])[0]
+        if formName is None:
+            try:
+                record = _jsonRecord(request)
+            except validation.FormError:
+                record = None
+            if record is not None:
+                formName = record.get(FORMS_KEY)
         if formName is None:
             return None
         # Find the actual form and process it
@@ -582,6 +1254,12 @@ class FormsResourceBehaviour(object):
         return d
 
     def _formProcessed(self, result, ctx):
+        if _jsonRecord(inevow.IRequest(ctx)) is not None:
+            # JSON requests get JSON back, rather than the page or a redirect.
+            if isinstance(result, FormErrors):
+                return util.JSONResource(_jsonErrors(result), 400)
+            elif result is None:
+                return util.JSONResource({})
         if isinstance(result, FormErrors):
             return None
         elif result is None:
@@ -671,6 +1349,8 @@ def locateForm(ctx, name):
     def cacheForm( form, name ):
         if form is None:
             raise Exception('Form %r not found'%name)
+        if isinstance(form, FormSchema):
+            form = form.makeForm()
         form.name = name
         # Make it a known
         knownForms[name] = form
@@ -684,6 +1364,9 @@ def locateForm(ctx, name):
 def widgetResourceURL(name):
     return url.here.child(FORMS_KEY).child(name).child(WIDGET_RESOURCE_KEY)
 
+def validateURL(name):
+    return url.here.child(FORMS_KEY).child(name).child(VALIDATE_KEY)
+
 def widgetResourceURLFromContext(ctx,name):
     # Could this replace widgetResourceURL?
     u = url.URL.fromContext(ctx)
@@ -715,12 +1398,34 @@ class FormRenderer(object):
         self.original = original
 
     def rend(self, ctx, data):
-        tag = T.invisible[self.loader.load()]
+        renderCache = self.original.renderCache
+        if renderCache is not None:
+            return renderCache.render(self.original, ctx,
+                    lambda: self._rend(ctx, data))
+        return self._rend(ctx, data)
+
+    def _rend(self, ctx, data):
+        if self.loader is not FormRenderer.loader:
+            tag = T.invisible[self.loader.load()]
+            tag.fillSlots('formAction', url.here)
+            tag.fillSlots('formErrors', self._renderErrors)
+            tag.fillSlots('formItems', self._renderItems)
+            tag.fillSlots('formActions', self._renderActions)
+        else:
+            # Fill the precompiled markup directly. The action URL has to be
+            # flattened here as the attribute must be filled with a string.
+            formAction = flat.flatten(url.here,
+                    context.WovenContext(parent=ctx, isAttrib=True))
+            tag = T.invisible[_formTemplate.fill({
+                'formName': self.original.name,
+                'formAction': formAction,
+                'formErrors': self._renderErrors(ctx, data),
+                'formItems': list(self._renderItems(ctx, data)),
+                'formActions': [self._renderAction(ctx, action) for action in
+                    self.original.actions or ()],
+                })]
+        # The form's name is also used by the widgets' CSS ids.
         tag.fillSlots('formName', self.original.name)
-        tag.fillSlots('formAction', url.here)
-        tag.fillSlots('formErrors', self._renderErrors)
-        tag.fillSlots('formItems', self._renderItems)
-        tag.fillSlots('formActions', self._renderActions)
         return tag
 
     def _renderErrors(self, ctx, data):
@@ -728,16 +1433,15 @@ class FormRenderer(object):
         if not self.original.errors:
             return ''
 
-        errors = self.original.errors.getFormErrors()
+        errors = self.original.errors
 
         errorList = T.ul()
-        for error in errors:
+        for error in errors.getFormLevelErrors():
             if isinstance(error, validation.FormError):
                 errorList[ T.li[ error.message ] ]
-        for error in errors:
-            if isinstance(error, validation.FieldError):
-                item = self.original.getItemByName(error.fieldName)
-                errorList[ T.li[ T.strong[ item.label, ' : ' ], error.message ] ]
+        for error in errors.getFieldErrors():
+            item = self.original.getItemByName(error.fieldName)
+            errorList[ T.li[ T.strong[ item.label, ' : ' ], error.message ] ]
         return T.div(class_='errors')[ T.p['Please correct the following errors:'], errorList ]
 
     def _renderItems(self, ctx, data):
@@ -760,5 +1464,11 @@ class FormRenderer(object):
         return T.input(type='submit', id='%s-action-%s'%(self.original.name, data.name), name=data.name, value=data.label)
 
 
+_formTemplate = util.StringTemplate(FormRenderer.loader.stan)
+
+
 registerAdapter(FormRenderer, Form, inevow.IRenderer)
 
+
+# The batch module builds on this one.
+from formal.batch import RecordValidator
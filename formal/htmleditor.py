@@ -53,5 +53,5 @@ class TinyMCE(object):
     def processInput(self, ctx, key, args):
         value = args.get(key, [''])[0].decode(util.getPOSTCharset(ctx))
         value = iformal.IStringConvertible(self.original).toType(value)
-        return self.original.validate(value)
+        return self.original.check(value)
 
@@ -80,3 +80,58 @@ class IValidator(Interface):
     def validate(self, field, value):
         pass
 
+
+
+class IValidationScheduler(Interface):
+    def schedule(self, validator, field, value):
+        pass
+
+
+class IValidatorCache(Interface):
+    def validate(self, validator, field, value, scheduler=None):
+        pass
+
+
+class IRenderCache(Interface):
+    def render(self, form, ctx, render):
+        pass
+
+    def invalidate(self, schema):
+        pass
+
+    def clear(self):
+        pass
+
+
+class IResourceStorage(Interface):
+    """
+    Storage for the files uploaded to a form, see ResourceManager.
+    """
+
+    def store(self, filelike, fileName):
+        """
+        Store the content of filelike, returning a new resource id.
+        """
+
+    def open(self, resourceId):
+        """
+        Return a file-like open on the resource, or None if there is no such
+        resource.
+        """
+
+    def getPath(self, resourceId):
+        """
+        Return the path of the file containing the resource, or None if the
+        resource is not stored in a file.
+        """
+
+    def remove(self, resourceId):
+        """
+        Remove the resource, if it exists.
+        """
+
+    def listResources(self):
+        """
+        Return an iterable of (resourceId, size, mtime) tuples, one per
+        resource held. Required by ResourceJanitor.
+        """
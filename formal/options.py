@@ -0,0 +1,370 @@
+"""
+Options for the choice widgets that are prepared once, rather than every time
+a widget is rendered or its input processed, and named sources of options that
+are loaded once and shared by all the forms that use them.
+"""
+
+import time
+from zope.interface import implements
+from twisted.internet import defer
+from twisted.python import failure
+from nevow import inevow
+from formal import iformal
+from formal.util import CannotRenderString, escapeAttribute, escapeText, \
+        renderTag, _flatString
+
+
+class OptionSet(object):
+    """
+    A sequence of options, for the options of SelectChoice and RadioChoice,
+    that is adapted to IKey and ILabel once, when it is created, and converted
+    and escaped once per converter, when first rendered. A SelectChoice then
+    renders its <option>s from a single string, marking the selected option
+    by its position.
+
+    The same set should be shared by all the forms using the options, e.g. by
+    creating it at import time or in a FormSchema. The options must not change
+    once the set is created.
+
+    A widget using an OptionSet also rejects any submitted value that is not
+    one of the options, using a dict rather than a search of the options.
+    """
+
+    def __init__(self, options):
+        self.options = list(options)
+        self.keys = [iformal.IKey(option).key() for option in self.options]
+        self.labels = [iformal.ILabel(option).label() for option in
+                self.options]
+        keySet = set()
+        try:
+            for key in self.keys:
+                keySet.add(key)
+                # A submitted value is decoded to unicode.
+                if isinstance(key, str):
+                    try:
+                        keySet.add(key.decode('utf-8'))
+                    except UnicodeDecodeError:
+                        pass
+        except TypeError:
+            # Unhashable keys are searched for.
+            keySet = None
+        self.keySet = keySet
+        self._converted = {}
+
+    def __iter__(self):
+        return iter(self.options)
+
+    def __len__(self):
+        return len(self.options)
+
+    def __getitem__(self, index):
+        return self.options[index]
+
+    def hasKey(self, key):
+        """
+        Test if key, a value of the field's type, is the key of one of the
+        options.
+        """
+        if self.keySet is not None:
+            try:
+                return key in self.keySet
+            except TypeError:
+                pass
+        return key in self.keys
+
+    def converted(self, converter):
+        """
+        Return the options converted, and escaped, using an
+        IStringConvertible converter.
+        """
+        # The converters only differ by class.
+        cls = converter.__class__
+        try:
+            return self._converted[cls]
+        except KeyError:
+            pass
+        converted = ConvertedOptions(self, converter)
+        self._converted[cls] = converted
+        return converted
+
+
+class ConvertedOptions(object):
+    """
+    The options of an OptionSet converted to the strings that a widget renders
+    as their values, and the markup that renders them.
+    """
+
+    def __init__(self, optionSet, converter):
+        self.values = [converter.fromType(key) for key in optionSet.keys]
+        self.labels = optionSet.labels
+        self.positions = positions = {}
+        for i, value in enumerate(self.values):
+            positions.setdefault(value, []).append(i)
+        try:
+            self._prepareMarkup()
+        except CannotRenderString:
+            # e.g. translated labels, which only Nevow can render.
+            self.markup = None
+
+    def _prepareMarkup(self):
+        options = [renderTag('option', {'value': value}, label)
+                for value, label in zip(self.values, self.labels)]
+        self.markup = ''.join(options)
+        self.offsets = offsets = [0]
+        for option in options:
+            offsets.append(offsets[-1] + len(option))
+        self.radios = []
+        for value, label in zip(self.values, self.labels):
+            if value is None:
+                value = ''
+            else:
+                value = ' value="%s"' % (escapeAttribute(_flatString(value)),)
+            self.radios.append((value, escapeText(label)))
+
+    def __iter__(self):
+        """
+        Generate the (value, label) of each option.
+        """
+        return iter(zip(self.values, self.labels))
+
+    def selected(self, value):
+        """
+        Return the positions of the options with the value.
+        """
+        try:
+            return self.positions.get(value, ())
+        except TypeError:
+            return [i for i, v in enumerate(self.values) if v == value]
+
+    def renderOptions(self, value):
+        """
+        Return the markup of the <option>s, those with the value selected.
+        """
+        markup = self.markup
+        if markup is None:
+            raise CannotRenderString(self.labels)
+        parts = []
+        start = 0
+        for i in self.selected(value):
+            parts.append(markup[start:self.offsets[i]])
+            parts.append(renderTag('option', {'selected': 'selected',
+                'value': self.values[i]}, self.labels[i]))
+            start = self.offsets[i + 1]
+        if not start:
+            return markup
+        parts.append(markup[start:])
+        return ''.join(parts)
+
+    def renderRadios(self, name, cssid, value, disabled, first=0):
+        """
+        Return the markup of RadioChoice's radio buttons, numbering their ids
+        from first.
+        """
+        if self.markup is None:
+            raise CannotRenderString(self.labels)
+        name = escapeAttribute(_flatString(name))
+        cssid = escapeAttribute(_flatString(cssid))
+        checked = set(self.selected(value))
+        if disabled:
+            disabled = ' disabled="disabled"'
+        else:
+            disabled = ''
+        markup = []
+        for i, (valueAttribute, label) in enumerate(self.radios):
+            if i in checked:
+                attributes = ' checked="checked"' + disabled
+            else:
+                attributes = disabled
+            num = first + i
+            markup.append('<div class="radiobutton"><input%s id="%s-%d" '
+                    'name="%s" type="radio"%s /><label for="%s-%d">%s</label>'
+                    '</div>' % (attributes, cssid, num, name, valueAttribute,
+                        cssid, num, label))
+        return ''.join(markup)
+
+
+def convertOptions(options, converter):
+    """
+    Generate the (key, label) of each option, converting the key using the
+    converter.
+    """
+    if isinstance(options, OptionSet):
+        return iter(options.converted(converter))
+    return ((converter.fromType(iformal.IKey(item).key()),
+        iformal.ILabel(item).label()) for item in options)
+
+
+class OptionSource(object):
+    """
+    A named source of options, e.g. a database query, that is loaded once and
+    then shared, as an OptionSet, by every widget using the source, across
+    forms and requests.
+
+    An OptionSource can be used as the options of SelectChoice, RadioChoice,
+    CheckboxMultiChoice and MultiselectChoice. Sources are usually registered
+    once, by name, and looked up by the form factories::
+
+        formal.registerOptionSource('countries', loadCountries, ttl=3600)
+
+        form.addField('country', formal.String(), formal.widgetFactory(
+            formal.SelectChoice, options=formal.optionSource('countries')))
+
+    name:
+        The name of the source.
+    loader:
+        A callable returning a sequence of options, or a Deferred that fires
+        with one. It is called again once the options are stale.
+    ttl:
+        The number of seconds the options are kept for, or None to keep them
+        until they are invalidated.
+    version:
+        An optional callable returning the current version of the options,
+        e.g. a counter bumped whenever the table they come from changes. The
+        options are stale once it returns something other than it did when
+        they were loaded. It is called every time the options are used so it
+        must be cheap.
+    clock:
+        A callable returning the current time in seconds, time.time by
+        default.
+
+    Widgets using a source whose loader returned a Deferred are rendered once
+    the options have loaded. Loads that are needed while one is already
+    running wait for its options rather than loading them again.
+    """
+
+    implements(inevow.IGettable)
+
+    def __init__(self, name, loader, ttl=None, version=None, clock=None):
+        self.name = name
+        self.loader = loader
+        self.ttl = ttl
+        self.version = version
+        if clock is None:
+            clock = time.time
+        self.clock = clock
+        # Bumped whenever the options change, e.g. for a RenderCache.
+        self.generation = 0
+        self.optionSet = None
+        self.loadedAt = None
+        self.loadedVersion = None
+        self.pending = None
+
+    def get(self, ctx):
+        # Nevow resolves the options when they are a tag's data.
+        return self.getOptions()
+
+    def getOptions(self):
+        """
+        Return the OptionSet, loading the options if they are not loaded or
+        are stale. A Deferred that fires with the OptionSet is returned if the
+        loader is asynchronous.
+        """
+        optionSet = self.current()
+        if optionSet is not None:
+            return optionSet
+        if self.pending is not None:
+            d = defer.Deferred()
+            self.pending.append(d)
+            return d
+        generation = self.generation
+        version = self._version()
+        options = self.loader()
+        if not isinstance(options, defer.Deferred):
+            return self._loaded(options, generation, version)
+        self.pending = []
+        return options.addBoth(self._cbLoaded, generation, version)
+
+    def current(self):
+        """
+        Return the OptionSet if it is loaded and not stale, otherwise None.
+        """
+        self.stamp()
+        return self.optionSet
+
+    def stamp(self):
+        """
+        Forget the options if they are stale and return the generation of the
+        options.
+        """
+        if self.optionSet is not None and self._stale():
+            self.invalidate()
+        return self.generation
+
+    def invalidate(self):
+        """
+        Forget the options, so that they are loaded again when next used.
+        """
+        self.optionSet = None
+        self.generation += 1
+
+    def _stale(self):
+        if self.ttl is not None and self.loadedAt + self.ttl <= self.clock():
+            return True
+        return self.version is not None and \
+                self.version() != self.loadedVersion
+
+    def _version(self):
+        if self.version is None:
+            return None
+        return self.version()
+
+    def _loaded(self, options, generation, version):
+        if not isinstance(options, OptionSet):
+            options = OptionSet(options)
+        # Options loaded before an invalidation are used, but not kept.
+        if generation == self.generation:
+            self.optionSet = options
+            self.loadedAt = self.clock()
+            self.loadedVersion = version
+            self.generation += 1
+        return options
+
+    def _cbLoaded(self, result, generation, version):
+        waiters, self.pending = self.pending, None
+        if not isinstance(result, failure.Failure):
+            try:
+                result = self._loaded(result, generation, version)
+            except:
+                result = failure.Failure()
+        for d in waiters:
+            if isinstance(result, failure.Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+        return result
+
+
+# The process-wide option sources, by name.
+_optionSources = {}
+
+
+def registerOptionSource(name, loader, ttl=None, version=None):
+    """
+    Create an OptionSource, replacing any other source of the same name, and
+    register it for the process. The source is returned.
+    """
+    source = OptionSource(name, loader, ttl, version)
+    _optionSources[name] = source
+    return source
+
+
+def optionSource(name):
+    """
+    Return the registered OptionSource called name.
+    """
+    try:
+        return _optionSources[name]
+    except KeyError:
+        raise KeyError("No option source called %r" % (name,))
+
+
+def invalidateOptionSource(name):
+    """
+    Forget the options of the registered OptionSource called name, e.g.
+    because the data they are loaded from has changed.
+    """
+    optionSource(name).invalidate()
+
+
+__all__ = ['OptionSet', 'OptionSource', 'registerOptionSource',
+        'optionSource', 'invalidateOptionSource']
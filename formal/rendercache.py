@@ -0,0 +1,216 @@
+"""
+Caching of the markup of rendered forms, so that a form rendered again with
+the same data, e.g. an edit page for an unchanged record, is not flattened
+again widget by widget.
+"""
+
+import inspect
+import weakref
+from zope.interface import implements
+from twisted.internet import defer
+from nevow import context, flat, inevow, tags as T, url
+from formal import iformal
+from formal.options import OptionSet, OptionSource
+from formal.util import LRUCache
+
+
+class RenderCache(object):
+    """
+    A cache of the markup of rendered forms, keyed by the form's schema and
+    everything else the markup depends on.
+
+    A cache is assigned to a form (or to the form that a FormSchema is compiled
+    from) using the form's renderCache attribute and is typically shared by
+    all the forms of an application. Only forms made from a FormSchema are
+    cached, as the schema identifies the form across requests. The key is made
+    up of:
+
+    - the schema, and the number of times it has been invalidated;
+    - the form's name and its actions' names and labels;
+    - the form's data;
+    - the languages of the request, for translated labels;
+    - the URL the form is posted to, i.e. the URL of the page;
+    - the generation of the options of any OptionSource the form uses.
+
+    A form with errors is never cached, nor is a form whose data cannot be
+    hashed or that has a widget that has not opted in. A widget whose markup
+    depends only on the above declares a true cacheable attribute, which a
+    subclass that changes how the widget renders has to declare again. Even
+    then, a choice widget is not cached if its options are worked out as it is
+    rendered, e.g. by a callable.
+
+    maxSize:
+        The maximum number of rendered forms remembered. The least recently
+        used form is discarded to make room.
+    ttl:
+        The number of seconds a rendered form is remembered for, or None to
+        remember it until it is discarded.
+    clock:
+        A callable returning the current time in seconds, time.time by
+        default.
+
+    Anything else that changes a form's markup, e.g. the labels of options
+    loaded from a database, should call invalidate() with the form's schema.
+    """
+
+    implements(iformal.IRenderCache)
+
+    def __init__(self, maxSize=1000, ttl=300, clock=None):
+        self.cache = LRUCache(maxSize, ttl, clock)
+        # Keyed weakly, so that a schema made per request, say, is not kept
+        # alive by the cache; the rendered forms are bounded by the LRU.
+        self.versions = weakref.WeakKeyDictionary()
+        self.cacheableSchemas = weakref.WeakKeyDictionary()
+        self.hits = 0
+        self.misses = 0
+
+    def render(self, form, ctx, render):
+        """
+        Return the markup of the form, as T.xml, remembered or else flattened
+        from render(), which returns the form's stan. The stan itself is
+        returned if the form cannot be cached.
+        """
+        key = self._key(form, ctx)
+        if key is None:
+            return render()
+        html = self.cache.get(key)
+        if html is not None:
+            self.hits += 1
+            return html
+        self.misses += 1
+        tag = render()
+        html = _flatten(tag, ctx)
+        if html is None:
+            # The stan was partly consumed by the flattener, so start again.
+            return render()
+        self.cache.set(key, html)
+        return html
+
+    def invalidate(self, schema):
+        """
+        Forget the rendered forms of a schema.
+        """
+        # Stale entries are no longer looked up and are soon discarded.
+        self.versions[schema] = self.versions.get(schema, 0) + 1
+
+    def clear(self):
+        """
+        Forget all rendered forms.
+        """
+        self.cache.clear()
+
+    def _key(self, form, ctx):
+        schema = form.schema
+        if schema is None or form.errors:
+            return None
+        sources = self._sources(schema)
+        if sources is None:
+            return None
+        data = _freeze(iformal.IFormData(ctx, None))
+        if data is None:
+            return None
+        try:
+            languages = tuple(inevow.ILanguages(ctx))
+        except TypeError:
+            languages = ()
+        actions = tuple([(action.name, action.label) for action in
+            form.actions or ()])
+        formAction = flat.flatten(url.here,
+                context.WovenContext(parent=ctx, isAttrib=True))
+        generations = tuple([source.stamp() for source in sources])
+        return (schema, self.versions.get(schema, 0), form.name, actions,
+                data, languages, formAction, generations)
+
+    def _sources(self, schema):
+        """
+        Return the OptionSources used by the schema's widgets, or None if the
+        schema's forms cannot be cached.
+        """
+        try:
+            return self.cacheableSchemas[schema]
+        except KeyError:
+            pass
+        sources = []
+        for field in schema.fields:
+            widget = field.makeWidget()
+            if not _cacheableWidget(widget):
+                sources = None
+                break
+            options = getattr(widget, 'options', None)
+            if isinstance(options, OptionSource):
+                sources.append(options)
+        if sources is not None:
+            sources = tuple(sources)
+        self.cacheableSchemas[schema] = sources
+        return sources
+
+
+def _cacheableWidget(widget):
+    if not getattr(widget, 'cacheable', False) or \
+            not _cacheableClass(widget.__class__):
+        return False
+    options = getattr(widget, 'options', None)
+    return options is None or isinstance(options,
+            (list, tuple, OptionSet, OptionSource))
+
+
+# Whether a widget class' cacheable attribute still holds, by class.
+_cacheableClasses = {}
+
+
+def _cacheableClass(cls):
+    """
+    Test that no subclass has changed how the widget renders since the class
+    that declared it cacheable.
+    """
+    try:
+        return _cacheableClasses[cls]
+    except KeyError:
+        pass
+    mro = inspect.getmro(cls)
+    def definedBy(name):
+        for i, base in enumerate(mro):
+            if name in vars(base):
+                return i
+        return len(mro)
+    result = min([definedBy(name) for name in ('render', 'renderImmutable',
+        'renderString', '_renderTag')]) >= definedBy('cacheable')
+    _cacheableClasses[cls] = result
+    return result
+
+
+def _freeze(value):
+    """
+    Return a hashable equivalent of the form's data, or None if it cannot be
+    hashed. Values are tagged with their type as, e.g., 1 and True render
+    differently.
+    """
+    try:
+        return _freezeValue(value)
+    except TypeError:
+        return None
+
+
+def _freezeValue(value):
+    if isinstance(value, dict):
+        return (dict, tuple(sorted([(k, _freezeValue(v)) for k, v in
+            value.iteritems()])))
+    if isinstance(value, (list, tuple)):
+        return (type(value), tuple([_freezeValue(v) for v in value]))
+    hash(value)
+    return (type(value), value)
+
+
+def _flatten(tag, ctx):
+    """
+    Flatten the tag, or return None if it includes something that has to wait,
+    i.e. a Deferred.
+    """
+    result = []
+    for item in flat.iterflatten(tag, ctx, result.append,
+            lambda item: isinstance(item, defer.Deferred)):
+        return None
+    return T.xml(''.join(result))
+
+
+__all__ = ['RenderCache']
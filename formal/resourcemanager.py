@@ -1,33 +1,111 @@
 import base64
+import errno
+import hashlib
 import tempfile
 import mimetypes
 import re
 import os
-from shutil import copyfileobj
+import threading
+import time
+from collections import OrderedDict
+from cStringIO import StringIO
 from exceptions import IOError, OSError
+from zope.interface import implements
+from twisted.application import service
+from twisted.internet import defer, reactor, task, threads
+from twisted.python import failure
+from twisted.python.threadpool import ThreadPool
+from formal import iformal
+from formal.upload import SpoolFile
+from formal.util import LRUCache
 
-
-# Use Python 2.4 base64 API if possible. Simulate on Python 2.3.
 try:
-    base64.b64encode
-except AttributeError:
-    # Python 2.3
-    def base64encode(s):
-        return base64.encodestring(s).replace('\n', '')
-    base64decode = base64.decodestring
-else:
-    # Python 2.4
-    base64encode = base64.b64encode
-    base64decode = base64.b64decode
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+
+# A resource id is a storage specific token and the encoded file name,
+# separated by '__'. The file name is base64 encoded using '-' and '.' in
+# place of '+' and '/' so that the id is safe in a URL and a file name and so
+# the separator can always be found. Ids created by the original
+# implementation, i.e. of mkstemp temporary files, are still understood.
+_RESOURCE_ID = re.compile( r'^[A-Za-z0-9_-]+__[A-Za-z0-9+.=-]*$' )
+_ALTCHARS = '-.'
+# The names of the files a TempDirectoryStorage creates, i.e. mkstemp
+# temporary files.
+_TEMP_RESOURCE = re.compile( r'^tmp[A-Za-z0-9_]+__[A-Za-z0-9+.=-]+$' )
+
+
+# The thread pool that resource managers run storage operations on, created
+# when first needed. See getThreadPool.
+_threadPool = None
+threadPoolSize = 4
+
+
+def getThreadPool():
+    """
+        Return the thread pool shared by all resource managers, starting it
+        if necessary. The pool is stopped when the reactor shuts down.
+
+        The pool is bounded, by threadPoolSize threads, so that a burst of
+        uploads queues for the disk rather than starting a thread each.
+    """
+    global _threadPool
+    if _threadPool is None:
+        _threadPool = ThreadPool( 0, threadPoolSize, 'formal.resourcemanager' )
+        _threadPool.start()
+        reactor.addSystemEventTrigger( 'during', 'shutdown', _stopThreadPool )
+    return _threadPool
+
+
+def _stopThreadPool():
+    global _threadPool
+    pool, _threadPool = _threadPool, None
+    if pool is not None:
+        pool.stop()
 
 
 class ResourceManagerException( Exception ):
     def __init__( self, *args, **kwds ):
         super( ResourceManagerException, self ).__init__( *args, **kwds )
 
+
+class UploadOffsetError( ResourceManagerException ):
+    """
+        A chunk of an upload was sent for the wrong offset. The offset the
+        upload has actually reached is the offset attribute.
+    """
+    def __init__( self, offset ):
+        super( UploadOffsetError, self ).__init__( offset )
+        self.offset = offset
+
+
 class ResourceManager( object ):
-    def __init__( self ):
+    """
+        Keep track of the files uploaded to a form's widgets between requests.
+
+        The files themselves are kept by an IResourceStorage, by default the
+        system's temporary directory.
+
+        The storage is disk (or database) I/O, which blocks. The methods whose
+        names start with 'defer' run the storage operations on a thread pool,
+        by default the one returned by getThreadPool, and return a Deferred so
+        that the reactor is not held up while files are copied, opened or
+        removed. The other methods call the storage directly, in the calling
+        thread.
+    """
+
+    def __init__( self, storage=None, threadPool=None, uploads=None ):
+        if storage is None:
+            storage = defaultStorage
+        if uploads is None:
+            uploads = defaultUploads
+        self.storage = storage
+        self.threadPool = threadPool
+        self.uploads = uploads
         self.widgetToID = {}
+        self.widgetToContentKey = {}
 
     def register( self, widgetName, resourceId ):
         self.widgetToID[widgetName] = resourceId
@@ -39,84 +117,984 @@ class ResourceManager( object ):
         resourceId = self.getResourceId( widgetName )
         if resourceId is None:
             return None
-        (path, fileName) = self._fromResourceId( resourceId )
-        mimetype = mimetypes.guess_type( fileName )[0]
+        return self.openResource( resourceId )
+
+    def openResource( self, resourceId ):
+        """
+            Return a (mimetype, filelike, fileName) tuple for the resource,
+            or None if it does not exist.
+        """
+        fileName = fileNameFromResourceId( resourceId )
+        if fileName is None:
+            return None
         try:
-            filelike = open( path, 'r' )
-            return (mimetype, filelike, fileName)
+            filelike = self.storage.open( resourceId )
         except IOError:
             return None
+        if filelike is None:
+            return None
+        mimetype = mimetypes.guess_type( fileName )[0]
+        return (mimetype, filelike, fileName)
 
     def getResourcePath( self, resourceId ):
         """
-            Required to create an instance of nevow.static.File
+            Required to create an instance of nevow.static.File. The path is
+            None if the storage does not keep the resource in a file.
         """
-        (path, fileName) = self._fromResourceId( resourceId )
+        fileName = fileNameFromResourceId( resourceId )
+        if fileName is None:
+            return (None, None, None)
         mimetype = mimetypes.guess_type( fileName )[0]
-        return (mimetype, path, fileName)
+        return (mimetype, self.storage.getPath( resourceId ), fileName)
 
     def setResource( self, widgetName, filelike, fileName ):
-        existingResource = self.widgetToID.get( widgetName )
+        contentKey = statContentKey( filelike )
+        if self._reusable( widgetName, contentKey ):
+            return self.widgetToID[widgetName]
+        resourceId = self._store( self.widgetToID.get( widgetName ), filelike,
+                fileName )
+        return self._stored( resourceId, widgetName, contentKey )
+
+    def clearUpResources( self ):
+        self._remove( self.widgetToID.values() )
+
+    def deferOpenResource( self, resourceId ):
+        """
+            Deferred version of openResource.
+        """
+        return self._defer( self.openResource, resourceId )
+
+    def deferGetResourceForWidget( self, widgetName ):
+        """
+            Deferred version of getResourceForWidget.
+        """
+        resourceId = self.getResourceId( widgetName )
+        if resourceId is None:
+            return defer.succeed( None )
+        return self.deferOpenResource( resourceId )
+
+    def deferSetResource( self, widgetName, filelike, fileName ):
+        """
+            Deferred version of setResource. The file-like must not be used
+            by anything else until the Deferred fires.
+        """
+        contentKey = statContentKey( filelike )
+        if self._reusable( widgetName, contentKey ):
+            return defer.succeed( self.widgetToID[widgetName] )
+        d = self._defer( self._store, self.widgetToID.get( widgetName ),
+                filelike, fileName )
+        return d.addCallback( self._stored, widgetName, contentKey )
+
+    def deferClearUpResources( self ):
+        """
+            Deferred version of clearUpResources.
+        """
+        return self._defer( self._remove, self.widgetToID.values() )
+
+    def beginUpload( self, fileName ):
+        """
+            Start a file that is uploaded a chunk at a time, returning the id
+            of the upload.
+        """
+        return self.uploads.begin( fileName )
+
+    def getUploadOffset( self, uploadId ):
+        """
+            Return the number of bytes of the upload received so far, or None
+            if there is no such upload.
+        """
+        return self.uploads.offset( uploadId )
+
+    def appendUpload( self, uploadId, offset, data ):
+        """
+            Add a chunk to an upload, returning the new offset. The chunk
+            must start at the upload's offset, otherwise UploadOffsetError is
+            raised. Returns None if there is no such upload.
+        """
+        return self.uploads.append( uploadId, offset, data )
+
+    def completeUpload( self, uploadId ):
+        """
+            Move a completed upload into the storage, returning the new
+            resource id, or None if there is no such upload.
+        """
+        filelike = self.uploads.open( uploadId )
+        if filelike is None:
+            return None
+        try:
+            resourceId = self.storage.store( filelike,
+                    fileNameFromResourceId( uploadId ) )
+        finally:
+            filelike.close()
+        if filelike.adoptable:
+            # Copied, rather than moved, into the storage.
+            self.uploads.remove( uploadId )
+        return resourceId
+
+    def deferBeginUpload( self, fileName ):
+        """
+            Deferred version of beginUpload.
+        """
+        return self._defer( self.beginUpload, fileName )
+
+    def deferGetUploadOffset( self, uploadId ):
+        """
+            Deferred version of getUploadOffset.
+        """
+        return self._defer( self.getUploadOffset, uploadId )
+
+    def deferAppendUpload( self, uploadId, offset, data ):
+        """
+            Deferred version of appendUpload.
+        """
+        return self._defer( self.appendUpload, uploadId, offset, data )
+
+    def deferCompleteUpload( self, uploadId ):
+        """
+            Deferred version of completeUpload.
+        """
+        return self._defer( self.completeUpload, uploadId )
+
+    def _defer( self, f, *a ):
+        threadPool = self.threadPool
+        if threadPool is None:
+            threadPool = getThreadPool()
+        return threads.deferToThreadPool( reactor, threadPool, f, *a )
+
+    def _reusable( self, widgetName, contentKey ):
+        """
+            True if the widget's existing resource has the content, i.e. the
+            same file is being stored for the widget again, e.g. an original
+            that is rendered more than once.
+        """
+        return contentKey is not None and widgetName in self.widgetToID and \
+                self.widgetToContentKey.get( widgetName ) == contentKey
+
+    # The storage operations, which may be run in a thread. The widget maps
+    # are only ever changed in the calling thread.
+
+    def _store( self, existingResource, filelike, fileName ):
         if existingResource is not None:
-            try:
-                (path, ignore) = self._fromResourceId( existingResource )
-                os.remove( path )
-            except OSError:
-                pass
+            self.storage.remove( existingResource )
+        return self.storage.store( filelike, fileName )
 
-        # Encode the filename to avoid any unicode filesystem errors.
-        fileName = self._encodeFilename(fileName)
-
-        (target, path) = tempfile.mkstemp( '__' + fileName )
-        
-        # target is a file handle. We want a file object.
-        target = os.fdopen(target, 'w')
-        
-        copyfileobj( filelike, target )
-        target.close()
-        resourceId = self._toResourceId( path )
+    def _stored( self, resourceId, widgetName, contentKey ):
         self.widgetToID[widgetName] = resourceId
+        self.widgetToContentKey[widgetName] = contentKey
         return resourceId
 
-    def _fromResourceId( self, resourceId ):
-        match = re.match( '^.*__(.*)$', resourceId )
-        if match is None:
+    def _remove( self, resourceIds ):
+        for id in resourceIds:
+            self.storage.remove( id )
+
+
+def makeResourceId( token, fileName ):
+    """
+        Build a resource id from a storage's token and the (possibly
+        unicode) file name.
+    """
+    return '%s__%s' % (token, encodeFileName( fileName ))
+
+
+def fileNameFromResourceId( resourceId ):
+    """
+        Return the file name encoded in a resource id, or None if the id is
+        not valid.
+    """
+    if isinstance( resourceId, unicode ):
+        # e.g. an id sent back in a JSON document
+        try:
+            resourceId = resourceId.encode( 'ascii' )
+        except UnicodeError:
+            return None
+    if not _RESOURCE_ID.match( resourceId ):
+        return None
+    try:
+        return decodeFileName( resourceId.rsplit( '__', 1 )[1] )
+    except (TypeError, UnicodeError):
+        return None
+
+
+def isValidResourceId( resourceId ):
+    return fileNameFromResourceId( resourceId ) is not None
+
+
+def encodeFileName( fileName ):
+    """
+        Encode the filename (which may be unicode) so it's safe to use with
+        the filesystem and in a URL.
+    """
+    return base64.b64encode( fileName.encode( 'utf-8' ), _ALTCHARS )
+
+
+def decodeFileName( encoded ):
+    """
+        Undo what encodeFileName did.
+    """
+    return base64.b64decode( encoded, _ALTCHARS ).decode( 'utf-8' )
+
+
+def _statResource( directory, name ):
+    """
+        Return a (resourceId, size, mtime) tuple for a file, or None if it
+        is not a resource or has gone.
+    """
+    if not isValidResourceId( name ):
+        return None
+    try:
+        stat = os.stat( os.path.join( directory, name ) )
+    except OSError:
+        return None
+    return (name, stat.st_size, stat.st_mtime)
+
+
+def statContentKey( filelike ):
+    """
+        Return a key for the content of a file-like open on a named file that
+        can be found without reading it, i.e. from the file's device, inode,
+        size and modification time. None is returned for any other file-like,
+        whose content has to be hashed instead.
+
+        A named file is a SpoolFile, or a file whose name is the absolute path
+        of an existing file. Temporary files without a name, e.g. cgi's
+        '<fdopen>' files, reuse the inodes of deleted files so their stat is
+        not a key for their content.
+
+        The content of such a file-like is taken to be the whole file,
+        whatever its current position.
+    """
+    if not isinstance( filelike, SpoolFile ):
+        name = getattr( filelike, 'name', None )
+        if not isinstance( name, basestring ) or not os.path.isabs( name ) \
+                or not os.path.exists( name ):
             return None
-        fileName = match.group( 1 )
-        path = os.sep.join( (tempfile.gettempdir(), resourceId) )
-        return path, self._decodeFilename(fileName)
+    try:
+        stat = os.fstat( filelike.fileno() )
+    except (AttributeError, IOError, OSError, ValueError):
+        return None
+    return ('stat', stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime)
 
-    def _toResourceId( self, path ):
-        path = path[len(tempfile.gettempdir()):]
-        if path[0] == os.sep:
-            path = path[1:]
+
+def _copyAndHash( source, target ):
+    """
+        Copy the content of one file-like to another, returning the SHA-1
+        content key of what was copied.
+    """
+    digest = hashlib.sha1()
+    while True:
+        data = source.read( 64 * 1024 )
+        if not data:
+            break
+        digest.update( data )
+        target.write( data )
+    return ('sha1', digest.digest())
+
+
+def _newToken():
+    return os.urandom( 16 ).encode( 'hex' )
+
+
+def _fileSize( filelike ):
+    """
+        Return the size of a real file, or None for other file-likes.
+    """
+    try:
+        return os.fstat( filelike.fileno() ).st_size
+    except (AttributeError, IOError, OSError):
+        return None
+
+
+class _PrefixedFile( object ):
+    """
+        A file-like whose content is some already read data followed by the
+        rest of another file-like.
+    """
+
+    def __init__( self, data, filelike ):
+        self.data = data
+        self.filelike = filelike
+
+    def read( self, size=-1 ):
+        data = self.data
+        if size < 0:
+            self.data = ''
+            return data + self.filelike.read()
+        if len( data ) >= size:
+            self.data = data[size:]
+            return data[:size]
+        self.data = ''
+        return data + self.filelike.read( size - len( data ) )
+
+
+class DirectoryStorage( object ):
+    """
+        Store resources as files in a directory.
+
+        directory:
+            The directory, created if necessary.
+        fanOut:
+            The number of levels of two character sub-directories to spread
+            the files across, so that no one directory grows too large.
+
+        An uploaded file that was spooled to a named file, see formal.upload,
+        is moved into place rather than copied when the directory is on the
+        same filesystem.
+
+        Resources with the same content share one file, by hard linking, where
+        the filesystem allows. A file is recognised by its identity, without
+        reading it, when it is stored again, e.g. an edit form's original
+        file, and otherwise by the SHA-1 of the content that is copied.
+    """
+    implements( iformal.IResourceStorage )
+
+    def __init__( self, directory, fanOut=2 ):
+        self.directory = directory
+        self.fanOut = fanOut
+        # Content key -> path of a resource with that content. Resources may
+        # be stored from several threads at once, see ResourceManager.
+        self._content = LRUCache( 10000 )
+        self._lock = threading.Lock()
+
+    def store( self, filelike, fileName ):
+        statKey = statContentKey( filelike )
+        if statKey is not None:
+            resourceId = self._storeLink( statKey, fileName )
+            if resourceId is not None:
+                return resourceId
+            filelike.seek( 0 )
+        fd, resourceId, path = self._create( fileName )
+        contentKey = None
+        if getattr( filelike, 'adoptable', False ) and \
+                self._adopt( filelike, path ):
+            os.close( fd )
+        else:
+            target = os.fdopen( fd, 'wb' )
+            try:
+                contentKey = _copyAndHash( filelike, target )
+            finally:
+                target.close()
+            existing = self._contentPath( contentKey )
+            if existing is not None:
+                # Share the existing file rather than keep another copy.
+                self._link( existing, path )
+        self._lock.acquire()
+        try:
+            for key in (statKey, contentKey):
+                if key is not None:
+                    self._content.set( key, path )
+        finally:
+            self._lock.release()
+        return resourceId
+
+    def open( self, resourceId ):
+        path = self.getPath( resourceId )
+        if path is None:
+            return None
+        try:
+            return open( path, 'rb' )
+        except IOError, e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+
+    def getPath( self, resourceId ):
+        if not isValidResourceId( resourceId ):
+            return None
+        return self._path( resourceId )
+
+    def remove( self, resourceId ):
+        path = self.getPath( resourceId )
+        if path is None:
+            return
+        try:
+            os.remove( path )
+        except OSError:
+            pass
+
+    def listResources( self ):
+        """
+            Generate a (resourceId, size, mtime) tuple for every resource.
+        """
+        for directory, dirs, files in os.walk( self.directory ):
+            for name in files:
+                resource = _statResource( directory, name )
+                if resource is not None:
+                    yield resource
+
+    def _create( self, fileName ):
+        """
+            Create a new, empty file for the resource, returning an open file
+            descriptor, the resource id and the path.
+        """
+        resourceId = makeResourceId( _newToken(), fileName )
+        path = self._path( resourceId )
+        directory = os.path.dirname( path )
+        if not os.path.isdir( directory ):
+            try:
+                os.makedirs( directory )
+            except OSError:
+                # Another request may have just created it.
+                if not os.path.isdir( directory ):
+                    raise
+        fd = os.open( path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600 )
+        return fd, resourceId, path
+
+    def _storeLink( self, contentKey, fileName ):
+        """
+            Store a resource as a link to an existing resource with the
+            content, returning the new resource id or None if there is no such
+            resource or it cannot be linked to.
+        """
+        existing = self._contentPath( contentKey )
+        if existing is None:
+            return None
+        fd, resourceId, path = self._create( fileName )
+        os.close( fd )
+        if not self._link( existing, path ):
+            os.remove( path )
+            return None
+        return resourceId
+
+    def _contentPath( self, contentKey ):
+        self._lock.acquire()
+        try:
+            path = self._content.get( contentKey )
+        finally:
+            self._lock.release()
+        if path is not None and not os.path.exists( path ):
+            self._lock.acquire()
+            try:
+                self._content.delete( contentKey )
+            finally:
+                self._lock.release()
+            path = None
         return path
 
-    def clearUpResources( self ):
-        for id in self.widgetToID.values():
+    def _link( self, existing, path ):
+        """
+            Replace the file at path with a hard link to existing. Returns
+            False if the link cannot be made.
+        """
+        directory, name = os.path.split( path )
+        temp = os.path.join( directory, '.link-' + name )
+        try:
+            os.link( existing, temp )
+            os.rename( temp, path )
+        except (AttributeError, OSError):
+            # No os.link on this platform, or not possible on this filesystem.
             try:
-                (path, fileName) = self._fromResourceId( id )
-                os.remove( path )
+                os.remove( temp )
             except OSError:
                 pass
-        
-    def _encodeFilename(self, filename):
+            return False
+        # The link shares the existing file's modification time. Refresh it so
+        # a ResourceJanitor does not treat the new resource as old.
+        try:
+            os.utime( path, None )
+        except OSError:
+            pass
+        return True
+
+    def _path( self, resourceId ):
+        parts = [self.directory]
+        for i in range( self.fanOut ):
+            parts.append( resourceId[i*2:i*2+2] )
+        parts.append( resourceId )
+        return os.path.join( *parts )
+
+    def _adopt( self, filelike, path ):
         """
-        Encode the filename (which may be unicode) so it's safe to use with
-        the filesystem.
-        NOTE: the string encode('base64') can result in strings with '\n'
-        embedded in them. the base64.b64encode() does not appear to suffer this
-        problem.
-        """
-        rv = filename.encode('utf-8')
-        rv = base64encode(rv)
-        return rv
-        
-    def _decodeFilename(self, filename):
-        """
-        Undo what _encodeFilename did.
-        """
-        rv = base64decode(filename)
-        rv = rv.decode('utf-8')
-        return rv
-        
+            Take over a file that an upload was spooled to, see
+            formal.upload, by renaming it rather than copying its content.
+            Returns False if the file could not be renamed, e.g. because it
+            is on a different filesystem.
+        """
+        try:
+            filelike.flush()
+            os.rename( filelike.name, path )
+        except (IOError, OSError):
+            return False
+        filelike.adoptable = False
+        return True
+
+
+class TempDirectoryStorage( DirectoryStorage ):
+    """
+        Store resources as temporary files in the system's temporary
+        directory. This is the default storage and creates the same ids as
+        the original, storage-less, implementation.
+    """
+
+    def __init__( self ):
+        DirectoryStorage.__init__( self, None, 0 )
+
+    def _create( self, fileName ):
+        fd, path = tempfile.mkstemp( '__' + encodeFileName( fileName ) )
+        return fd, os.path.basename( path ), path
+
+    def _path( self, resourceId ):
+        return os.path.join( tempfile.gettempdir(), resourceId )
+
+    def listResources( self ):
+        """
+            Generate a (resourceId, size, mtime) tuple for every resource in
+            the temporary directory, including those of other processes and
+            those left behind by earlier runs.
+        """
+        directory = tempfile.gettempdir()
+        for name in os.listdir( directory ):
+            if _TEMP_RESOURCE.match( name ):
+                resource = _statResource( directory, name )
+                if resource is not None:
+                    yield resource
+
+
+class MemoryStorage( object ):
+    """
+        Store small resources in memory, e.g. so that avatar uploads never
+        touch the disk.
+
+        maxBytes:
+            The total size of the resources kept. When exceeded, the least
+            recently used resources are discarded.
+        maxFileSize:
+            The size of the largest resource kept in memory. Larger ones are
+            passed to the fallback storage.
+        fallback:
+            The storage used for large resources, a TempDirectoryStorage by
+            default.
+
+        A single instance is typically shared by many forms. Resources with
+        the same content share the same data.
+    """
+    implements( iformal.IResourceStorage )
+
+    def __init__( self, maxBytes=16*1024*1024, maxFileSize=256*1024,
+            fallback=None ):
+        if fallback is None:
+            fallback = TempDirectoryStorage()
+        self.maxBytes = maxBytes
+        self.maxFileSize = maxFileSize
+        self.fallback = fallback
+        self.size = 0
+        self._resources = OrderedDict()
+        # Content key -> id of a resource with that content.
+        self._content = LRUCache( 10000 )
+        self._lock = threading.Lock()
+
+    def store( self, filelike, fileName ):
+        statKey = statContentKey( filelike )
+        contentKey = None
+        data = self._contentData( statKey )
+        if data is None:
+            if statKey is not None:
+                filelike.seek( 0 )
+            size = _fileSize( filelike )
+            if size is not None and size > self.maxFileSize:
+                return self.fallback.store( filelike, fileName )
+            data = filelike.read( self.maxFileSize + 1 )
+            if len( data ) > self.maxFileSize:
+                return self.fallback.store( _PrefixedFile( data, filelike ),
+                        fileName )
+            contentKey = ('sha1', hashlib.sha1( data ).digest())
+            data = self._contentData( contentKey ) or data
+        resourceId = makeResourceId( 'mem' + _newToken(), fileName )
+        self._lock.acquire()
+        try:
+            for key in (statKey, contentKey):
+                if key is not None:
+                    self._content.set( key, resourceId )
+            self._resources[resourceId] = (data, time.time())
+            self.size += len( data )
+            while self.size > self.maxBytes:
+                evicted, (data, stored) = self._resources.popitem( last=False )
+                self.size -= len( data )
+        finally:
+            self._lock.release()
+        return resourceId
+
+    def open( self, resourceId ):
+        self._lock.acquire()
+        try:
+            resource = self._resources.pop( resourceId, None )
+            if resource is not None:
+                # Reinsert to mark it as the most recently used.
+                self._resources[resourceId] = resource
+        finally:
+            self._lock.release()
+        if resource is None:
+            return self.fallback.open( resourceId )
+        return StringIO( resource[0] )
+
+    def getPath( self, resourceId ):
+        if resourceId in self._resources:
+            return None
+        return self.fallback.getPath( resourceId )
+
+    def _contentData( self, contentKey ):
+        """
+            Return the data of a resource with the content, or None.
+        """
+        if contentKey is None:
+            return None
+        self._lock.acquire()
+        try:
+            resource = self._resources.get( self._content.get( contentKey ) )
+        finally:
+            self._lock.release()
+        if resource is None:
+            return None
+        return resource[0]
+
+    def remove( self, resourceId ):
+        self._lock.acquire()
+        try:
+            resource = self._resources.pop( resourceId, None )
+            if resource is not None:
+                self.size -= len( resource[0] )
+        finally:
+            self._lock.release()
+        if resource is None:
+            self.fallback.remove( resourceId )
+
+    def listResources( self ):
+        self._lock.acquire()
+        try:
+            resources = [(resourceId, len( data ), stored) for
+                    resourceId, (data, stored) in self._resources.iteritems()]
+        finally:
+            self._lock.release()
+        return resources + list( self.fallback.listResources() )
+
+
+class SQLiteStorage( object ):
+    """
+        Store resources as blobs in a single SQLite database file.
+    """
+    implements( iformal.IResourceStorage )
+
+    def __init__( self, path ):
+        if sqlite3 is None:
+            raise ResourceManagerException( 'SQLiteStorage requires sqlite3' )
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect( path, check_same_thread=False )
+        self._db.execute( 'CREATE TABLE IF NOT EXISTS formal_resources '
+                '(id TEXT PRIMARY KEY, data BLOB NOT NULL, stored REAL NOT NULL)' )
+        self._db.commit()
+
+    def store( self, filelike, fileName ):
+        resourceId = makeResourceId( _newToken(), fileName )
+        data = sqlite3.Binary( filelike.read() )
+        self._execute( 'INSERT INTO formal_resources (id, data, stored) '
+                'VALUES (?, ?, ?)', (resourceId, data, time.time()),
+                commit=True )
+        return resourceId
+
+    def open( self, resourceId ):
+        rows = self._execute( 'SELECT data FROM formal_resources WHERE id = ?',
+                (resourceId,) )
+        if not rows:
+            return None
+        return StringIO( str( rows[0][0] ) )
+
+    def getPath( self, resourceId ):
+        return None
+
+    def remove( self, resourceId ):
+        self._execute( 'DELETE FROM formal_resources WHERE id = ?',
+                (resourceId,), commit=True )
+
+    def listResources( self ):
+        return self._execute( 'SELECT id, length(data), stored '
+                'FROM formal_resources', () )
+
+    def _execute( self, sql, params, commit=False ):
+        self._lock.acquire()
+        try:
+            rows = self._db.execute( sql, params ).fetchall()
+            if commit:
+                self._db.commit()
+            return rows
+        finally:
+            self._lock.release()
+
+
+class ResourceJanitor( service.Service ):
+    """
+        Remove the resources of abandoned forms, e.g. forms that failed
+        validation and were never submitted again, from a storage.
+
+        storage:
+            The storage to clean up, which must provide listResources().
+        maxAge:
+            Resources older than this many seconds are removed. None to keep
+            resources regardless of age.
+        maxBytes:
+            When the resources held exceed this many bytes the oldest are
+            removed until they do not. None for no limit.
+        interval:
+            The number of seconds between sweeps when running as a service.
+            The first sweep is made as soon as the service starts, removing
+            anything left behind by earlier runs.
+        clock:
+            A callable returning the current time in seconds, time.time by
+            default.
+        threadPool:
+            The thread pool that deferSweep, and so the service, sweeps on,
+            by default the one returned by getThreadPool.
+
+        The janitor keeps some metrics, updated after each sweep:
+        resourcesHeld and bytesHeld, what the storage holds, and
+        resourcesReaped and bytesReaped, the totals removed so far.
+    """
+
+    def __init__( self, storage, maxAge=24*60*60, maxBytes=None,
+            interval=15*60, clock=None, threadPool=None ):
+        if clock is None:
+            clock = time.time
+        self.storage = storage
+        self.maxAge = maxAge
+        self.maxBytes = maxBytes
+        self.interval = interval
+        self.clock = clock
+        self.threadPool = threadPool
+        self.resourcesHeld = 0
+        self.bytesHeld = 0
+        self.resourcesReaped = 0
+        self.bytesReaped = 0
+        self._loop = None
+        # The Deferreds waiting for the sweep in progress, if any.
+        self._waiting = None
+
+    def startService( self ):
+        service.Service.startService( self )
+        self._loop = task.LoopingCall( self.deferSweep )
+        self._loop.start( self.interval, now=True )
+
+    def stopService( self ):
+        service.Service.stopService( self )
+        if self._loop is not None and self._loop.running:
+            self._loop.stop()
+        self._loop = None
+
+    def sweep( self ):
+        """
+            Remove the resources that are too old and then, oldest first,
+            any over the byte quota.
+        """
+        self._swept( self._sweep() )
+
+    def deferSweep( self ):
+        """
+            Deferred version of sweep, which sweeps on the janitor's thread
+            pool. A sweep is not started while another is in progress; the
+            Deferred fires when that one finishes instead.
+        """
+        if self._waiting is not None:
+            d = defer.Deferred()
+            self._waiting.append( d )
+            return d
+        self._waiting = []
+        threadPool = self.threadPool
+        if threadPool is None:
+            threadPool = getThreadPool()
+        d = threads.deferToThreadPool( reactor, threadPool, self._sweep )
+        return d.addCallback( self._swept ).addBoth( self._cbSwept )
+
+    def _sweep( self ):
+        """
+            Sweep the storage, returning the (resourcesReaped, bytesReaped,
+            resourcesHeld, bytesHeld) of the sweep.
+        """
+        now = self.clock()
+        keep = []
+        reaped = []
+        for resource in self.storage.listResources():
+            resourceId, size, mtime = resource
+            if self.maxAge is not None and now - mtime > self.maxAge:
+                self.storage.remove( resourceId )
+                reaped.append( size )
+            else:
+                keep.append( resource )
+
+        held = sum( [size for resourceId, size, mtime in keep] )
+        if self.maxBytes is not None and held > self.maxBytes:
+            keep.sort( key=lambda resource: resource[2] )
+            while keep and held > self.maxBytes:
+                resourceId, size, mtime = keep.pop( 0 )
+                self.storage.remove( resourceId )
+                reaped.append( size )
+                held -= size
+
+        return (len( reaped ), sum( reaped ), len( keep ), held)
+
+    def _swept( self, result ):
+        resourcesReaped, bytesReaped, self.resourcesHeld, self.bytesHeld = \
+                result
+        self.resourcesReaped += resourcesReaped
+        self.bytesReaped += bytesReaped
+
+    def _cbSwept( self, result ):
+        waiting, self._waiting = self._waiting, None
+        for d in waiting:
+            if isinstance( result, failure.Failure ):
+                d.errback( result )
+            else:
+                d.callback( result )
+        return result
+
+
+class ChunkedUploads( object ):
+    """
+        Keep the files being uploaded a chunk at a time, see
+        FileUploadWidget's chunked option, until they are complete.
+
+        A partial file is kept in the directory, named by its upload id, and
+        an upload's offset is simply the size of its file, so an upload can be
+        resumed by any process sharing the directory, even after a restart.
+        Completed files are moved into the resource manager's storage by
+        renaming where possible, see DirectoryStorage.
+
+        Abandoned uploads can be removed by a ResourceJanitor.
+
+        directory:
+            The directory, created if necessary. Defaults to the system's
+            temporary directory.
+    """
+
+    PREFIX = 'formal-chunked-'
+
+    def __init__( self, directory=None ):
+        if directory is None:
+            directory = tempfile.gettempdir()
+        self.directory = directory
+        # A lock per upload being appended to, with the number of threads
+        # using it, and the lock that guards them.
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def begin( self, fileName ):
+        if not os.path.isdir( self.directory ):
+            try:
+                os.makedirs( self.directory )
+            except OSError:
+                if not os.path.isdir( self.directory ):
+                    raise
+        uploadId = makeResourceId( _newToken(), fileName )
+        fd = os.open( self._path( uploadId ),
+                os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600 )
+        os.close( fd )
+        return uploadId
+
+    def offset( self, uploadId ):
+        path = self._path( uploadId )
+        if path is None:
+            return None
+        try:
+            return os.stat( path ).st_size
+        except OSError:
+            return None
+
+    def append( self, uploadId, offset, data ):
+        path = self._path( uploadId )
+        if path is None:
+            return None
+        # Chunks for the same upload, e.g. a retry racing the original, are
+        # appended one at a time so the offset check holds.
+        lock = self._acquire( uploadId )
+        try:
+            try:
+                f = open( path, 'r+b' )
+            except IOError, e:
+                if e.errno == errno.ENOENT:
+                    return None
+                raise
+            try:
+                f.seek( 0, 2 )
+                if f.tell() != offset:
+                    raise UploadOffsetError( f.tell() )
+                f.write( data )
+                return f.tell()
+            finally:
+                f.close()
+        finally:
+            self._release( uploadId, lock )
+
+    def open( self, uploadId ):
+        """
+            Return an adoptable file open on the upload, or None.
+        """
+        path = self._path( uploadId )
+        if path is None:
+            return None
+        try:
+            return SpoolFile( path, 'rb' )
+        except IOError, e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+
+    def remove( self, uploadId ):
+        path = self._path( uploadId )
+        if path is None:
+            return
+        try:
+            os.remove( path )
+        except OSError:
+            pass
+
+    def listResources( self ):
+        """
+            Generate an (uploadId, size, mtime) tuple for every upload, so
+            that a ResourceJanitor can remove abandoned uploads.
+        """
+        try:
+            names = os.listdir( self.directory )
+        except OSError:
+            return
+        for name in names:
+            if not name.startswith( self.PREFIX ):
+                continue
+            uploadId = name[len( self.PREFIX ):]
+            if not isValidResourceId( uploadId ):
+                continue
+            try:
+                stat = os.stat( os.path.join( self.directory, name ) )
+            except OSError:
+                continue
+            yield (uploadId, stat.st_size, stat.st_mtime)
+
+    def _acquire( self, uploadId ):
+        self._lock.acquire()
+        try:
+            lock, users = self._locks.get( uploadId, (None, 0) )
+            if lock is None:
+                lock = threading.Lock()
+            self._locks[uploadId] = (lock, users + 1)
+        finally:
+            self._lock.release()
+        lock.acquire()
+        return lock
+
+    def _release( self, uploadId, lock ):
+        lock.release()
+        self._lock.acquire()
+        try:
+            users = self._locks[uploadId][1] - 1
+            if users:
+                self._locks[uploadId] = (lock, users)
+            else:
+                del self._locks[uploadId]
+        finally:
+            self._lock.release()
+
+    def _path( self, uploadId ):
+        if not isValidResourceId( uploadId ):
+            return None
+        return os.path.join( self.directory, self.PREFIX + uploadId )
+
+
+# The storage used by a ResourceManager that is not given one.
+defaultStorage = TempDirectoryStorage()
+defaultUploads = ChunkedUploads()
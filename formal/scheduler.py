@@ -0,0 +1,150 @@
+"""
+Scheduling of (typically asynchronous) validators so that forms with many
+expensive validators, e.g. database lookups, cannot overwhelm the resources
+they use.
+"""
+
+import heapq
+import itertools
+from zope.interface import implements
+from twisted.internet import defer
+from formal import iformal
+
+
+class ValidationScheduler(object):
+    """
+    Limit the number of validators running at once.
+
+    A scheduler is assigned to a form (or to the form that a FormSchema is
+    compiled from) using the form's validationScheduler attribute and is
+    typically shared by all instances of the form, and even by several forms,
+    so that the limits apply across concurrent submissions.
+
+    limit:
+        The maximum number of validators running at once.
+    perValidatorLimit:
+        The default maximum number of calls to any one validator running at
+        once, or None for no limit other than limit.
+
+    When a limit is reached, validation is queued and run, in order of the
+    validator's priority, then cost, then arrival, as running validators
+    complete. Validators may declare any of the following attributes:
+
+    priority:
+        Higher priority validators are run first. Defaults to 0.
+    cost:
+        Cheaper validators are run first. Defaults to 0.
+    maxConcurrency:
+        Overrides perValidatorLimit for the validator.
+    concurrencyKey:
+        Validators with the same key share their per-validator limit, e.g.
+        different validators that query the same database. Defaults to the
+        validator itself.
+    synchronous:
+        True if the validator never returns a Deferred. Synchronous
+        validators complete immediately so they are never queued.
+    """
+    implements(iformal.IValidationScheduler)
+
+    def __init__(self, limit=10, perValidatorLimit=None):
+        self.limit = limit
+        self.perValidatorLimit = perValidatorLimit
+        self.running = 0
+        self.runningByKey = {}
+        self.queue = []
+        self._order = itertools.count()
+        self._draining = False
+
+    def schedule(self, validator, field, value):
+        """
+        Call validator.validate(field, value) as soon as the limits allow.
+
+        If the validator can be called immediately its result, or exception,
+        is passed straight back. Otherwise a Deferred is returned that fires
+        with the result once the validator has been called and completed.
+        """
+        if getattr(validator, 'synchronous', False):
+            return validator.validate(field, value)
+        key = getattr(validator, 'concurrencyKey', None) or validator
+        if self._canRun(validator, key):
+            return self._run(validator, field, value, key)
+        d = defer.Deferred()
+        rank = (-getattr(validator, 'priority', 0),
+                getattr(validator, 'cost', 0), self._order.next())
+        heapq.heappush(self.queue, (rank, validator, field, value, key, d))
+        return d
+
+    def _canRun(self, validator, key):
+        if self.running >= self.limit:
+            return False
+        keyLimit = getattr(validator, 'maxConcurrency', None)
+        if keyLimit is None:
+            keyLimit = self.perValidatorLimit
+        return keyLimit is None or self.runningByKey.get(key, 0) < keyLimit
+
+    def _run(self, validator, field, value, key):
+        self.running += 1
+        self.runningByKey[key] = self.runningByKey.get(key, 0) + 1
+        try:
+            result = validator.validate(field, value)
+        except:
+            self._release(key)
+            raise
+        if isinstance(result, defer.Deferred):
+            return result.addBoth(self._cbRelease, key)
+        self._release(key)
+        return result
+
+    def _cbRelease(self, result, key):
+        self._release(key)
+        return result
+
+    def _release(self, key):
+        self.running -= 1
+        count = self.runningByKey[key] - 1
+        if count:
+            self.runningByKey[key] = count
+        else:
+            del self.runningByKey[key]
+        self._drain()
+
+    def _drain(self):
+        """
+        Run as many queued validators as the limits now allow, in order.
+        """
+        # Validators complete, and so release, while the queue is being
+        # drained. The loop below will pick up any capacity that frees.
+        if self._draining:
+            return
+        self._draining = True
+        try:
+            # Keep going until a pass over the queue runs nothing. Entries
+            # skipped because of a per-validator limit may become runnable as
+            # later entries complete synchronously.
+            progress = True
+            while progress:
+                progress = False
+                blocked = []
+                while self.queue and self.running < self.limit:
+                    entry = heapq.heappop(self.queue)
+                    rank, validator, field, value, key, d = entry
+                    if not self._canRun(validator, key):
+                        blocked.append(entry)
+                        continue
+                    progress = True
+                    try:
+                        result = self._run(validator, field, value, key)
+                    except:
+                        d.errback()
+                    else:
+                        if isinstance(result, defer.Deferred):
+                            result.chainDeferred(d)
+                        else:
+                            d.callback(result)
+                for entry in blocked:
+                    heapq.heappush(self.queue, entry)
+        finally:
+            self._draining = False
+
+
+__all__ = ['ValidationScheduler']
@@ -0,0 +1,120 @@
+from datetime import date
+from twisted.internet import defer
+from twisted.trial import unittest
+import formal
+from formal import validation
+
+
+def makeForm():
+    form = formal.Form()
+    form.addField('name', formal.String(required=True, strip=True))
+    form.addField('age', formal.Integer(validators=[formal.RangeValidator(min=18)]))
+    form.addField('id', formal.Integer(immutable=True))
+    group = form.addGroup('group')
+    group.addField('born', formal.Date())
+    group.addField('tags', formal.Sequence(formal.Integer()))
+    return form
+
+
+class TestRecordValidator(unittest.TestCase):
+
+    def test_valid(self):
+        validator = formal.RecordValidator(makeForm())
+        data, errors = validator.validate({'name': ' Matt ', 'age': '30',
+            'group.born': '2000-01-02', 'group.tags': ['1', 2]})
+        self.failIf(errors)
+        self.assertEquals(data, {'name': 'Matt', 'age': 30,
+            'group.born': date(2000, 1, 2), 'group.tags': [1, 2]})
+
+    def test_typedValues(self):
+        validator = formal.RecordValidator(makeForm())
+        data, errors = validator.validate({'name': u'Matt', 'age': 30,
+            'group.born': date(2000, 1, 2)})
+        self.failIf(errors)
+        self.assertEquals(data['age'], 30)
+        self.assertEquals(data['group.born'], date(2000, 1, 2))
+        self.assertEquals(data['group.tags'], None)
+
+    def test_errors(self):
+        validator = formal.RecordValidator(makeForm())
+        data, errors = validator.validate({'age': '12', 'group.born': 'foo',
+            'id': '1'})
+        self.failUnless(isinstance(errors.getFieldError('name'),
+            validation.FieldRequiredError))
+        self.assertEquals(errors.getFieldError('age').message, 'Must be greater than 18')
+        self.assertEquals(errors.getFieldError('group.born').message, 'Invalid date')
+        self.assertEquals(errors.getErrorCount('group'), 1)
+        self.assertEquals(data, {'group.tags': None})
+
+    def test_jsonValues(self):
+        validator = formal.RecordValidator(makeForm())
+        data, errors = validator.validate({'name': 5, 'age': 20.0,
+            'group.tags': [1, [3]]})
+        self.assertEquals(data['name'], '5')
+        self.assertEquals(errors.getFieldError('age').message,
+                'Not a valid number')
+        self.assertEquals(errors.getFieldError('group.tags').message,
+                'Invalid value')
+        data, errors = validator.validate({'name': {'first': 'Matt'},
+            'age': [30], 'group.born': 20000102})
+        self.assertEquals(errors.getFieldError('name').message, 'Invalid value')
+        self.assertEquals(errors.getFieldError('age').message, 'Invalid value')
+        self.assertEquals(errors.getFieldError('group.born').message,
+                'Invalid date')
+
+    def test_schema(self):
+        schema = formal.FormSchema(makeForm())
+        results = list(formal.validateRecords(schema, [{'name': 'a'}, {}]))
+        self.assertEquals(len(results), 2)
+        self.failIf(results[0][1])
+        self.failUnless(results[1][1])
+
+    def test_deferredValidator(self):
+        class DeferredValidator(object):
+            def validate(self, field, value):
+                if value == 'fail':
+                    return defer.fail(validation.FieldValidationError('failed'))
+                return defer.succeed(None)
+        form = formal.Form()
+        form.addField('name', formal.String(validators=[DeferredValidator()]))
+        results = list(formal.validateRecords(form, [{'name': 'ok'}, {'name': 'fail'}]))
+        d = defer.gatherResults(results)
+        def check(results):
+            (data, errors), (_, failed) = results
+            self.assertEquals(data, {'name': 'ok'})
+            self.failIf(errors)
+            self.assertEquals(failed.getFieldError('name').message, 'failed')
+        return d.addCallback(check)
+
+
+class TestParallel(unittest.TestCase):
+
+    def test_order(self):
+        records = [{'name': str(i), 'age': str(i)} for i in xrange(25)]
+        progress = []
+        results = list(formal.validateRecordsInParallel(makeForm, records,
+            processes=2, chunkSize=4, maxPendingChunks=2,
+            progress=lambda *a: progress.append(a)))
+        self.assertEquals(len(results), 25)
+        for i, (data, errors) in enumerate(results):
+            self.assertEquals(data['name'], str(i))
+            if i < 18:
+                self.assertEquals(errors.getFieldError('age').message,
+                        'Must be greater than 18')
+            else:
+                self.assertEquals(data['age'], i)
+                self.failIf(errors)
+        self.assertEquals(progress[-1], (7, 25))
+        self.assertEquals([p[1] for p in progress], [4, 8, 12, 16, 20, 24, 25])
+
+    def test_backPressure(self):
+        consumed = []
+        def records():
+            for i in xrange(1000):
+                consumed.append(i)
+                yield {'name': 'x'}
+        results = formal.validateRecordsInParallel(makeForm, records(),
+                processes=1, chunkSize=10, maxPendingChunks=2)
+        results.next()
+        self.failUnless(len(consumed) <= 30)
+        results.close()
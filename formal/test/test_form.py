@@ -1,8 +1,12 @@
+from datetime import date
+from StringIO import StringIO
+from twisted.internet import defer
 from twisted.trial import unittest
-from nevow import testutil
+from nevow import flat, inevow, loaders, testutil
 from nevow import context
 
 import formal
+from formal.util import cssKey, json, partNamer, render_cssid
 from formal.validation import FieldRequiredError
 
 class TestForm(unittest.TestCase):
@@ -28,6 +32,19 @@ class TestForm(unittest.TestCase):
         d.addCallback(done)
         return d
 
+    def test_processNoResources(self):
+        # A form with nothing uploaded does not clear up its resources.
+        form = formal.Form()
+        request = testutil.FakeRequest(args={'foo': ['bar', ]})
+        ctx = context.RequestContext(tag=request)
+        form.addField('foo', formal.String())
+        form.addAction(lambda *a, **kw: 'done')
+        def clearUp():
+            self.fail('Resources cleared up')
+        form.resourceManager.deferClearUpResources = clearUp
+        d = form.process(ctx)
+        return d.addCallback(self.failUnlessEqual, 'done')
+
     def test_processError(self):
         form = formal.Form()
         request = testutil.FakeRequest()
@@ -43,3 +60,571 @@ class TestForm(unittest.TestCase):
         d.addCallbacks(done)
         return d
 
+
+
+class TestFormSchema(unittest.TestCase):
+
+    def makeSchema(self):
+        form = formal.Form()
+        form.addField('foo', formal.String(required=True))
+        group = form.addGroup('group')
+        group.addField('bar', formal.Integer(), label='Bar!')
+        form.addAction(lambda *a, **kw: None)
+        return formal.FormSchema(form)
+
+    def test_fields(self):
+        schema = self.makeSchema()
+        self.failUnlessEqual([f.key for f in schema.fields], ['foo', 'group.bar'])
+        field = schema.getField('group.bar')
+        self.failUnlessEqual(field.label, 'Bar!')
+        self.failUnlessEqual(field.converter.toType('1'), 1)
+        self.failUnlessEqual(field.itemConverter, None)
+        # Records are converted with the schema's own converters.
+        self.failUnless(schema.recordValidator.fields[1].converter is
+                field.converter)
+        self.assertRaises(KeyError, schema.getField, 'baz')
+
+    def test_immutable(self):
+        schema = self.makeSchema()
+        self.assertRaises(AttributeError, setattr, schema, 'callback', None)
+        self.assertRaises(AttributeError, setattr, schema.fields[0], 'key', 'baz')
+        self.assertRaises(TypeError, schema.items.add, formal.Field('baz', formal.String()))
+        group = schema.items.getItemByName('group')
+        self.assertRaises(TypeError, group.addField, 'baz', formal.String())
+
+    def test_makeForm(self):
+        schema = self.makeSchema()
+        form1, form2 = schema.makeForm(), schema.makeForm()
+        self.failUnless(form1.items is form2.items)
+        self.failIf(form1.data is form2.data)
+        self.failIf(form1.errors is form2.errors)
+        self.failIf(form1.actions is form2.actions)
+        self.failUnlessEqual(len(form1.actions), 1)
+        form1.addAction(lambda *a, **kw: None, name='other')
+        self.failUnlessEqual(len(form2.actions), 1)
+        self.assertRaises(TypeError, form1.addField, 'baz', formal.String())
+
+    def test_process(self):
+        schema = self.makeSchema()
+        form = schema.makeForm()
+        request = testutil.FakeRequest(args={'foo': ['bar'], 'group.bar': ['1']})
+        ctx = context.RequestContext(tag=request)
+        d = form.process(ctx)
+
+        def done(_):
+            self.failUnlessEqual(form.data, {'foo': 'bar', 'group.bar': 1})
+            self.failUnlessEqual(schema.makeForm().data, {})
+
+        d.addCallback(done)
+        return d
+
+
+class TestItemKeys(unittest.TestCase):
+
+    def test_keys(self):
+        form = formal.Form()
+        field = form.addField('foo', formal.String())
+        group = form.addGroup('group')
+        nested = group.addField('bar', formal.String())
+        self.failUnlessEqual(field.key, 'foo')
+        self.failUnlessEqual(group.key, 'group')
+        self.failUnlessEqual(nested.key, 'group.bar')
+
+    def test_lateAttachment(self):
+        # Keys are kept up to date when a populated group is added later.
+        outer = formal.Group('outer')
+        inner = outer.addGroup('inner')
+        field = inner.addField('foo', formal.String())
+        self.failUnlessEqual(field.key, 'outer.inner.foo')
+        form = formal.Form()
+        wrapper = form.addGroup('wrapper')
+        wrapper.add(outer)
+        self.failUnlessEqual(inner.key, 'wrapper.outer.inner')
+        self.failUnlessEqual(field.key, 'wrapper.outer.inner.foo')
+        self.failUnlessEqual(field.key, formal.form.itemKey(field))
+
+    def test_cssKey(self):
+        form = formal.Form()
+        group = form.addGroup('group')
+        group.addField('foo', formal.String())
+        field = form.getItemByName('group').getItemByName('foo')
+        self.failUnlessEqual(field.cssKey, 'group-foo')
+        self.failUnlessEqual(field.partNamer('year'), 'group.foo__year')
+        self.failUnlessEqual(cssKey('group.foo'), 'group-foo')
+        self.failUnlessEqual(render_cssid('group.foo', 'extra')[1:],
+                ['-', 'group-foo', '-', 'extra'])
+        self.failUnlessEqual(partNamer('group.foo')('year'), 'group.foo__year')
+        # Widgets are given the key, which carries the field's own.
+        self.failUnless(partNamer(field.key) is field.partNamer)
+        self.failUnless(cssKey(field.key) is field.cssKey)
+        self.failUnlessEqual(field.key, u'group.foo')
+        self.failUnlessEqual({u'group.foo': 1}[field.key], 1)
+        # Moving the group moves its items' ids and names too.
+        formal.Form().addGroup('outer').add(group)
+        self.failUnlessEqual(group.cssKey, 'outer-group')
+        self.failUnlessEqual(field.cssKey, 'outer-group-foo')
+        self.failUnlessEqual(field.partNamer('year'), 'outer.group.foo__year')
+
+
+class TestFormItems(unittest.TestCase):
+
+    def test_unique(self):
+        form = formal.Form()
+        form.addField('foo', formal.String())
+        self.assertRaises(ValueError, form.addField, 'foo', formal.String())
+        group = form.addGroup('group')
+        group.addField('foo', formal.String())
+        self.assertRaises(ValueError, group.addField, 'foo', formal.String())
+
+    def test_getItemByName(self):
+        form = formal.Form()
+        foo = form.addField('foo', formal.String())
+        group = form.addGroup('group')
+        inner = group.addGroup('inner')
+        bar = inner.addField('bar', formal.String())
+        self.failUnless(form.getItemByName('foo') is foo)
+        self.failUnless(form.getItemByName('group.inner') is inner)
+        self.failUnless(form.getItemByName('group.inner.bar') is bar)
+        self.failUnless(group.getItemByName('inner.bar') is bar)
+        self.assertRaises(KeyError, form.getItemByName, 'group.baz')
+        self.assertRaises(KeyError, group.getItemByName, 'inner.baz')
+
+    def test_indexLateAdditions(self):
+        # Items added to groups that are already part of the form, or groups
+        # populated before being added, are all found by key.
+        form = formal.Form()
+        group = form.addGroup('group')
+        foo = group.addField('foo', formal.String())
+        detached = formal.Group('detached')
+        bar = detached.addField('bar', formal.String())
+        group.add(detached)
+        baz = detached.addField('baz', formal.String())
+        self.failUnless(form.getItemByName('group.foo') is foo)
+        self.failUnless(form.getItemByName('group.detached.bar') is bar)
+        self.failUnless(form.getItemByName('group.detached.baz') is baz)
+        self.failUnlessEqual(sorted(form.items.itemsByKey.keys()), [
+            'group', 'group.detached', 'group.detached.bar',
+            'group.detached.baz', 'group.foo'])
+
+
+class TestProcessing(unittest.TestCase):
+
+    def makeForm(self, validators=None):
+        form = formal.Form()
+        form.addField('foo', formal.String(required=True))
+        group = form.addGroup('group')
+        group.addField('bar', formal.Integer(validators=validators))
+        form.addAction(lambda *a, **kw: None)
+        return form
+
+    def process(self, form, args):
+        request = testutil.FakeRequest(args=args)
+        return form.process(context.RequestContext(tag=request))
+
+    def test_synchronousFields(self):
+        form = self.makeForm()
+        request = testutil.FakeRequest(args={'foo': ['x'], 'group.bar': ['1']})
+        ctx = context.RequestContext(tag=request)
+        field = form.getItemByName('foo')
+        self.failUnlessEqual(field.process(ctx, form, {'foo': ['x']}, form.errors), None)
+        self.failUnlessEqual(form.data['foo'], 'x')
+
+    def test_synchronousErrors(self):
+        form = self.makeForm()
+        d = self.process(form, {'group.bar': ['x']})
+        def done(errors):
+            self.failUnless(errors is form.errors)
+            self.failUnless(isinstance(errors.getFieldError('foo'), FieldRequiredError))
+            self.failUnlessEqual(errors.getFieldError('group.bar').message, 'Not a valid number')
+        return d.addCallback(done)
+
+    def test_uncheckable(self):
+        # Uploads are left for the whole form, and a widget that fails
+        # unexpectedly only fails its own field.
+        class BrokenWidget(formal.TextInput):
+            def processInput(self, ctx, key, args):
+                raise RuntimeError('broken')
+        form = self.makeForm()
+        form.addField('file', formal.File(), formal.FileUploadWidget)
+        form.addField('raw', formal.File(), formal.FileUploadRaw)
+        form.addField('broken', formal.String(), BrokenWidget)
+        request = testutil.FakeRequest(args={'file': [''], 'raw': [''],
+            'broken': ['x'], 'group.bar': ['1'], formal.form.FIELDS_KEY:
+                ['file', 'raw', 'broken', 'group.bar']})
+        ctx = context.RequestContext(tag=request)
+        resource = formal.form.FieldValidationResource(form)
+        d = defer.maybeDeferred(resource.renderHTTP, ctx)
+        def rendered(body):
+            self.failUnlessEqual(json.loads(body), {'group.bar': None,
+                'broken': 'Could not be validated'})
+            self.assertEquals(len(self.flushLoggedErrors(RuntimeError)), 1)
+        return d.addCallback(rendered)
+
+    def test_deferredValidator(self):
+        class DeferredValidator(object):
+            def validate(self, field, value):
+                if value == 2:
+                    return defer.fail(formal.FieldValidationError('Two'))
+                return defer.succeed(None)
+        form = self.makeForm(validators=[DeferredValidator()])
+        d = self.process(form, {'foo': ['x'], 'group.bar': ['2']})
+        def done(errors):
+            self.failUnless(errors is form.errors)
+            self.failUnlessEqual(errors.getFieldError('group.bar').message, 'Two')
+            valid = self.makeForm(validators=[DeferredValidator()])
+            d = self.process(valid, {'foo': ['x'], 'group.bar': ['1']})
+            d.addCallback(self.failUnlessEqual, None)
+            d.addCallback(lambda _: self.failUnlessEqual(valid.data,
+                {'foo': 'x', 'group.bar': 1}))
+            return d
+        return d.addCallback(done)
+
+
+class TestFieldValidation(unittest.TestCase):
+
+    def makeForm(self, validators=None):
+        form = formal.Form()
+        form.addField('foo', formal.String(required=True))
+        form.addField('id', formal.Integer(immutable=True))
+        group = form.addGroup('group')
+        group.addField('bar', formal.Integer(validators=validators))
+        form.addAction(lambda *a, **kw: None)
+        return form
+
+    def test_validateFields(self):
+        form = self.makeForm()
+        request = testutil.FakeRequest(args={'group.bar': ['x']})
+        ctx = context.RequestContext(tag=request)
+        errors = form.validateFields(ctx, ['group.bar'])
+        self.failUnlessEqual(errors.getFieldError('group.bar').message,
+                'Not a valid number')
+        # Only the named fields are validated and the form is untouched.
+        self.failUnlessEqual(errors.getFieldError('foo'), None)
+        self.failIf(form.errors)
+        self.failUnlessEqual(form.data, {})
+
+    def test_resource(self):
+        form = self.makeForm()
+        request = testutil.FakeRequest(args={'foo': [''], 'group.bar': ['1'],
+            formal.form.FIELDS_KEY: ['foo', 'group.bar', 'group', 'id', 'x']})
+        ctx = context.RequestContext(tag=request)
+        resource = formal.form.FieldValidationResource(form)
+        d = defer.maybeDeferred(resource.renderHTTP, ctx)
+        def rendered(body):
+            self.failUnlessEqual(json.loads(body),
+                    {'foo': 'Required', 'group.bar': None})
+            self.failUnlessEqual(request.headers['content-type'],
+                    'application/json; charset=utf-8')
+        return d.addCallback(rendered)
+
+    def test_uncheckable(self):
+        # Uploads are left for the whole form, and a widget that fails
+        # unexpectedly only fails its own field.
+        class BrokenWidget(formal.TextInput):
+            def processInput(self, ctx, key, args):
+                raise RuntimeError('broken')
+        form = self.makeForm()
+        form.addField('file', formal.File(), formal.FileUploadWidget)
+        form.addField('raw', formal.File(), formal.FileUploadRaw)
+        form.addField('broken', formal.String(), BrokenWidget)
+        request = testutil.FakeRequest(args={'file': [''], 'raw': [''],
+            'broken': ['x'], 'group.bar': ['1'], formal.form.FIELDS_KEY:
+                ['file', 'raw', 'broken', 'group.bar']})
+        ctx = context.RequestContext(tag=request)
+        resource = formal.form.FieldValidationResource(form)
+        d = defer.maybeDeferred(resource.renderHTTP, ctx)
+        def rendered(body):
+            self.failUnlessEqual(json.loads(body), {'group.bar': None,
+                'broken': 'Could not be validated'})
+            self.assertEquals(len(self.flushLoggedErrors(RuntimeError)), 1)
+        return d.addCallback(rendered)
+
+    def test_deferredValidator(self):
+        class DeferredValidator(object):
+            def validate(self, field, value):
+                return defer.fail(formal.FieldValidationError('Two'))
+        form = self.makeForm(validators=[DeferredValidator()])
+        request = testutil.FakeRequest(args={'group.bar': ['2']})
+        ctx = context.RequestContext(tag=request)
+        d = form.validateFields(ctx, ['group.bar'])
+        d.addCallback(lambda errors: self.failUnlessEqual(
+            errors.getFieldError('group.bar').message, 'Two'))
+        return d
+
+
+class TestJSONProcessing(unittest.TestCase):
+
+    def makeForm(self, submitted):
+        form = formal.Form()
+        form.addField('foo', formal.String(required=True))
+        form.addField('when', formal.Date())
+        group = form.addGroup('group')
+        group.addField('bar', formal.Integer())
+        group.addField('tags', formal.Sequence(formal.Integer()))
+        form.addAction(lambda ctx, form, data: submitted.append(data))
+        form.name = 'test'
+        return form
+
+    def makeContext(self, body):
+        request = testutil.FakeRequest(
+                headers={'content-type': 'application/json; charset=utf-8'})
+        request.method = 'POST'
+        request.content = StringIO(body)
+        return context.RequestContext(tag=request)
+
+    def test_process(self):
+        submitted = []
+        form = self.makeForm(submitted)
+        ctx = self.makeContext(json.dumps({'foo': 'x', 'when': '2000-01-02',
+            'group': {'bar': '1', 'tags': [1, '2']}}))
+        d = form.process(ctx)
+        def done(result):
+            self.failUnlessEqual(result, None)
+            self.failUnlessEqual(submitted, [{'foo': 'x',
+                'when': date(2000, 1, 2), 'group.bar': 1,
+                'group.tags': [1, 2]}])
+        return d.addCallback(done)
+
+    def test_dottedKeys(self):
+        submitted = []
+        form = self.makeForm(submitted)
+        ctx = self.makeContext(json.dumps({'foo': 'x', 'group.bar': 1}))
+        d = form.process(ctx)
+        d.addCallback(lambda _: self.failUnlessEqual(submitted[0]['group.bar'], 1))
+        return d
+
+    def test_errors(self):
+        form = self.makeForm([])
+        ctx = self.makeContext(json.dumps({'group': {'bar': 'x'}}))
+        behaviour = formal.form.FormsResourceBehaviour(parent=None)
+        d = defer.maybeDeferred(form.process, ctx)
+        d.addCallback(behaviour._formProcessed, ctx)
+        d.addCallback(lambda resource: resource.renderHTTP(ctx))
+        def rendered(body):
+            self.failUnlessEqual(inevow.IRequest(ctx).code, 400)
+            self.failUnlessEqual(json.loads(body), {'formErrors': [],
+                'errors': {'foo': 'Required', 'group.bar': 'Not a valid number'}})
+        return d.addCallback(rendered)
+
+    def test_valueTypes(self):
+        # Values that are not strings are checked like any other input.
+        def process(record):
+            form = formal.Form()
+            form.addField('n', formal.Integer())
+            form.addField('when', formal.Date())
+            form.addField('foo', formal.String(strip=True))
+            form.addAction(lambda ctx, form, data: None)
+            d = form.process(self.makeContext(json.dumps(record)))
+            return d.addCallback(lambda _: (form.data, form.errors))
+        def invalid(result, key, message):
+            data, errors = result
+            self.failUnlessEqual(errors.getFieldError(key).message, message)
+        def valid(result, key, value):
+            data, errors = result
+            self.failIf(errors)
+            self.failUnlessEqual(data[key], value)
+        return defer.gatherResults([
+            process({'n': 1.5}).addCallback(invalid, 'n', 'Not a valid number'),
+            process({'n': [1]}).addCallback(invalid, 'n', 'Invalid value'),
+            process({'n': {'a': 1}}).addCallback(invalid, 'n', 'Invalid value'),
+            process({'n': True}).addCallback(invalid, 'n', 'Not a valid number'),
+            process({'when': 20200101}).addCallback(invalid, 'when',
+                'Invalid date'),
+            process({'n': 2}).addCallback(valid, 'n', 2),
+            process({'foo': 5}).addCallback(valid, 'foo', '5'),
+            ])
+
+    def test_widgets(self):
+        # JSON input is held to the same rules as the widgets apply to a
+        # posted form.
+        def makeForm():
+            form = formal.Form()
+            form.addField('choice', formal.String(), formal.widgetFactory(
+                formal.SelectChoice, options=formal.OptionSet([('a', 'A')]),
+                noneOption=('none', 'Nothing')))
+            form.addField('pw', formal.String(), formal.CheckedPassword)
+            form.addField('id', formal.Integer(immutable=True))
+            form.addAction(lambda ctx, form, data: None)
+            form.data = {'id': 5}
+            return form
+        schema = formal.FormSchema(makeForm())
+        def process(record, form=None):
+            if form is None:
+                form = makeForm()
+            d = form.process(self.makeContext(json.dumps(record)))
+            return d.addCallback(lambda _: (form.data, form.errors))
+        def invalid(result, key, message):
+            data, errors = result
+            self.failUnlessEqual(errors.getFieldError(key).message, message)
+        def valid(result, expected):
+            data, errors = result
+            self.failIf(errors)
+            for key, value in expected.iteritems():
+                self.failUnlessEqual(data[key], value)
+        form = schema.makeForm()
+        form.data = {'id': 5}
+        self.failUnless(schema.recordValidator is form._recordValidator())
+        return defer.gatherResults([
+            process({'choice': 'zzz'}).addCallback(invalid, 'choice',
+                'Invalid choice'),
+            process({'choice': 'none', 'pw': ['x', 'x']}).addCallback(valid,
+                {'choice': None, 'pw': 'x'}),
+            process({'pw': 'x'}).addCallback(invalid, 'pw',
+                'Please enter the password twice for confirmation.'),
+            process({'pw': ['x', 'y']}).addCallback(invalid, 'pw',
+                'Passwords do not match.'),
+            process({'choice': 'a', 'id': 9}, form).addCallback(valid,
+                {'choice': 'a', 'id': 5}),
+            ])
+
+    def test_invalid(self):
+        form = self.makeForm([])
+        d = form.process(self.makeContext('[1, 2'))
+        def done(errors):
+            self.failUnless(errors is form.errors)
+            self.failUnlessEqual(len(errors.getFormLevelErrors()), 1)
+        return d.addCallback(done)
+
+
+def flattenForm(form, name='example'):
+    form.name = name
+    request = testutil.FakeRequest(uri='/', currentSegments=[''])
+    ctx = context.RequestContext(tag=request)
+    ctx.remember(None, inevow.IData)
+    ctx.remember(form, formal.iformal.IForm)
+    if form.errors:
+        ctx.remember(form.errors.data, formal.iformal.IFormData)
+    else:
+        ctx.remember(form.data, formal.iformal.IFormData)
+    return flat.flatten(inevow.IRenderer(form), ctx)
+
+
+class TestRendering(unittest.TestCase):
+
+    def makeForm(self):
+        form = formal.Form()
+        form.addField('foo', formal.String(required=True))
+        group = form.addGroup('grp')
+        group.addField('bar', formal.Integer())
+        form.addAction(lambda *a: None)
+        form.errors.data = {'foo': [''], 'grp.bar': ['x']}
+        form.errors.add(FieldRequiredError('Required', 'foo'))
+        form.errors.add(formal.FieldValidationError('Bad', 'grp.bar'))
+        form.errors.add(formal.FormError('Whole form bad'))
+        return form
+
+    def test_render(self):
+        self.assertEquals(flattenForm(self.makeForm()),
+            '<form accept-charset="utf-8" action="http://localhost/" '
+            'class="nevow-form" enctype="multipart/form-data" id="example" '
+            'method="post"><div><input name="_charset_" type="hidden" />'
+            '<input name="__nevow_form__" type="hidden" value="example" />'
+            '<div class="errors"><p>Please correct the following errors:</p>'
+            '<ul><li>Whole form bad</li><li><strong>Foo : </strong>Required'
+            '</li><li><strong>Bar : </strong>Bad</li></ul></div>'
+            '<div class="field string textinput required error" '
+            'id="example-foo-field"><label class="label" for="example-foo">'
+            'Foo</label><div class="inputs"><input id="example-foo" '
+            'name="foo" type="text" value="" /></div>'
+            '<div class="description"></div><div class="message">Required'
+            '</div></div><fieldset class="group" id="example-grp"><legend>'
+            'Grp</legend><div class="description"></div>'
+            '<div class="field integer textinput error" '
+            'id="example-grp-bar-field"><label class="label" '
+            'for="example-grp-bar">Bar</label><div class="inputs"><input '
+            'id="example-grp-bar" name="grp.bar" type="text" value="x" />'
+            '</div><div class="description"></div><div class="message">Bad'
+            '</div></div></fieldset><div class="actions"><input '
+            'id="example-action-submit" name="submit" type="submit" '
+            'value="Submit" /></div></div></form>')
+
+    def test_customLoader(self):
+        # A renderer with its own template is rendered through Nevow's slots,
+        # with the same result.
+        class Renderer(formal.form.FormRenderer):
+            loader = loaders.stan(formal.form.FormRenderer.loader.stan)
+        form = self.makeForm()
+        expected = flattenForm(form)
+        request = testutil.FakeRequest(uri='/', currentSegments=[''])
+        ctx = context.RequestContext(tag=request)
+        ctx.remember(None, inevow.IData)
+        ctx.remember(form, formal.iformal.IForm)
+        ctx.remember(form.errors.data, formal.iformal.IFormData)
+        self.assertEquals(flat.flatten(Renderer(form), ctx), expected)
+
+
+class TestFastRender(unittest.TestCase):
+
+    def makeForm(self, immutable=False, fastRender=False):
+        form = formal.Form()
+        form.fastRender = fastRender
+        form.addField('text', formal.String(immutable=immutable))
+        form.addField('password', formal.String(immutable=immutable),
+                formal.Password)
+        form.addField('textarea', formal.String(immutable=immutable),
+                formal.TextArea)
+        form.addField('hidden', formal.String(), formal.Hidden)
+        form.addField('checkbox', formal.Boolean(immutable=immutable))
+        form.addField('select', formal.String(immutable=immutable),
+                formal.widgetFactory(formal.SelectChoice,
+                    options=[('a', 'A'), ('b', u'\xe9<"&>')]))
+        form.addField('radio', formal.Integer(immutable=immutable),
+                formal.widgetFactory(formal.RadioChoice,
+                    options=[(1, 'One'), (2, u'T\xe9o')], noneOption=('', '-')))
+        form.addField('date', formal.Date(immutable=immutable),
+                formal.widgetFactory(formal.DatePartsInput, dayFirst=True))
+        group = form.addGroup('grp')
+        group.addField('bar', formal.Integer(immutable=immutable))
+        form.addAction(lambda *a: None)
+        form.data = {'text': u'v\xe4l"ue<&>\'', 'password': 'secret',
+                'textarea': 'a\n<b>&"', 'hidden': 'h"', 'checkbox': True,
+                'select': 'b', 'radio': 2, 'date': date(2020, 1, 2),
+                'grp.bar': 7}
+        return form
+
+    def addErrors(self, form):
+        form.errors.data = {'text': ['x"<'], 'textarea': ['t&'],
+                'hidden': ['z'], 'checkbox': ['True'], 'select': ['a'],
+                'radio': ['1'], 'date__year': ['20"'], 'date__month': ['1'],
+                'date__day': ['2'], 'grp.bar': ['q']}
+        form.errors.add(formal.FieldValidationError('Bad', 'text'))
+
+    def test_sameMarkup(self):
+        for immutable in (False, True):
+            for errors in (False, True):
+                forms = [self.makeForm(immutable, fastRender)
+                        for fastRender in (False, True)]
+                if errors:
+                    for form in forms:
+                        self.addErrors(form)
+                self.assertEquals(*[flattenForm(form) for form in forms])
+
+    def test_renderString(self):
+        calls = []
+        class Widget(formal.TextInput):
+            def renderString(self, *a):
+                calls.append(a[1])
+                return formal.TextInput.renderString(self, *a)
+        form = self.makeForm(fastRender=True)
+        form.getItemByName('text').widgetFactory = Widget
+        flattenForm(form)
+        self.assertEquals(calls, ['text'])
+
+    def test_fallback(self):
+        # A subclass that changes how the widget renders, or options that only
+        # Nevow can resolve, are rendered to stan.
+        class Widget(formal.TextInput):
+            def render(self, ctx, key, args, errors):
+                return 'custom'
+        form = self.makeForm(fastRender=True)
+        form.getItemByName('text').widgetFactory = Widget
+        select = form.getItemByName('select')
+        select.widgetFactory = formal.widgetFactory(formal.SelectChoice,
+                options=lambda ctx, data: [('a', 'A'), ('b', 'B')])
+        html = flattenForm(form)
+        self.assertIn('<div class="inputs">custom</div>', html)
+        self.assertIn('<option selected="selected" value="b">B</option>', html)
+
+    def test_schema(self):
+        form = self.makeForm(fastRender=True)
+        self.assertEquals(formal.FormSchema(form).makeForm().fastRender, True)
@@ -11,3 +11,42 @@ class TestFormErrors(unittest.TestCase):
         self.failIf(not e)
         self.failUnless(not not e)
 
+
+    def test_fieldError(self):
+        e = form.FormErrors()
+        self.failUnlessEqual(e.getFieldError('foo'), None)
+        first = validation.FieldRequiredError('required', 'foo')
+        second = validation.FieldValidationError('invalid', 'foo')
+        e.add(first)
+        e.add(second)
+        e.add(validation.FieldValidationError('invalid', 'bar'))
+        self.failUnless(e.getFieldError('foo') is first)
+        self.failUnlessEqual(e.getFieldError('baz'), None)
+        self.failUnlessEqual(len(e.getFormErrors()), 3)
+        self.failUnlessEqual(e.getFieldErrors(), e.getFormErrors())
+        self.failUnlessEqual(e.getFormLevelErrors(), [])
+
+    def test_formLevelErrors(self):
+        e = form.FormErrors()
+        formError = validation.FormError('failed')
+        e.add(validation.FieldValidationError('invalid', 'foo'))
+        e.add(formError)
+        self.failUnlessEqual(e.getFormLevelErrors(), [formError])
+        self.failUnlessEqual(len(e.getFieldErrors()), 1)
+        self.failUnlessEqual(len(e.getFormErrors()), 2)
+        self.failUnless(e.hasErrors())
+
+    def test_groupCounts(self):
+        e = form.FormErrors()
+        self.failIf(e.hasErrors())
+        e.add(validation.FieldValidationError('invalid', 'group.inner.foo'))
+        e.add(validation.FieldValidationError('invalid', 'group.bar'))
+        e.add(validation.FieldValidationError('invalid', 'other'))
+        self.failUnlessEqual(e.getErrorCount('group'), 2)
+        self.failUnlessEqual(e.getErrorCount('group.inner'), 1)
+        self.failUnlessEqual(e.getErrorCount('group.inner.foo'), 1)
+        self.failUnlessEqual(e.getErrorCount('group.baz'), 0)
+        self.failUnless(e.hasErrors('group.inner'))
+        self.failIf(e.hasErrors('group.baz'))
+        # Only complete key parts are counted.
+        self.failIf(e.hasErrors('gro'))
@@ -0,0 +1,268 @@
+from datetime import date
+from twisted.internet import defer
+from twisted.trial import unittest
+from nevow import context, tags as T, testutil
+from zope.interface import implements
+import formal
+from formal import iformal, options, validation
+from formal.test.test_form import flattenForm
+
+
+class Option(object):
+    implements(iformal.IKey, iformal.ILabel)
+
+    calls = 0
+
+    def __init__(self, key, label):
+        self._key = key
+        self._label = label
+
+    def key(self):
+        Option.calls += 1
+        return self._key
+
+    def label(self):
+        Option.calls += 1
+        return self._label
+
+
+OPTIONS = [(1, 'One'), (2, u'T\xe9o <&>'), (3, 'Three"'), (2, 'Again')]
+
+
+def makeForm(options, fastRender=False, immutable=False, noneOption=None):
+    form = formal.Form()
+    form.fastRender = fastRender
+    for name, widget in [('select', formal.SelectChoice),
+            ('radio', formal.RadioChoice)]:
+        if noneOption is None:
+            widgetFactory = formal.widgetFactory(widget, options=options)
+        else:
+            widgetFactory = formal.widgetFactory(widget, options=options,
+                    noneOption=noneOption)
+        form.addField(name, formal.Integer(immutable=immutable), widgetFactory)
+    form.addField('date', formal.Date(), formal.widgetFactory(
+        formal.SelectChoice, options=formal.OptionSet([
+            (date(2020, 1, 1), 'New year'), (date(2020, 12, 25), 'Xmas')])))
+    form.data = {'select': 2, 'radio': 3, 'date': date(2020, 12, 25)}
+    return form
+
+
+def processInput(widget, value):
+    request = testutil.FakeRequest(args={'foo': [value]})
+    ctx = context.RequestContext(tag=request)
+    return widget.processInput(ctx, 'foo', {'foo': [value]})
+
+
+class TestOptionSet(unittest.TestCase):
+
+    def test_sameMarkup(self):
+        optionSet = formal.OptionSet(OPTIONS)
+        for fastRender in (False, True):
+            for immutable in (False, True):
+                for noneOption in (None, ('', 'Nothing'), ('0', 'Zero')):
+                    expected = flattenForm(makeForm(OPTIONS, False, immutable,
+                        noneOption))
+                    form = makeForm(optionSet, fastRender, immutable,
+                            noneOption)
+                    self.assertEquals(flattenForm(form), expected)
+                    form.errors.data = {'select': ['3'], 'radio': ['x']}
+                    form.errors.add(formal.FieldValidationError('Bad',
+                        'select'))
+                    expected = makeForm(OPTIONS, False, immutable, noneOption)
+                    expected.errors = form.errors
+                    self.assertEquals(flattenForm(form), flattenForm(expected))
+
+    def test_adaptedOnce(self):
+        optionSet = formal.OptionSet([Option(i, str(i)) for i in range(10)])
+        calls = Option.calls
+        for fastRender in (False, True):
+            flattenForm(makeForm(optionSet, fastRender))
+            self.assertEquals(Option.calls, calls)
+
+    def test_convertedOnce(self):
+        optionSet = formal.OptionSet(OPTIONS)
+        converter = iformal.IStringConvertible(formal.Integer())
+        converted = optionSet.converted(converter)
+        self.assertIdentical(optionSet.converted(
+            iformal.IStringConvertible(formal.Integer())), converted)
+        self.assertEquals(converted.values, ['1', '2', '3', '2'])
+        self.assertEquals(converted.selected('2'), [1, 3])
+
+    def test_translatedLabels(self):
+        options = [(1, T.em['One']), (2, 'Two')]
+        expected = flattenForm(makeForm(options))
+        self.assertEquals(flattenForm(makeForm(formal.OptionSet(options),
+            True)), expected)
+
+    def test_processInput(self):
+        widget = formal.SelectChoice(formal.Integer(),
+                options=formal.OptionSet(OPTIONS))
+        self.assertEquals(processInput(widget, '3'), 3)
+        self.assertEquals(processInput(widget, ''), None)
+        self.assertRaises(validation.FieldValidationError, processInput,
+                widget, '4')
+        widget = formal.RadioChoice(formal.String(),
+                options=formal.OptionSet([('a', 'A'), ('\xc3\xa9', 'E')]))
+        self.assertEquals(processInput(widget, '\xc3\xa9'), u'\xe9')
+        self.assertRaises(validation.FieldValidationError, processInput,
+                widget, 'b')
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class Loader(object):
+
+    def __init__(self, options=OPTIONS):
+        self.options = options
+        self.calls = []
+
+    def __call__(self):
+        self.calls.append(None)
+        return self.options
+
+
+class DeferredLoader(object):
+
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self):
+        d = defer.Deferred()
+        self.calls.append(d)
+        return d
+
+
+class TestOptionSource(unittest.TestCase):
+
+    def tearDown(self):
+        options._optionSources.pop('test', None)
+
+    def test_shared(self):
+        loader = Loader()
+        source = formal.OptionSource('test', loader)
+        expected = flattenForm(makeForm(OPTIONS))
+        for fastRender in (False, True):
+            self.assertEquals(flattenForm(makeForm(source, fastRender)),
+                    expected)
+        self.assertEquals(len(loader.calls), 1)
+        self.assertIdentical(source.getOptions(), source.getOptions())
+
+    def test_ttl(self):
+        clock = Clock()
+        loader = Loader()
+        source = formal.OptionSource('test', loader, ttl=60, clock=clock)
+        first = source.getOptions()
+        clock.now = 59
+        self.assertIdentical(source.getOptions(), first)
+        clock.now = 60
+        self.assertNotIdentical(source.getOptions(), first)
+        self.assertEquals(len(loader.calls), 2)
+
+    def test_version(self):
+        versions = [1]
+        loader = Loader()
+        source = formal.OptionSource('test', loader,
+                version=lambda: versions[0])
+        first = source.getOptions()
+        self.assertIdentical(source.getOptions(), first)
+        versions[0] = 2
+        self.assertNotIdentical(source.getOptions(), first)
+        self.assertEquals(len(loader.calls), 2)
+
+    def test_registry(self):
+        loader = Loader()
+        source = formal.registerOptionSource('test', loader)
+        self.assertIdentical(formal.optionSource('test'), source)
+        self.assertRaises(KeyError, formal.optionSource, 'other')
+        generation = source.stamp()
+        source.getOptions()
+        formal.invalidateOptionSource('test')
+        self.assertEquals(source.current(), None)
+        self.assertEquals(source.stamp(), generation + 2)
+        source.getOptions()
+        self.assertEquals(len(loader.calls), 2)
+
+    def test_deferred(self):
+        loader = DeferredLoader()
+        source = formal.OptionSource('test', loader)
+        first = source.getOptions()
+        second = source.getOptions()
+        self.assertEquals(len(loader.calls), 1)
+        loader.calls[0].callback(OPTIONS)
+        results = []
+        first.addCallback(results.append)
+        second.addCallback(results.append)
+        self.assertEquals(len(results), 2)
+        self.assertIdentical(results[0], results[1])
+        self.assertIdentical(source.getOptions(), results[0])
+
+    def test_deferredFailure(self):
+        loader = DeferredLoader()
+        source = formal.OptionSource('test', loader)
+        first = source.getOptions()
+        second = source.getOptions()
+        loader.calls[0].errback(RuntimeError('down'))
+        d = defer.gatherResults([self.assertFailure(first, RuntimeError),
+            self.assertFailure(second, RuntimeError)])
+        def failed(_):
+            self.assertEquals(source.current(), None)
+            source.getOptions()
+            self.assertEquals(len(loader.calls), 2)
+        return d.addCallback(failed)
+
+    def test_invalidatedWhileLoading(self):
+        loader = DeferredLoader()
+        source = formal.OptionSource('test', loader)
+        d = source.getOptions()
+        source.invalidate()
+        loader.calls[0].callback(OPTIONS)
+        self.assertEquals(source.current(), None)
+        return d.addCallback(self.assertIsInstance, formal.OptionSet)
+
+    def test_processInput(self):
+        loader = DeferredLoader()
+        widget = formal.SelectChoice(formal.Integer(),
+                options=formal.OptionSource('test', loader))
+        valid = processInput(widget, '3')
+        invalid = processInput(widget, '4')
+        self.assertEquals(processInput(widget, ''), None)
+        loader.calls[0].callback(OPTIONS)
+        valid.addCallback(self.assertEquals, 3)
+        return defer.gatherResults([valid, self.assertFailure(invalid,
+            validation.FieldValidationError)])
+
+    def test_multiChoice(self):
+        source = formal.OptionSource('test', Loader())
+        for widget, type in [
+                (formal.CheckboxMultiChoice, formal.Sequence(formal.Integer())),
+                (formal.MultiselectChoice, formal.Integer())]:
+            html = []
+            for options in (OPTIONS, source):
+                form = formal.Form()
+                form.addField('multi', type,
+                        formal.widgetFactory(widget, options=options))
+                form.data = {'multi': [2, 3]}
+                html.append(flattenForm(form))
+            self.assertEquals(html[0], html[1])
+
+    def test_renderCache(self):
+        source = formal.OptionSource('test', Loader())
+        cache = formal.RenderCache()
+        form = formal.Form()
+        form.renderCache = cache
+        form.addField('select', formal.Integer(), formal.widgetFactory(
+            formal.SelectChoice, options=source))
+        schema = formal.FormSchema(form)
+        for i in range(3):
+            flattenForm(schema.makeForm())
+        self.assertEquals((cache.hits, cache.misses), (1, 2))
+        source.invalidate()
+        flattenForm(schema.makeForm())
+        self.assertEquals(cache.misses, 3)
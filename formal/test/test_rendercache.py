@@ -0,0 +1,196 @@
+import gc
+from twisted.internet import defer
+from twisted.trial import unittest
+from zope.interface import implements
+from nevow import context, flat, inevow, testutil, tags as T
+from nevow.flat import twist
+import formal
+from formal import iformal
+from formal.test.test_options import DeferredLoader
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def makeSchema(cache, widgetFactory=None, type=formal.Integer):
+    form = formal.Form()
+    form.renderCache = cache
+    form.addField('name', formal.String())
+    form.addField('count', type(), widgetFactory)
+    return formal.FormSchema(form)
+
+
+def render(form, uri='/', languages=None):
+    form.name = 'example'
+    request = testutil.FakeRequest(uri=uri, currentSegments=[uri[1:]])
+    if languages is not None:
+        request.received_headers['accept-language'] = languages
+    ctx = context.RequestContext(tag=request)
+    ctx.remember(None, inevow.IData)
+    ctx.remember(form, iformal.IForm)
+    if form.errors:
+        ctx.remember(form.errors.data, iformal.IFormData)
+    else:
+        ctx.remember(form.data, iformal.IFormData)
+    return flat.flatten(inevow.IRenderer(form), ctx)
+
+
+def makeForm(schema, **data):
+    form = schema.makeForm()
+    form.addAction(lambda *a: None)
+    form.data = data
+    return form
+
+
+class TestRenderCache(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.cache = formal.RenderCache(ttl=60, clock=self.clock)
+        self.schema = makeSchema(self.cache)
+
+    def test_hit(self):
+        first = render(makeForm(self.schema, name='a', count=1))
+        self.assertEquals(render(makeForm(self.schema, name='a', count=1)),
+                first)
+        self.assertEquals((self.cache.hits, self.cache.misses), (1, 1))
+        self.assertIn('value="a"', first)
+
+    def test_key(self):
+        render(makeForm(self.schema, name='a', count=1))
+        # Different data, or the same data of a different type.
+        html = render(makeForm(self.schema, name='b', count=1))
+        self.assertIn('value="b"', html)
+        html = render(makeForm(self.schema, name='a', count=True))
+        self.assertIn('value="True"', html)
+        # Different page or languages.
+        html = render(makeForm(self.schema, name='a', count=1), uri='/x')
+        self.assertIn('action="http://localhost/x"', html)
+        render(makeForm(self.schema, name='a', count=1), languages='fr')
+        # Different actions.
+        form = makeForm(self.schema, name='a', count=1)
+        form.addAction(lambda *a: None, 'other')
+        self.assertIn('name="other"', render(form))
+        self.assertEquals((self.cache.hits, self.cache.misses), (0, 6))
+
+    def test_errors(self):
+        form = makeForm(self.schema, name='a', count=1)
+        form.errors.data = {'name': ['x'], 'count': ['y']}
+        form.errors.add(formal.FieldValidationError('Bad', 'count'))
+        render(form)
+        render(form)
+        self.assertEquals(len(self.cache.cache), 0)
+
+    def test_ttl(self):
+        render(makeForm(self.schema, name='a'))
+        self.clock.now = 61
+        render(makeForm(self.schema, name='a'))
+        self.assertEquals((self.cache.hits, self.cache.misses), (0, 2))
+
+    def test_invalidate(self):
+        other = makeSchema(self.cache)
+        render(makeForm(self.schema, name='a'))
+        render(makeForm(other, name='a'))
+        self.cache.invalidate(self.schema)
+        render(makeForm(self.schema, name='a'))
+        render(makeForm(other, name='a'))
+        self.assertEquals((self.cache.hits, self.cache.misses), (1, 3))
+        self.cache.clear()
+        render(makeForm(other, name='a'))
+        self.assertEquals(self.cache.misses, 4)
+
+    def test_forgetSchemas(self):
+        # The cache does not keep schemas that are otherwise gone.
+        schema = makeSchema(self.cache)
+        self.cache.invalidate(schema)
+        render(makeForm(schema, name='a'))
+        self.cache.clear()
+        del schema
+        gc.collect()
+        self.assertEquals((len(self.cache.versions),
+            len(self.cache.cacheableSchemas)), (0, 0))
+
+    def test_uncacheable(self):
+        # Plain forms, and widgets that change from one render to the next,
+        # are rendered every time.
+        form = formal.Form()
+        form.renderCache = self.cache
+        form.addField('name', formal.String())
+        render(form)
+        render(makeForm(makeSchema(self.cache, formal.FileUploadRaw,
+            formal.File)))
+        render(makeForm(makeSchema(self.cache, formal.widgetFactory(
+            formal.SelectChoice, options=lambda ctx, data: [(1, 'One')])),
+            count=1))
+        self.assertEquals(len(self.cache.cache), 0)
+
+    def test_optIn(self):
+        # Widgets, and subclasses that change how they render, have to say
+        # that they can be cached.
+        class Widget(object):
+            implements(iformal.IWidget)
+            def __init__(self, original):
+                self.original = original
+            def render(self, ctx, key, args, errors):
+                return T.input(name=key)
+            renderImmutable = render
+        class Subclass(formal.TextInput):
+            def render(self, ctx, key, args, errors):
+                return T.input(name=key)
+        for widget in (Widget, Subclass):
+            render(makeForm(makeSchema(self.cache, widget), count=1))
+        self.assertEquals(len(self.cache.cache), 0)
+        class Cacheable(Subclass):
+            cacheable = True
+        render(makeForm(makeSchema(self.cache, Cacheable), count=1))
+        self.assertEquals(len(self.cache.cache), 1)
+
+    def test_deferred(self):
+        class Widget(formal.TextInput):
+            cacheable = True
+            def render(self, ctx, key, args, errors):
+                return defer.succeed(T.input(name=key))
+        schema = makeSchema(self.cache, Widget)
+        request = testutil.FakeRequest(uri='/', currentSegments=[''])
+        ctx = context.RequestContext(tag=request)
+        ctx.remember(None, inevow.IData)
+        form = makeForm(schema, count=1)
+        form.name = 'example'
+        ctx.remember(form, iformal.IForm)
+        ctx.remember(form.data, iformal.IFormData)
+        result = inevow.IRenderer(form).rend(ctx, None)
+        self.assertEquals(isinstance(result, T.xml), False)
+        self.assertEquals(len(self.cache.cache), 0)
+
+    def test_deferredOptions(self):
+        # Every field is rendered when the options have still to load.
+        loader = DeferredLoader()
+        form = formal.Form()
+        form.renderCache = self.cache
+        form.addField('first', formal.String())
+        form.addField('select', formal.Integer(), formal.widgetFactory(
+            formal.SelectChoice, options=formal.OptionSource('test', loader)))
+        form.addField('last', formal.String())
+        form = makeForm(formal.FormSchema(form), first='a', select=2)
+        form.name = 'example'
+        request = testutil.FakeRequest(uri='/', currentSegments=[''])
+        ctx = context.RequestContext(tag=request)
+        ctx.remember(None, inevow.IData)
+        ctx.remember(form, iformal.IForm)
+        ctx.remember(form.data, iformal.IFormData)
+        written = []
+        d = twist.deferflatten(inevow.IRenderer(form), ctx, written.append)
+        loader.calls[0].callback([(1, 'One'), (2, 'Two')])
+        def flattened(_):
+            html = ''.join(written)
+            for name in ('first', 'select', 'last'):
+                self.assertIn('name="%s"' % (name,), html)
+            self.assertIn('<option selected="selected" value="2">', html)
+            self.assertEquals(len(self.cache.cache), 0)
+        return d.addCallback(flattened)
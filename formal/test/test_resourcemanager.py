@@ -0,0 +1,500 @@
+import cgi
+import os
+import shutil
+import tempfile
+from StringIO import StringIO
+import time
+from twisted.internet import defer
+from twisted.python import threadable, threadpool
+from twisted.trial import unittest
+from nevow import appserver, context, testutil
+import formal
+from formal import iformal, resourcemanager, upload
+from formal.util import json
+from formal.resourcemanager import ResourceManager
+
+
+class StorageTests(object):
+    """
+    Tests that every storage must pass.
+    """
+
+    def makeStorage(self):
+        raise NotImplementedError()
+
+    def setUp(self):
+        self.storage = self.makeStorage()
+
+    def test_storeAndOpen(self):
+        resourceId = self.storage.store(StringIO('data'), u'caf\xe9.txt')
+        self.assertEquals(resourcemanager.fileNameFromResourceId(resourceId),
+                u'caf\xe9.txt')
+        f = self.storage.open(resourceId)
+        self.assertEquals(f.read(), 'data')
+        f.close()
+
+    def test_remove(self):
+        resourceId = self.storage.store(StringIO('data'), u'foo.txt')
+        self.storage.remove(resourceId)
+        self.assertEquals(self.storage.open(resourceId), None)
+        # Removing twice is harmless.
+        self.storage.remove(resourceId)
+
+    def test_listResources(self):
+        resourceId = self.storage.store(StringIO('data'), u'foo.txt')
+        resources = dict([(r[0], r) for r in self.storage.listResources()])
+        self.assertEquals(resources[resourceId][1], 4)
+        self.storage.remove(resourceId)
+        resources = dict([(r[0], r) for r in self.storage.listResources()])
+        self.failIf(resourceId in resources)
+
+    def test_resourceManager(self):
+        rm = ResourceManager(self.storage)
+        rm.setResource('file', StringIO('one'), u'foo.png')
+        rm.setResource('file', StringIO('two'), u'foo.png')
+        mimetype, filelike, fileName = rm.getResourceForWidget('file')
+        self.assertEquals((mimetype, filelike.read(), fileName),
+                ('image/png', 'two', u'foo.png'))
+        filelike.close()
+        rm.clearUpResources()
+        self.assertEquals(rm.getResourceForWidget('file'), None)
+
+    def test_deferredResourceManager(self):
+        rm = ResourceManager(self.storage)
+        d = rm.deferSetResource('file', StringIO('data'), u'foo.png')
+        d.addCallback(lambda _: rm.deferGetResourceForWidget('file'))
+        def opened((mimetype, filelike, fileName)):
+            self.assertEquals((mimetype, filelike.read(), fileName),
+                    ('image/png', 'data', u'foo.png'))
+            filelike.close()
+            return rm.deferClearUpResources()
+        d.addCallback(opened)
+        d.addCallback(lambda _: rm.deferGetResourceForWidget('file'))
+        return d.addCallback(self.assertEquals, None)
+
+
+class TestTempDirectoryStorage(StorageTests, unittest.TestCase):
+
+    def makeStorage(self):
+        return resourcemanager.TempDirectoryStorage()
+
+    def test_path(self):
+        resourceId = self.storage.store(StringIO('data'), u'foo.txt')
+        path = self.storage.getPath(resourceId)
+        self.assertEquals(os.path.dirname(path), tempfile.gettempdir())
+        self.storage.remove(resourceId)
+
+    def test_invalidId(self):
+        self.assertEquals(self.storage.getPath('../etc/passwd__Zm9v'), None)
+        self.assertEquals(self.storage.open('../etc/passwd__Zm9v'), None)
+
+
+class TestDirectoryStorage(StorageTests, unittest.TestCase):
+
+    def makeStorage(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        return resourcemanager.DirectoryStorage(self.directory)
+
+    def test_fanOut(self):
+        resourceId = self.storage.store(StringIO('data'), u'foo.txt')
+        path = self.storage.getPath(resourceId)
+        self.assertEquals(path, os.path.join(self.directory, resourceId[:2],
+            resourceId[2:4], resourceId))
+        self.failUnless(os.path.exists(path))
+
+
+    def test_sharedContent(self):
+        one = self.storage.store(StringIO('same'), u'one.txt')
+        two = self.storage.store(StringIO('same'), u'two.txt')
+        self.assertNotEquals(one, two)
+        self.assertEquals(os.stat(self.storage.getPath(one)).st_ino,
+                os.stat(self.storage.getPath(two)).st_ino)
+        # Removing one leaves the other intact.
+        self.storage.remove(one)
+        self.assertEquals(self.storage.open(two).read(), 'same')
+
+    def test_originalLinked(self):
+        original = os.path.join(self.directory, 'original')
+        f = open(original, 'wb')
+        f.write('original')
+        f.close()
+        one = self.storage.store(open(original, 'rb'), u'one.txt')
+        # Storing the same file again does not read it.
+        class Unreadable(object):
+            name = original
+            def fileno(self):
+                return f.fileno()
+        f = open(original, 'rb')
+        two = self.storage.store(Unreadable(), u'two.txt')
+        self.assertEquals(self.storage.open(two).read(), 'original')
+        self.assertEquals(os.stat(self.storage.getPath(one)).st_ino,
+                os.stat(self.storage.getPath(two)).st_ino)
+
+
+class TestMemoryStorage(StorageTests, unittest.TestCase):
+
+    def makeStorage(self):
+        return resourcemanager.MemoryStorage(maxBytes=10, maxFileSize=5)
+
+    def test_inMemory(self):
+        resourceId = self.storage.store(StringIO('data'), u'foo.txt')
+        self.assertEquals(self.storage.getPath(resourceId), None)
+        self.assertEquals(self.storage.size, 4)
+
+    def test_fallback(self):
+        resourceId = self.storage.store(StringIO('too large'), u'foo.txt')
+        self.assertEquals(self.storage.size, 0)
+        path = self.storage.getPath(resourceId)
+        self.failUnless(os.path.exists(path))
+        self.assertEquals(self.storage.open(resourceId).read(), 'too large')
+        self.storage.remove(resourceId)
+        self.failIf(os.path.exists(path))
+
+    def test_sharedContent(self):
+        one = self.storage.store(StringIO('same'), u'one.txt')
+        two = self.storage.store(StringIO('same'), u'two.txt')
+        self.failUnless(self.storage._resources[one][0] is
+                self.storage._resources[two][0])
+
+    def test_lru(self):
+        one = self.storage.store(StringIO('1111'), u'1')
+        two = self.storage.store(StringIO('2222'), u'2')
+        self.storage.open(one).read()
+        three = self.storage.store(StringIO('3333'), u'3')
+        self.assertEquals(self.storage.open(two), None)
+        self.assertEquals(self.storage.open(one).read(), '1111')
+        self.assertEquals(self.storage.size, 8)
+
+
+class TestResourceManager(unittest.TestCase):
+
+    def test_sameOriginal(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        original = os.path.join(directory, 'original')
+        f = open(original, 'wb')
+        f.write('original')
+        f.close()
+        rm = ResourceManager(resourcemanager.DirectoryStorage(directory))
+        f = open(original, 'rb')
+        resourceId = rm.setResource('file', f, u'original.txt')
+        self.assertEquals(rm.setResource('file', f, u'original.txt'),
+                resourceId)
+        self.assertNotEquals(rm.setResource('file', StringIO('new'),
+            u'original.txt'), resourceId)
+
+    def test_statContentKey(self):
+        # Only files known by their path are keyed by their stat.
+        fd, path = tempfile.mkstemp()
+        self.addCleanup(os.remove, path)
+        unnamed = os.fdopen(fd, 'w+b')
+        self.addCleanup(unnamed.close)
+        self.assertEquals(unnamed.name, '<fdopen>')
+        self.assertEquals(resourcemanager.statContentKey(unnamed), None)
+        temporary = tempfile.TemporaryFile()
+        self.addCleanup(temporary.close)
+        self.assertEquals(resourcemanager.statContentKey(temporary), None)
+        named = open(path, 'rb')
+        self.addCleanup(named.close)
+        self.assertEquals(resourcemanager.statContentKey(named)[0], 'stat')
+        spooled = upload.SpoolFile(path, 'rb')
+        self.addCleanup(spooled.close)
+        self.assertEquals(resourcemanager.statContentKey(spooled)[0], 'stat')
+
+    def test_threadPool(self):
+        # Storage operations of the deferred methods run off the reactor
+        # thread, on the resource manager's pool.
+        threads = []
+        class Storage(resourcemanager.MemoryStorage):
+            def store(self, filelike, fileName):
+                threads.append(threadable.isInIOThread())
+                return resourcemanager.MemoryStorage.store(self, filelike,
+                        fileName)
+        pool = threadpool.ThreadPool(0, 1)
+        pool.start()
+        self.addCleanup(pool.stop)
+        rm = ResourceManager(Storage(), threadPool=pool)
+        d = rm.deferSetResource('file', StringIO('data'), u'foo.txt')
+        def stored(resourceId):
+            self.assertEquals(threads, [False])
+            self.assertEquals(rm.getResourceId('file'), resourceId)
+        return d.addCallback(stored)
+
+    def test_sharedThreadPool(self):
+        pool = resourcemanager.getThreadPool()
+        self.assertIdentical(resourcemanager.getThreadPool(), pool)
+        self.assertEquals(pool.max, resourcemanager.threadPoolSize)
+
+    def test_rejectedUpload(self):
+        # A file the type does not allow is never stored.
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        storage = resourcemanager.MemoryStorage(
+                fallback=resourcemanager.DirectoryStorage(directory))
+        form = formal.Form()
+        form.resourceManager = ResourceManager(storage)
+        form.addField('file', formal.File(maxBytes=3), formal.FileUploadWidget)
+        form.addAction(lambda *a: None)
+        fileitem = cgi.FieldStorage()
+        fileitem.filename = 'foo.txt'
+        fileitem.file = StringIO('data')
+        request = testutil.FakeRequest(args={'file': ['']})
+        request.fields = {'file': fileitem}
+        ctx = context.RequestContext(tag=request)
+        ctx.remember(form, iformal.IForm)
+        d = form.process(ctx)
+        def processed(errors):
+            self.failUnless(errors.getFieldError('file'))
+            self.assertEquals(list(storage.listResources()), [])
+        return d.addCallback(processed)
+
+    def test_unknownResource(self):
+        # A missing, or since removed, resource is not found.
+        form = formal.Form()
+        form.resourceManager = ResourceManager(
+                resourcemanager.MemoryStorage())
+        form.addField('file', formal.File(), formal.FileUploadWidget)
+        widget = form.getItemByName('file').makeWidget()
+        ctx = context.RequestContext(tag=testutil.FakeRequest())
+        ctx.remember(form, iformal.IForm)
+        resourceId = 'x__' + resourcemanager.encodeFileName(u'foo.txt')
+        d = widget.getResource(ctx, 'file',
+                [widget.FROM_RESOURCE_MANAGER, resourceId])
+        return d.addCallback(self.assertIdentical, appserver.NotFound)
+
+
+class TestSQLiteStorage(StorageTests, unittest.TestCase):
+
+    if resourcemanager.sqlite3 is None:
+        skip = 'sqlite3 is not available'
+
+    def makeStorage(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        return resourcemanager.SQLiteStorage(path)
+
+
+class Clock(object):
+
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class TestResourceJanitor(unittest.TestCase):
+
+    def setUp(self):
+        # Keep the fallback away from other tests' resources.
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.fallback = resourcemanager.DirectoryStorage(directory)
+        self.storage = resourcemanager.MemoryStorage(fallback=self.fallback)
+        self.clock = Clock(time.time())
+
+    def test_maxAge(self):
+        resourceId = self.storage.store(StringIO('data'), u'foo.txt')
+        janitor = resourcemanager.ResourceJanitor(self.storage, maxAge=60,
+                clock=self.clock)
+        janitor.sweep()
+        self.assertEquals((janitor.resourcesHeld, janitor.bytesHeld), (1, 4))
+        self.clock.now += 61
+        janitor.sweep()
+        self.assertEquals(self.storage.open(resourceId), None)
+        self.assertEquals((janitor.resourcesHeld, janitor.bytesHeld), (0, 0))
+        self.assertEquals((janitor.resourcesReaped, janitor.bytesReaped), (1, 4))
+
+    def test_maxBytes(self):
+        ids = [self.storage.store(StringIO('data'), u'foo.txt')
+                for i in range(3)]
+        # Make the first the oldest.
+        data, stored = self.storage._resources[ids[0]]
+        self.storage._resources[ids[0]] = (data, stored - 10)
+        janitor = resourcemanager.ResourceJanitor(self.storage, maxAge=None,
+                maxBytes=8, clock=self.clock)
+        janitor.sweep()
+        self.assertEquals(self.storage.open(ids[0]), None)
+        self.assertEquals(self.storage.open(ids[1]).read(), 'data')
+        self.assertEquals((janitor.resourcesHeld, janitor.bytesHeld), (2, 8))
+
+    def makePool(self):
+        pool = threadpool.ThreadPool(0, 1)
+        pool.start()
+        self.addCleanup(pool.stop)
+        return pool
+
+    def test_service(self):
+        resourceId = self.storage.store(StringIO('data'), u'foo.txt')
+        self.clock.now += 120
+        janitor = resourcemanager.ResourceJanitor(self.storage, maxAge=60,
+                clock=self.clock, threadPool=self.makePool())
+        # The first sweep is made as the service starts.
+        janitor.startService()
+        self.addCleanup(janitor.stopService)
+        d = janitor.deferSweep()
+        d.addCallback(lambda _: self.assertEquals(janitor.resourcesReaped, 1))
+        return d
+
+    def test_deferSweep(self):
+        # Sweeps run off the reactor thread, one at a time.
+        threads = []
+        class Storage(resourcemanager.MemoryStorage):
+            def listResources(self):
+                threads.append(threadable.isInIOThread())
+                return resourcemanager.MemoryStorage.listResources(self)
+        storage = Storage(fallback=self.fallback)
+        storage.store(StringIO('data'), u'foo.txt')
+        janitor = resourcemanager.ResourceJanitor(storage, maxAge=60,
+                clock=Clock(time.time() + 120), threadPool=self.makePool())
+        d = defer.gatherResults([janitor.deferSweep(), janitor.deferSweep()])
+        def swept(_):
+            self.assertEquals(threads, [False])
+            self.assertEquals((janitor.resourcesReaped, janitor.bytesReaped),
+                    (1, 4))
+            self.assertEquals(janitor.resourcesHeld, 0)
+        return d.addCallback(swept)
+
+    def test_leakyForms(self):
+        # A form that fails validation, and is abandoned, leaves its upload
+        # behind until the janitor removes it.
+        form = formal.Form()
+        form.resourceManager = ResourceManager(self.storage)
+        form.addField('name', formal.String(required=True))
+        form.addField('file', formal.File(), formal.FileUploadWidget)
+        form.addAction(lambda *a: None)
+        fileitem = cgi.FieldStorage()
+        fileitem.filename = 'foo.txt'
+        fileitem.file = StringIO('data')
+        request = testutil.FakeRequest(args={'name': [''], 'file': ['']})
+        request.fields = {'file': fileitem}
+        ctx = context.RequestContext(tag=request)
+        ctx.remember(form, iformal.IForm)
+        d = form.process(ctx)
+        def processed(errors):
+            self.failUnless(errors.getFieldError('name'))
+            resourceId = form.resourceManager.getResourceId('file')
+            self.assertEquals(self.storage.open(resourceId).read(), 'data')
+            self.clock.now += 25 * 60 * 60
+            resourcemanager.ResourceJanitor(self.storage,
+                    clock=self.clock).sweep()
+            self.assertEquals(self.storage.open(resourceId), None)
+        return d.addCallback(processed)
+
+
+class TestChunkedUploads(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.uploads = resourcemanager.ChunkedUploads(
+                os.path.join(directory, 'uploads'))
+        self.storage = resourcemanager.DirectoryStorage(
+                os.path.join(directory, 'resources'))
+        self.rm = ResourceManager(self.storage, uploads=self.uploads)
+
+    def test_upload(self):
+        uploadId = self.rm.beginUpload(u'foo.txt')
+        self.assertEquals(self.rm.appendUpload(uploadId, 0, 'abc'), 3)
+        self.assertEquals(self.rm.appendUpload(uploadId, 3, 'def'), 6)
+        # A repeated chunk is refused, with the offset to resume from.
+        e = self.assertRaises(resourcemanager.UploadOffsetError,
+                self.rm.appendUpload, uploadId, 3, 'def')
+        self.assertEquals(e.offset, 6)
+        self.assertEquals(self.rm.getUploadOffset(uploadId), 6)
+        resourceId = self.rm.completeUpload(uploadId)
+        self.assertEquals(resourcemanager.fileNameFromResourceId(resourceId),
+                u'foo.txt')
+        self.assertEquals(self.storage.open(resourceId).read(), 'abcdef')
+        # The file was moved into the storage.
+        self.assertEquals(self.rm.getUploadOffset(uploadId), None)
+        self.assertEquals(self.rm.completeUpload(uploadId), None)
+
+    def test_unknown(self):
+        self.assertEquals(self.rm.getUploadOffset('nonsense'), None)
+        self.assertEquals(self.rm.appendUpload('x__' +
+            resourcemanager.encodeFileName(u'foo'), 0, 'abc'), None)
+
+    def test_threadPool(self):
+        # The resource's file operations run off the reactor thread.
+        threads = []
+        class Uploads(resourcemanager.ChunkedUploads):
+            def begin(self, fileName):
+                threads.append(threadable.isInIOThread())
+                return resourcemanager.ChunkedUploads.begin(self, fileName)
+            def offset(self, uploadId):
+                threads.append(threadable.isInIOThread())
+                return resourcemanager.ChunkedUploads.offset(self, uploadId)
+        self.rm.uploads = Uploads(self.uploads.directory)
+        d = self.render((), 'POST', {'name': ['foo.txt']})
+        d.addCallback(lambda (code, result): self.render(
+            (result['uploadId'],), 'GET'))
+        def status((code, result)):
+            self.assertEquals(result, {'offset': 0})
+            self.assertEquals(threads, [False, False])
+        return d.addCallback(status)
+
+    def test_locks(self):
+        # Appends lock their own upload, and the locks are not kept.
+        first = self.rm.beginUpload(u'foo.txt')
+        second = self.rm.beginUpload(u'bar.txt')
+        lock = self.uploads._acquire(first)
+        self.assertEquals(self.rm.appendUpload(second, 0, 'abc'), 3)
+        self.uploads._release(first, lock)
+        self.assertEquals(self.rm.appendUpload(first, 0, 'abc'), 3)
+        self.assertEquals(self.uploads._locks, {})
+
+    def test_janitor(self):
+        uploadId = self.rm.beginUpload(u'foo.txt')
+        self.assertEquals([r[0] for r in self.uploads.listResources()],
+                [uploadId])
+        resourcemanager.ResourceJanitor(self.uploads, maxAge=60,
+                clock=Clock(time.time() + 120)).sweep()
+        self.assertEquals(self.rm.getUploadOffset(uploadId), None)
+
+    def render(self, segments, method, args=None, content=''):
+        resource = formal.widget.ChunkedUploadResource(self.rm, maxBytes=10)
+        if segments:
+            resource, remaining = resource.locateChild(None, segments)
+        request = testutil.FakeRequest(args=args)
+        request.method = method
+        request.content = StringIO(content)
+        ctx = context.RequestContext(tag=request)
+        d = defer.maybeDeferred(resource.renderHTTP, ctx)
+        return d.addCallback(lambda body: (request.code, json.loads(body)))
+
+    def test_resource(self):
+        d = self.render((), 'POST', {'name': ['foo.txt']})
+        def begun((code, result)):
+            self.assertEquals(result['offset'], 0)
+            self.uploadId = result['uploadId']
+            return self.render((self.uploadId,), 'PUT', {'offset': ['0']},
+                    'abc')
+        def appended((code, result)):
+            self.assertEquals(result, {'offset': 3})
+            return self.render((self.uploadId,), 'PUT', {'offset': ['0']},
+                    'abc')
+        def conflict((code, result)):
+            self.assertEquals((code, result), (409, {'offset': 3}))
+            return self.render((self.uploadId,), 'PUT', {'offset': ['3']},
+                    'x' * 8)
+        def tooLarge((code, result)):
+            self.assertEquals(code, 413)
+            return self.render((self.uploadId,), 'GET')
+        def status((code, result)):
+            self.assertEquals(result, {'offset': 3})
+            return self.render((self.uploadId, 'complete'), 'POST')
+        def completed((code, result)):
+            self.assertEquals(result['fileName'], u'foo.txt')
+            f = self.storage.open(result['resourceId'])
+            self.assertEquals(f.read(), 'abc')
+            f.close()
+            return self.render((self.uploadId,), 'GET')
+        def gone((code, result)):
+            self.assertEquals(code, 404)
+        for f in (begun, appended, conflict, tooLarge, status, completed,
+                gone):
+            d.addCallback(f)
+        return d
@@ -0,0 +1,146 @@
+from twisted.internet import defer
+from twisted.trial import unittest
+import formal
+from formal import validation
+
+
+class DeferredValidator(object):
+    """
+    A validator that returns a Deferred per call, fired by the test.
+    """
+
+    def __init__(self, name=None, **attrs):
+        self.name = name
+        self.calls = []
+        self.__dict__.update(attrs)
+
+    def validate(self, field, value):
+        d = defer.Deferred()
+        self.calls.append((value, d))
+        return d
+
+    def fire(self, index=0, error=None):
+        value, d = self.calls.pop(index)
+        if error is None:
+            d.callback(None)
+        else:
+            d.errback(validation.FieldError(error))
+
+
+class SyncValidator(object):
+    synchronous = True
+
+    def __init__(self):
+        self.calls = []
+
+    def validate(self, field, value):
+        self.calls.append(value)
+
+
+class TestScheduler(unittest.TestCase):
+
+    def test_limit(self):
+        scheduler = formal.ValidationScheduler(limit=2)
+        validator = DeferredValidator()
+        results = [scheduler.schedule(validator, None, i) for i in range(4)]
+        self.assertEquals([v for v, d in validator.calls], [0, 1])
+        self.assertEquals(len(scheduler.queue), 2)
+        validator.fire()
+        self.assertEquals([v for v, d in validator.calls], [1, 2])
+        validator.fire()
+        validator.fire()
+        validator.fire()
+        self.assertEquals(scheduler.running, 0)
+        self.assertEquals(scheduler.queue, [])
+        for d in results:
+            self.assertEquals(d.called, True)
+
+    def test_order(self):
+        scheduler = formal.ValidationScheduler(limit=1)
+        order = []
+        blocker = DeferredValidator()
+        scheduler.schedule(blocker, None, 'blocker')
+        cheap = DeferredValidator(cost=1)
+        dear = DeferredValidator(cost=10)
+        urgent = DeferredValidator(priority=1, cost=10)
+        for validator in (dear, cheap, urgent):
+            scheduler.schedule(validator, None, validator)
+        def run():
+            for validator in (blocker, urgent, cheap, dear):
+                if validator.calls:
+                    order.append(validator)
+                    validator.fire()
+                    return
+        for i in range(4):
+            run()
+        self.assertEquals(order, [blocker, urgent, cheap, dear])
+
+    def test_perValidatorLimit(self):
+        scheduler = formal.ValidationScheduler(limit=10, perValidatorLimit=1)
+        lookup = DeferredValidator()
+        other = DeferredValidator()
+        scheduler.schedule(lookup, None, 1)
+        scheduler.schedule(lookup, None, 2)
+        scheduler.schedule(other, None, 3)
+        self.assertEquals(len(lookup.calls), 1)
+        self.assertEquals(len(other.calls), 1)
+        lookup.fire()
+        self.assertEquals([v for v, d in lookup.calls], [2])
+
+    def test_concurrencyKey(self):
+        scheduler = formal.ValidationScheduler()
+        one = DeferredValidator(maxConcurrency=1, concurrencyKey='db')
+        two = DeferredValidator(maxConcurrency=1, concurrencyKey='db')
+        scheduler.schedule(one, None, 1)
+        scheduler.schedule(two, None, 2)
+        self.assertEquals(len(two.calls), 0)
+        one.fire()
+        self.assertEquals(len(two.calls), 1)
+
+    def test_synchronous(self):
+        scheduler = formal.ValidationScheduler(limit=1)
+        scheduler.schedule(DeferredValidator(), None, 1)
+        validator = SyncValidator()
+        self.assertEquals(scheduler.schedule(validator, None, 2), None)
+        self.assertEquals(validator.calls, [2])
+
+    def test_errors(self):
+        scheduler = formal.ValidationScheduler(limit=1)
+        validator = DeferredValidator()
+        first = scheduler.schedule(validator, None, 1)
+        first.addErrback(lambda failure: failure.trap(validation.FieldError))
+        d = scheduler.schedule(validator, None, 2)
+        validator.fire(error='bad')
+        validator.fire(error='worse')
+        self.assertEquals(scheduler.running, 0)
+        return self.assertFailure(d, validation.FieldError)
+
+
+class TestFormScheduling(unittest.TestCase):
+
+    def test_recordValidator(self):
+        scheduler = formal.ValidationScheduler(limit=1)
+        validator = DeferredValidator()
+        form = formal.Form()
+        form.validationScheduler = scheduler
+        form.addField('a', formal.String(validators=[validator]))
+        form.addField('b', formal.String(validators=[validator]))
+        form.addField('c', formal.String(required=True))
+        validator = formal.RecordValidator(form)
+        d = validator.validate({'a': 'x', 'b': 'y'})
+        self.assertEquals(len(scheduler.queue), 1)
+        calls = form.getItemByName('a').type.validators[0].calls
+        while calls:
+            calls.pop(0)[1].callback(None)
+        def check((data, errors)):
+            self.assertEquals(data, {'a': 'x', 'b': 'y'})
+            self.assertEquals(errors.getFieldError('c').message, 'Required')
+        return d.addCallback(check)
+
+    def test_schema(self):
+        scheduler = formal.ValidationScheduler()
+        form = formal.Form()
+        form.validationScheduler = scheduler
+        form.addField('a', formal.String())
+        schema = formal.FormSchema(form)
+        self.assertIdentical(schema.makeForm().validationScheduler, scheduler)
@@ -198,3 +198,99 @@ class TestValidate(unittest.TestCase):
         pass
     test_file.skip = "write tests"
 
+
+
+class TestCheck(unittest.TestCase):
+
+    def test_synchronous(self):
+        t = formal.String(strip=True, missing='missing',
+                validators=[validation.LengthValidator(max=5)])
+        self.assertEquals(t.check(' foo '), 'foo')
+        self.assertEquals(t.check(' '), 'missing')
+        self.assertRaises(validation.FieldValidationError, t.check, '123456')
+        self.assertRaises(validation.FieldRequiredError,
+                formal.Integer(required=True).check, None)
+
+    def test_deferred(self):
+        class DeferredValidator(object):
+            def validate(self, field, value):
+                if value == 'fail':
+                    return defer.fail(validation.FieldValidationError('failed'))
+                return defer.succeed(None)
+        t = formal.String(validators=[DeferredValidator()])
+        d = t.check('foo')
+        self.failUnless(isinstance(d, defer.Deferred))
+        d.addCallback(self.assertEquals, 'foo')
+        def failure(_):
+            d = t.check('fail')
+            self.failUnless(isinstance(d, defer.Deferred))
+            return self.assertFailure(d, validation.FieldValidationError)
+        d.addCallback(failure)
+        return d
+
+    def test_firstErrorWins(self):
+        t = formal.String(validators=[validation.LengthValidator(max=1),
+            validation.PatternValidator('^[0-9]*$')])
+        try:
+            t.check('foo')
+        except validation.FieldValidationError, e:
+            self.assertEquals(e.message, 'Must be shorter than 1 characters')
+        else:
+            self.fail('FieldValidationError not raised')
+
+    def test_sequential(self):
+        calls = []
+        class Validator(object):
+            def __init__(self, name, cost=0, fail=False):
+                self.name = name
+                self.cost = cost
+                self.fail = fail
+            def validate(self, field, value):
+                calls.append(self.name)
+                if self.fail:
+                    return defer.fail(validation.FieldValidationError(self.name))
+                return defer.succeed(None)
+        t = formal.String(required=True, sequential=True, validators=[
+            Validator('remote', cost=10), Validator('local', cost=1),
+            Validator('other', cost=1)])
+        t.check('foo').addCallback(self.assertEquals, 'foo')
+        self.assertEquals(calls, ['local', 'other', 'remote'])
+        # The required validator is synchronous so it is run first and the
+        # others are not run at all.
+        del calls[:]
+        self.assertRaises(validation.FieldRequiredError, t.check, None)
+        self.assertEquals(calls, [])
+        # Nothing is run after the first failure.
+        t = formal.String(sequential=True, validators=[
+            Validator('remote', cost=10), Validator('local', cost=1, fail=True)])
+        d = t.check('foo')
+        d = self.assertFailure(d, validation.FieldValidationError)
+        d.addCallback(lambda _: self.assertEquals(calls, ['local']))
+        return d
+
+    def test_sequentialDeferred(self):
+        pending = []
+        class DeferredValidator(object):
+            def validate(self, field, value):
+                d = defer.Deferred()
+                pending.append(d)
+                return d
+        t = formal.String(sequential=True,
+                validators=[DeferredValidator(), DeferredValidator()])
+        d = t.check('foo')
+        self.assertEquals(len(pending), 1)
+        pending.pop().callback(None)
+        self.assertEquals(len(pending), 1)
+        pending.pop().callback(None)
+        d.addCallback(self.assertEquals, 'foo')
+        return d
+
+    def test_validateOverride(self):
+        # A subclass that customises validate() is still honoured.
+        class Upper(formal.String):
+            def validate(self, value):
+                return super(Upper, self).validate(value.upper())
+        d = Upper().check('foo')
+        self.failUnless(isinstance(d, defer.Deferred))
+        d.addCallback(self.assertEquals, 'FOO')
+        return d
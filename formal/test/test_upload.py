@@ -0,0 +1,165 @@
+import os
+from StringIO import StringIO
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial import unittest
+from twisted.web import http
+from nevow import appserver, inevow, rend
+from formal import upload
+from formal.resourcemanager import ResourceManager
+
+
+BOUNDARY = 'xyzzy'
+
+class LimitedFieldStorage(upload.UploadFieldStorage):
+    maxFileSize = 5000
+
+
+def parse(content, factory=upload.UploadFieldStorage):
+    body = '\r\n'.join([
+        '--' + BOUNDARY,
+        'Content-Disposition: form-data; name="name"',
+        '',
+        'Matt',
+        '--' + BOUNDARY,
+        'Content-Disposition: form-data; name="file"; filename="foo.txt"',
+        'Content-Type: text/plain',
+        '',
+        content,
+        '--' + BOUNDARY + '--',
+        ''])
+    headers = {'content-type': 'multipart/form-data; boundary=' + BOUNDARY,
+            'content-length': str(len(body))}
+    return factory(StringIO(body), headers,
+            environ={'REQUEST_METHOD': 'POST'})
+
+
+class TestUpload(unittest.TestCase):
+
+    content = 'x' * 10000
+
+    def test_spool(self):
+        fields = parse(self.content)
+        self.assertEquals(fields['name'].value, 'Matt')
+        f = fields['file'].file
+        self.failUnless(isinstance(f, upload.SpoolFile))
+        self.failUnless(os.path.exists(f.name))
+        self.assertEquals(list(upload.iterSpoolFiles(fields)), [f])
+        f.close()
+        os.remove(f.name)
+
+    def test_adopt(self):
+        fields = parse(self.content)
+        f = fields['file'].file
+        rm = ResourceManager()
+        rm.setResource('file', f, u'foo.txt')
+        self.failIf(f.adoptable)
+        self.failIf(os.path.exists(f.name))
+        mimetype, filelike, fileName = rm.getResourceForWidget('file')
+        self.assertEquals(filelike.read(), self.content)
+        self.assertEquals(fileName, u'foo.txt')
+        filelike.close()
+        f.close()
+        rm.clearUpResources()
+
+    def test_copy(self):
+        # Small files are not spooled to disk by the cgi module.
+        fields = parse('small')
+        rm = ResourceManager()
+        rm.setResource('file', fields['file'].file, u'foo.txt')
+        mimetype, filelike, fileName = rm.getResourceForWidget('file')
+        self.assertEquals(filelike.read(), 'small')
+        filelike.close()
+        rm.clearUpResources()
+
+    def test_maxFileSize(self):
+        fields = parse('\r\n'.join(['x' * 99] * 100), LimitedFieldStorage)
+        self.assertEquals(fields['name'].value, 'Matt')
+        fileitem = fields['file']
+        self.failUnless(fileitem.oversized)
+        # Nothing beyond the limit was kept.
+        fileitem.file.seek(0, 2)
+        self.failUnless(fileitem.file.tell() <= 5000)
+        for f in upload.iterSpoolFiles(fields):
+            f.close()
+            os.remove(f.name)
+        fields = parse('small', LimitedFieldStorage)
+        self.failIf(fields['file'].oversized)
+        # Files kept in memory are limited too.
+        class TinyFieldStorage(upload.UploadFieldStorage):
+            maxFileSize = 3
+        fields = parse('small', TinyFieldStorage)
+        self.failUnless(fields['file'].oversized)
+        self.assertEquals(fields['file'].file.read(), '')
+
+
+class LimitedRequest(upload.UploadRequest):
+    maxContentLength = 100
+
+
+class TestUploadRequest(unittest.TestCase):
+
+    def connect(self):
+        channel = http.HTTPChannel()
+        channel.requestFactory = LimitedRequest
+        transport = StringTransport()
+        channel.makeConnection(transport)
+        return channel, transport
+
+    def test_contentLength(self):
+        # The request is refused on seeing its headers.
+        channel, transport = self.connect()
+        channel.dataReceived('POST / HTTP/1.1\r\nContent-Length: 1000\r\n'
+                'Expect: 100-continue\r\n\r\n')
+        self.failUnless(transport.value().startswith('HTTP/1.1 413 '))
+        self.failUnless('Connection: close\r\n' in transport.value())
+        self.failIf('100 Continue' in transport.value())
+        self.failUnless(transport.disconnecting)
+        self.assertEquals(channel.requests[-1].content.getvalue(), '')
+
+    def test_fields(self):
+        seen = []
+        class Page(rend.Page):
+            def locateChild(self, ctx, segments):
+                seen.append(segments)
+                return self, ()
+            def renderHTTP(self, ctx):
+                request = inevow.IRequest(ctx)
+                request.content.seek(0)
+                seen.append(request.content.read())
+                seen.append(request.fields)
+                return 'done'
+        channel = http.HTTPChannel()
+        channel.site = appserver.NevowSite(Page())
+        channel.requestFactory = upload.UploadRequest
+        transport = StringTransport()
+        channel.makeConnection(transport)
+        body = '\r\n'.join([
+            '--' + BOUNDARY,
+            'Content-Disposition: form-data; name="file"; filename="foo.txt"',
+            '',
+            'x' * 10000,
+            '--' + BOUNDARY + '--',
+            ''])
+        channel.dataReceived('POST /a/b HTTP/1.1\r\nContent-Type: '
+                'multipart/form-data; boundary=%s\r\nContent-Length: %d\r\n'
+                '\r\n%s' % (BOUNDARY, len(body), body))
+        segments, content, fields = seen
+        self.assertEquals(segments, ('a', 'b'))
+        # The body is left for the page, and only parsed once.
+        self.assertEquals(content, body)
+        self.failUnless(isinstance(fields, upload.UploadFieldStorage))
+        f = fields['file'].file
+        self.failUnless(isinstance(f, upload.SpoolFile))
+        self.failUnless('done' in transport.value())
+        # The file was not adopted, so it is gone with the request.
+        self.failIf(os.path.exists(f.name))
+
+    def test_chunked(self):
+        # A body without a length is refused once too much of it arrives.
+        channel, transport = self.connect()
+        channel.dataReceived('POST / HTTP/1.1\r\n'
+                'Transfer-Encoding: chunked\r\n\r\n')
+        self.assertEquals(transport.value(), '')
+        channel.dataReceived('%x\r\n%s\r\n' % (200, 'x' * 200))
+        self.failUnless(transport.value().startswith('HTTP/1.1 413 '))
+        self.failUnless(transport.disconnecting)
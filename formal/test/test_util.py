@@ -1,5 +1,10 @@
+from StringIO import StringIO
+from twisted.internet import defer
 from twisted.trial import unittest
+from nevow import context, flat, tags as T, testutil
 from formal import util
+from formal.util import FileResource, StringTemplate, renderTag, \
+        CannotRenderString
 
 
 class TestUtil(unittest.TestCase):
@@ -15,3 +20,89 @@ class TestUtil(unittest.TestCase):
         self.assertEquals(util.validIdentifier('9'), False)
     test_validIdentifier.todo = "Fails due to weird import poblem"
 
+
+
+class TestStringTemplate(unittest.TestCase):
+
+    def test_fill(self):
+        template = StringTemplate(
+                T.div(id=T.slot('id'), class_=['a ', T.slot('class')])[
+                    T.p[T.slot('content')], T.slot('more')])
+        slots = {'id': u'\xe9"', 'class': '<b>', 'content': T.em['x & y'],
+                'more': ''}
+        stan = T.div(id=u'\xe9"', class_=['a ', '<b>'])[
+                T.p[T.em['x & y']], '']
+        self.assertEquals(flat.flatten(template.fill(slots)),
+                flat.flatten(stan))
+        # The markup around the slots is flattened once.
+        self.assertEquals(len(template.holes), 4)
+
+
+class TestRenderTag(unittest.TestCase):
+
+    def test_renderTag(self):
+        for stan, markup in [
+                (T.input(type='text', value=u'\xe9"<&>\'', size=4, x=None),
+                    renderTag('input', {'type': 'text', 'value': u'\xe9"<&>\'',
+                        'size': 4, 'x': None})),
+                (T.textarea(name='t')[''], renderTag('textarea', {'name': 't'}, '')),
+                (T.select(name='s'), renderTag('select', {'name': 's'})),
+                (T.option(value=1.5, selected=True)[u'<\xff>'],
+                    renderTag('option', {'value': 1.5, 'selected': True},
+                        u'<\xff>')),
+                ]:
+            self.assertEquals(markup, flat.flatten(stan))
+
+    def test_stan(self):
+        self.assertRaises(CannotRenderString, renderTag, 'label', {}, T.em['x'])
+        self.assertRaises(CannotRenderString, renderTag, 'input',
+                {'value': T.slot('x')})
+
+
+
+class TestFileResource(unittest.TestCase):
+
+    content = ''.join([chr(i % 256) for i in range(200000)])
+
+    def render(self, headers=None, method='GET'):
+        request = testutil.FakeRequest(headers=headers)
+        request.method = method
+        resource = FileResource(StringIO(self.content), 'image/png')
+        d = defer.maybeDeferred(resource.renderHTTP,
+                context.RequestContext(tag=request))
+        return d.addCallback(lambda body: (request, request.accumulator + body))
+
+    def test_whole(self):
+        def rendered((request, body)):
+            self.assertEquals(body, self.content)
+            self.assertEquals(request.responseHeaders.getRawHeaders(
+                'content-length'), [str(len(self.content))])
+            self.assertEquals(request.responseHeaders.getRawHeaders(
+                'content-type'), ['image/png'])
+        return self.render().addCallback(rendered)
+
+    def test_range(self):
+        def rendered((request, body)):
+            self.assertEquals(request.code, 206)
+            self.assertEquals(body, self.content[100:200])
+            self.assertEquals(request.responseHeaders.getRawHeaders(
+                'content-range'), ['bytes 100-199/200000'])
+        return self.render({'range': 'bytes=100-199'}).addCallback(rendered)
+
+    def test_suffixRange(self):
+        def rendered((request, body)):
+            self.assertEquals(body, self.content[-10:])
+        return self.render({'range': 'bytes=-10'}).addCallback(rendered)
+
+    def test_unsatisfiable(self):
+        def rendered((request, body)):
+            self.assertEquals(request.code, 416)
+            self.assertEquals(body, '')
+        return self.render({'range': 'bytes=300000-'}).addCallback(rendered)
+
+    def test_head(self):
+        def rendered((request, body)):
+            self.assertEquals(body, '')
+            self.assertEquals(request.responseHeaders.getRawHeaders(
+                'content-length'), [str(len(self.content))])
+        return self.render(method='HEAD').addCallback(rendered)
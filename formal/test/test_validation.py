@@ -1,6 +1,9 @@
 import re
+from StringIO import StringIO
+from twisted.internet import defer
+from twisted.python import context
 from twisted.trial import unittest
-from formal import types, validation
+from formal import iformal, types, validation
 
 
 class TestRequired(unittest.TestCase):
@@ -95,3 +98,207 @@ class TestPattern(unittest.TestCase):
         self.assertRaises(validation.FieldValidationError, v.validate, types.String(), '1')
         self.assertRaises(validation.FieldValidationError, v.validate, types.String(), 'foo')
         
+
+
+PNG = '\x89PNG\r\n\x1a\n' + '\x00' * 100
+
+
+class TestFile(unittest.TestCase):
+
+    def test_maxBytes(self):
+        v = validation.FileValidator(maxBytes=100)
+        v.validate(types.File(), None)
+        v.validate(types.File(), (None, None, None))
+        v.validate(types.File(), ('text/plain', StringIO('x' * 100), u'a.txt'))
+        self.assertRaises(validation.FieldValidationError, v.validate,
+                types.File(), ('text/plain', StringIO('x' * 101), u'a.txt'))
+
+    def test_extensions(self):
+        v = validation.FileValidator(extensions=['.png'])
+        v.validate(types.File(), ('image/png', StringIO(PNG), u'a.PNG'))
+        self.assertRaises(validation.FieldValidationError, v.validate,
+                types.File(), ('image/png', StringIO(PNG), u'a.exe'))
+
+    def test_mimeTypes(self):
+        v = validation.FileValidator(mimeTypes=['image/*', 'text/plain'])
+        v.validate(types.File(), ('image/png', StringIO(PNG), u'a.png'))
+        v.validate(types.File(), (None, StringIO('hello'), u'a.txt'))
+        # The content decides, whatever the name or declared type.
+        v.validate(types.File(), ('text/plain', StringIO(PNG), u'a.txt'))
+        self.assertRaises(validation.FieldValidationError, v.validate,
+                types.File(), ('image/png', StringIO('MZ\x90\x00'), u'a.png'))
+        self.assertRaises(validation.FieldValidationError, v.validate,
+                types.File(), ('application/pdf', StringIO('%PDF-1.4'),
+                    u'a.pdf'))
+
+    def test_rawValue(self):
+        # FileUploadRaw's (fileName, filelike) values.
+        v = validation.FileValidator(mimeTypes=['image/png'])
+        v.validate(types.File(), (u'', StringIO('')))
+        v.validate(types.File(), (u'a.png', StringIO(PNG)))
+        self.assertRaises(validation.FieldValidationError, v.validate,
+                types.File(), (u'a.png', StringIO('\x7fELF')))
+
+    def test_container(self):
+        # Zip based formats are typed by name.
+        v = validation.FileValidator(mimeTypes=['application/vnd.oasis.opendocument.text'])
+        v.validate(types.File(), (None, StringIO('PK\x03\x04'), u'a.odt'))
+        self.assertRaises(validation.FieldValidationError, v.validate,
+                types.File(), (None, StringIO('PK\x03\x04'), u'a.zip'))
+
+    def test_type(self):
+        self.assertEquals(types.File().validators, [])
+        t = types.File(maxBytes=10, required=True)
+        self.failUnless(t.hasValidator(validation.FileValidator))
+        self.failUnless(t.required)
+        self.assertRaises(validation.FieldValidationError, t.check,
+                ('text/plain', StringIO('x' * 11), u'a.txt'))
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class LookupValidator(object):
+    """
+    A validator that counts its calls and rejects the value 'taken',
+    asynchronously if requested.
+    """
+
+    cacheable = True
+
+    def __init__(self, async=False):
+        self.async = async
+        self.calls = 0
+        self.pending = []
+
+    def validate(self, field, value):
+        self.calls += 1
+        if not self.async:
+            if value == 'taken':
+                raise validation.FieldValidationError('Taken')
+            return
+        d = defer.Deferred()
+        self.pending.append((d, value))
+        return d
+
+    def fire(self):
+        for d, value in self.pending:
+            if value == 'taken':
+                d.errback(validation.FieldValidationError('Taken'))
+            else:
+                d.callback(None)
+        self.pending = []
+
+
+class TestValidatorCache(unittest.TestCase):
+
+    def test_cache(self):
+        cache = validation.ValidatorCache()
+        v = LookupValidator()
+        field = types.String()
+        cache.validate(v, field, 'free')
+        cache.validate(v, field, 'free')
+        self.assertEquals(v.calls, 1)
+        self.assertEquals((cache.hits, cache.misses), (1, 1))
+
+    def test_cacheKey(self):
+        # Validators made for each request share outcomes by their cacheKey.
+        class KeyedValidator(LookupValidator):
+            calls = 0
+            def __init__(self, table):
+                LookupValidator.__init__(self)
+                self.cacheKey = table
+            def validate(self, field, value):
+                KeyedValidator.calls += 1
+        cache = validation.ValidatorCache()
+        field = types.String()
+        for table in ['users', 'users', 'groups']:
+            cache.validate(KeyedValidator(table), field, 'free')
+        self.assertEquals(KeyedValidator.calls, 2)
+        self.failIf([key for key in cache.cache._items
+            if isinstance(key[0], KeyedValidator)])
+
+    def test_negative(self):
+        cache = validation.ValidatorCache()
+        v = LookupValidator()
+        field = types.String()
+        for i in range(2):
+            try:
+                cache.validate(v, field, 'taken')
+            except validation.FieldValidationError, e:
+                self.assertEquals(e.fieldName, None)
+                e.fieldName = 'name'
+            else:
+                self.fail('FieldValidationError not raised')
+        self.assertEquals(v.calls, 1)
+
+    def test_negativeTTL(self):
+        clock = Clock()
+        cache = validation.ValidatorCache(ttl=60, negativeTTL=0, clock=clock)
+        v = LookupValidator()
+        field = types.String()
+        for i in range(2):
+            self.assertRaises(validation.FieldValidationError, cache.validate,
+                    v, field, 'taken')
+        self.assertEquals(v.calls, 2)
+        cache.validate(v, field, 'free')
+        clock.now = 59
+        cache.validate(v, field, 'free')
+        self.assertEquals(v.calls, 3)
+        clock.now = 60
+        cache.validate(v, field, 'free')
+        self.assertEquals(v.calls, 4)
+
+    def test_lru(self):
+        cache = validation.ValidatorCache(maxSize=2)
+        v = LookupValidator()
+        field = types.String()
+        for value in ['a', 'b', 'a', 'c', 'a', 'b']:
+            cache.validate(v, field, value)
+        self.assertEquals(v.calls, 4)
+
+    def test_unhashable(self):
+        cache = validation.ValidatorCache()
+        v = LookupValidator()
+        field = types.Sequence()
+        cache.validate(v, field, ['a'])
+        cache.validate(v, field, ['a'])
+        self.assertEquals(v.calls, 2)
+
+    def test_inFlight(self):
+        cache = validation.ValidatorCache()
+        v = LookupValidator(async=True)
+        field = types.String()
+        results = [cache.validate(v, field, 'taken') for i in range(3)]
+        self.assertEquals(v.calls, 1)
+        v.fire()
+        self.assertRaises(validation.FieldValidationError, cache.validate,
+                v, field, 'taken')
+        self.assertEquals(v.calls, 1)
+        errors = []
+        for d in results:
+            d.addErrback(lambda f: errors.append(f.trap(validation.FieldError)))
+        self.assertEquals(len(errors), 3)
+
+    def test_cachingValidator(self):
+        v = LookupValidator()
+        v.cost = 10
+        caching = validation.CachingValidator(v)
+        caching.validate(types.String(), 'free')
+        caching.validate(types.String(), 'free')
+        self.assertEquals(v.calls, 1)
+        self.assertEquals(caching.cost, 10)
+
+    def test_type(self):
+        cache = validation.ValidatorCache()
+        v = LookupValidator()
+        field = types.String(validators=[v])
+        for i in range(2):
+            context.call({iformal.IValidatorCache: cache}, field.check, 'free')
+        self.assertEquals(v.calls, 1)
@@ -9,6 +9,7 @@ except ImportError:
     haveDecimal = False
 from zope.interface import implements
 from twisted.internet import defer
+from twisted.python import context, failure
 
 from formal import iformal, validation
 
@@ -25,14 +26,19 @@ class Type(object):
     immutable = False
     # List of validators to test the value against
     validators = ()
+    # Run the validators one at a time, cheapest first, stopping at the first
+    # failure
+    sequential = False
 
-    def __init__(self, name=None, required=None, missing=None, immutable=None, validators=None):
+    def __init__(self, name=None, required=None, missing=None, immutable=None, validators=None, sequential=None):
         if name is not None:
             self.name = name
         if missing is not None:
             self.missing = missing
         if immutable is not None:
             self.immutable = immutable
+        if sequential is not None:
+            self.sequential = sequential
         if validators is not None:
             self.validators = list(validators)
         else:
@@ -43,9 +49,90 @@ class Type(object):
             self.validators.append(validation.RequiredValidator())
 
     def validate(self, value):
-        dl = []
+        """
+        Validate the value, returning a Deferred that fires with the validated
+        value or fails with a FieldError.
+        """
+        return defer.maybeDeferred(self._check, value)
+
+    def check(self, value):
+        """
+        Validate the value, returning the validated value directly when the
+        validation is synchronous. A FieldError is raised immediately unless a
+        validator returned a Deferred, in which case a Deferred is returned
+        instead.
+
+        Widgets should call this rather than validate() so that the common,
+        synchronous, case does not create any Deferreds.
+        """
+        if self.__class__.validate.im_func is not Type.validate.im_func:
+            # A subclass has customised validate so it must be used.
+            return self.validate(value)
+        return self._check(value)
+
+    def _check(self, value):
+        """
+        Run the value through all validators. Override this, rather than
+        validate(), to customise the value before it is validated.
+        """
+        scheduler = context.get(iformal.IValidationScheduler)
+        cache = context.get(iformal.IValidatorCache)
+
+        if self.sequential:
+            validators = sorted(self.validators, key=_pipelineOrder)
+            return self._checkSequential(None, iter(validators), value,
+                    scheduler, cache)
+
+        outcomes = []
+        isAsync = False
         for validator in self.validators:
-            dl.append(defer.maybeDeferred(validator.validate, self, value))
+            try:
+                outcome = _callValidator(validator, self, value, scheduler,
+                        cache)
+            except:
+                outcome = failure.Failure()
+            else:
+                if isinstance(outcome, defer.Deferred):
+                    isAsync = True
+            outcomes.append(outcome)
+
+        if isAsync:
+            return self._checkDeferred(outcomes, value)
+
+        for outcome in outcomes:
+            if isinstance(outcome, failure.Failure):
+                outcome.raiseException()
+
+        if value is None:
+            value = self.missing
+        return value
+
+    def _checkSequential(self, _, validators, value, scheduler, cache):
+        """
+        Run the remaining validators in turn, waiting for any that return a
+        Deferred before moving on to the next.
+        """
+        for validator in validators:
+            outcome = _callValidator(validator, self, value, scheduler, cache)
+            if isinstance(outcome, defer.Deferred):
+                return outcome.addCallback(self._checkSequential, validators,
+                        value, scheduler, cache)
+        if value is None:
+            value = self.missing
+        return value
+
+    def _checkDeferred(self, outcomes, value):
+        """
+        Wait for the outcome of validators that returned a Deferred, failing
+        with the first error.
+        """
+        dl = []
+        for outcome in outcomes:
+            if isinstance(outcome, failure.Failure):
+                outcome = defer.fail(outcome)
+            elif not isinstance(outcome, defer.Deferred):
+                outcome = defer.succeed(outcome)
+            dl.append(outcome)
 
         def _cbValidate(_, value):
             if value is None:
@@ -76,6 +163,26 @@ class Type(object):
     required = property(*required())
 
 
+def _callValidator(validator, field, value, scheduler, cache):
+    """
+    Call a validator, via the cache or scheduler in use, if any.
+    """
+    if cache is not None and getattr(validator, 'cacheable', False):
+        return cache.validate(validator, field, value, scheduler)
+    elif scheduler is not None:
+        return scheduler.schedule(validator, field, value)
+    return validator.validate(field, value)
+
+
+def _pipelineOrder(validator):
+    """
+    Sort key for the validators of a sequential type: synchronous validators
+    first, then by cost, otherwise keeping the declared order.
+    """
+    return (not getattr(validator, 'synchronous', False),
+            getattr(validator, 'cost', 0))
+
+
 class String(Type):
 
     # Strip the value before validation
@@ -87,12 +194,12 @@ class String(Type):
             self.strip = strip
         super(String, self).__init__(**k)
 
-    def validate(self, value):
+    def _check(self, value):
         if value is not None and self.strip:
             value = value.strip()
         if not value:
             value = None
-        return super(String, self).validate(value)
+        return super(String, self)._check(value)
 
 
 class Integer(Type):
@@ -132,15 +239,27 @@ class Sequence(Type):
         if type is not None:
             self.type = type
 
-    def validate(self, value):
+    def _check(self, value):
         # Map empty sequence to None
         if not value:
             value = None
-        return super(Sequence, self).validate(value)
+        return super(Sequence, self)._check(value)
 
 
 class File(Type):
-    pass
+    """
+    An uploaded file.
+
+    maxBytes, mimeTypes and extensions, if given, limit the files accepted
+    using a FileValidator.
+    """
+
+    def __init__(self, maxBytes=None, mimeTypes=None, extensions=None, **k):
+        super(File, self).__init__(**k)
+        if maxBytes is not None or mimeTypes is not None or \
+                extensions is not None:
+            self.validators.append(validation.FileValidator(maxBytes,
+                mimeTypes, extensions))
 
 
 
@@ -169,7 +288,7 @@ class RichTextType(Type):
         self.strip = strip or False
         
 
-    def validate(self, value):
+    def _check(self, value):
         # For the moment all the validation is against the content
 
         if self.strip:
@@ -177,7 +296,7 @@ class RichTextType(Type):
         if not value.value:
             value=None
 
-        return super(RichTextType, self).validate(value)
+        return super(RichTextType, self)._check(value)
 
 
 __all__ = [
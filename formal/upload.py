@@ -0,0 +1,236 @@
+"""
+Upload handling that avoids copying uploaded files around.
+
+By default the cgi module spools each uploaded file to an anonymous temporary
+file and the ResourceManager then copies it to a file of its own, so every
+upload is written to disk twice. Serving a site's requests with UploadRequest
+spools uploads to named files, in the same directory as the resource manager's
+files, that the resource manager adopts by renaming::
+
+    site = appserver.NevowSite(root)
+    site.requestFactory = formal.UploadRequest
+
+Spooled files that are not adopted, i.e. that no form kept, are removed when
+the request finishes.
+
+Limits can be set so that large uploads are refused as early as possible,
+rather than being spooled only to fail validation::
+
+    formal.UploadRequest.maxContentLength = 100 * 1024 * 1024
+    formal.UploadFieldStorage.maxFileSize = 20 * 1024 * 1024
+
+A request whose body is larger than maxContentLength is answered with a 413
+response, and the connection closed, as soon as its Content-Length header (or
+the body received so far) shows it to be too large. The body is not written
+anywhere. A file larger than maxFileSize stops being spooled once the limit is
+reached and the file widgets then fail the field as too large. Per field
+limits, e.g. a File type's maxBytes, are checked once the request has been
+parsed but before the file is copied to the resource manager.
+"""
+
+from __future__ import absolute_import
+
+import cgi
+import os
+import tempfile
+from cStringIO import StringIO
+from twisted.web import http
+from nevow import appserver
+
+
+SPOOL_PREFIX = 'formal-upload-'
+
+
+class SpoolFile(file):
+    """
+    A named file that an uploaded file was spooled to. The ResourceManager may
+    take over the file, by renaming it, as long as adoptable is true.
+
+    If maxSize is not None nothing is written beyond it. The file is emptied
+    and its oversized attribute set instead.
+    """
+    adoptable = True
+    maxSize = None
+    oversized = False
+    written = 0
+
+    def write(self, data):
+        if self.maxSize is not None:
+            if self.oversized:
+                return
+            self.written += len(data)
+            if self.written > self.maxSize:
+                self.oversized = True
+                self.seek(0)
+                self.truncate()
+                return
+        file.write(self, data)
+
+
+class UploadFieldStorage(cgi.FieldStorage):
+    """
+    A FieldStorage that spools uploaded files to SpoolFiles.
+
+    Files larger than maxFileSize, if not None, are not spooled beyond the
+    limit. Their oversized attribute is set and their content discarded.
+    """
+    maxFileSize = None
+    oversized = False
+
+    def make_file(self, binary=None):
+        fd, path = tempfile.mkstemp(prefix=SPOOL_PREFIX)
+        try:
+            f = SpoolFile(path, 'w+b')
+        finally:
+            os.close(fd)
+        if self.filename is not None:
+            f.maxSize = self.maxFileSize
+        return f
+
+    def read_binary(self):
+        # A part with its own Content-Length is read in one go.
+        if self._tooLarge(self.length):
+            self.oversized = True
+            self.length = -1
+            self.read_lines()
+            return
+        cgi.FieldStorage.read_binary(self)
+        self._checkSize()
+
+    def read_lines(self):
+        cgi.FieldStorage.read_lines(self)
+        self._checkSize()
+
+    def _checkSize(self):
+        # A part's content is only spooled to a file, which enforces the
+        # limit, once it outgrows a small in-memory buffer.
+        if self.filename is None or self.maxFileSize is None:
+            return
+        if isinstance(self.file, SpoolFile):
+            if self.file.oversized:
+                self.oversized = True
+        elif self._tooLarge(len(self.file.getvalue())):
+            self.oversized = True
+            self.file = StringIO()
+
+    def _tooLarge(self, size):
+        return self.filename is not None and self.maxFileSize is not None \
+                and size > self.maxFileSize
+
+
+def iterSpoolFiles(fields):
+    """
+    Iterate the SpoolFiles of a FieldStorage and all its parts.
+    """
+    if isinstance(fields.file, SpoolFile):
+        yield fields.file
+    for part in fields.list or ():
+        if isinstance(part, cgi.FieldStorage):
+            for f in iterSpoolFiles(part):
+                yield f
+
+
+class UploadRequest(appserver.NevowRequest):
+    """
+    A NevowRequest that parses POSTed fields using UploadFieldStorage and
+    removes any files it spooled that were not adopted when it finishes.
+    """
+
+    # The largest request body accepted, or None for no limit.
+    maxContentLength = None
+    # True once the request has been refused as too large.
+    refused = False
+    # The parsed fields, and the body, while Nevow parses an empty body.
+    _uploadFields = _body = None
+
+    def __init__(self, *a, **k):
+        appserver.NevowRequest.__init__(self, *a, **k)
+        self.received = 0
+        self.notifyFinish().addBoth(self._removeSpoolFiles)
+
+    def gotLength(self, length):
+        if length is not None and self._tooLarge(length):
+            self._refuse()
+            length = 0
+        appserver.NevowRequest.gotLength(self, length)
+
+    def handleContentChunk(self, data):
+        if self.refused:
+            return
+        self.received += len(data)
+        if self._tooLarge(self.received):
+            self._refuse()
+            return
+        appserver.NevowRequest.handleContentChunk(self, data)
+
+    def requestReceived(self, command, path, version):
+        # A refused request has already been answered.
+        if not self.refused:
+            appserver.NevowRequest.requestReceived(self, command, path,
+                    version)
+
+    def process(self):
+        # NevowRequest.process parses a POSTed body with cgi.FieldStorage as
+        # it starts and has no hook for the parsing. Parsing the body twice
+        # would spool every upload twice, so the body is parsed here and
+        # Nevow is shown an empty one, until it sets the fields.
+        if self.method == 'POST':
+            t = self.content.tell()
+            self.content.seek(0)
+            self._uploadFields = UploadFieldStorage(self.content,
+                    self._cgiHeaders(), environ={'REQUEST_METHOD': 'POST'})
+            self.content.seek(t)
+            self._body, self.content = self.content, StringIO()
+        return appserver.NevowRequest.process(self)
+
+    def __setattr__(self, name, value):
+        # NevowRequest is an old-style class, so this rather than a property.
+        if name == 'fields' and self._body is not None:
+            # Nevow's fields, from the empty body.
+            value, self._uploadFields = self._uploadFields, None
+            self.content, self._body = self._body, None
+        self.__dict__[name] = value
+
+    def _cgiHeaders(self):
+        """
+        Return the request's headers as the dict, keyed by lower case name,
+        that FieldStorage expects.
+        """
+        return dict([(name.lower(), values[-1]) for name, values in
+            self.requestHeaders.getAllRawHeaders()])
+
+    def _tooLarge(self, length):
+        return self.maxContentLength is not None and \
+                length > self.maxContentLength
+
+    def _refuse(self):
+        """
+        Answer with a 413 response and drop the connection, without waiting
+        for, or keeping, the body. The request is never finished, whatever
+        of the body arrives before the connection closes is discarded.
+        """
+        self.refused = True
+        # Stop the channel inviting the client to send the body.
+        self.requestHeaders.removeHeader('expect')
+        # The channel only hands over the request line with the body.
+        self.clientproto = 'HTTP/1.1'
+        self.setResponseCode(http.REQUEST_ENTITY_TOO_LARGE)
+        self.setHeader('connection', 'close')
+        self.setHeader('content-length', '0')
+        self.write('')
+        self.channel.loseConnection()
+
+    def _removeSpoolFiles(self, result=None):
+        fields = getattr(self, 'fields', None)
+        if fields is None:
+            return
+        for f in iterSpoolFiles(fields):
+            f.close()
+            if f.adoptable:
+                try:
+                    os.remove(f.name)
+                except OSError:
+                    pass
+
+
+__all__ = ['UploadRequest', 'UploadFieldStorage']
@@ -1,6 +1,16 @@
+import os
 import re
+import time
+from collections import OrderedDict
+try:
+    import json
+except ImportError:
+    import simplejson as json
 from zope.interface import implements
-from nevow import inevow, tags
+from twisted.internet import defer
+from twisted.internet.interfaces import IPullProducer
+from nevow import appserver, flat, inevow, stan, tags
+from nevow.flat import flatstan
 from formal import iformal
 
 
@@ -30,6 +40,57 @@ def titleFromName(name):
 
     return ''.join(_())
 
+class ItemKey(str):
+    """
+    The key of a form item, which carries the item's CSS id fragment and
+    sub-part namer, worked out once as the item is attached to its parent, so
+    that the widgets given the key do not work them out again.
+    """
+
+    def __new__(cls, key):
+        self = str.__new__(cls, key)
+        self.cssKey = '-'.join(key.split('.'))
+        self.partNamer = PartNamer(self)
+        return self
+
+
+def cssKey(key):
+    """
+    Return the CSS id fragment, i.e. the dashed version, of a form item's key.
+    """
+    try:
+        return key.cssKey
+    except AttributeError:
+        return '-'.join(key.split('.'))
+
+
+class PartNamer(object):
+    """
+    Build, and remember, the names of a widget's sub-parts, i.e. key__part.
+    """
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.names = {}
+
+    def __call__(self, part):
+        try:
+            return self.names[part]
+        except KeyError:
+            name = self.names[part] = '%s__%s' % (self.prefix, part)
+            return name
+
+
+def partNamer(key):
+    """
+    Return a callable that builds the names of the sub-parts of a widget.
+    """
+    try:
+        return key.partNamer
+    except AttributeError:
+        return PartNamer(key)
+
+
 def keytocssid(fieldKey, *extras):
     return render_cssid(fieldKey, *extras)
 
@@ -37,7 +98,7 @@ def render_cssid(fieldKey, *extras):
     """
     Render the CSS id for the form field's key.
     """
-    l = [tags.slot('formName'), '-', '-'.join(fieldKey.split('.'))]
+    l = [tags.slot('formName'), '-', cssKey(fieldKey)]
     for extra in extras:
         l.append('-')
         l.append(extra)
@@ -45,6 +106,206 @@ def render_cssid(fieldKey, *extras):
 
 
 
+class StringTemplate(object):
+    """
+    A stan template flattened, once, into the static markup around its slots
+    so that filling it costs a few string joins rather than a pass of Nevow's
+    flattener over every tag.
+
+    Only the template's tags and slots are used; render directives, data and
+    other specials are ignored. Slots in attribute values must be filled with
+    strings, which are escaped as Nevow would, and slots elsewhere with
+    anything Nevow can flatten.
+    """
+
+    def __init__(self, template):
+        parts = flat.flatten(_markSlots(template, False)).split('\x00')
+        self.start = parts[0]
+        self.holes = []
+        for name, markup in zip(parts[1::2], parts[2::2]):
+            if name.startswith('@'):
+                self.holes.append((name[1:], True, markup))
+            else:
+                self.holes.append((name, False, markup))
+
+    def fill(self, slots):
+        """
+        Return the template, filled from the slots dict, as a list for Nevow
+        to flatten.
+        """
+        result = []
+        run = [self.start]
+        for name, isAttribute, markup in self.holes:
+            value = slots[name]
+            if isAttribute:
+                run.append(escapeAttribute(value))
+            else:
+                result.append(tags.xml(''.join(run)))
+                result.append(value)
+                run = []
+            run.append(markup)
+        result.append(tags.xml(''.join(run)))
+        return result
+
+
+def _markSlots(obj, isAttribute):
+    """
+    Return a copy of a stan tree with its slots replaced by markers that
+    survive flattening, and without any specials.
+    """
+    if isinstance(obj, stan.slot):
+        if isAttribute:
+            return '\x00@%s\x00' % (obj.name,)
+        return '\x00%s\x00' % (obj.name,)
+    elif isinstance(obj, stan.Tag):
+        attributes = dict([(k, _markSlots(v, True))
+            for k, v in obj.attributes.iteritems()])
+        children = [_markSlots(child, isAttribute) for child in obj.children]
+        return stan.Tag(obj.tagName, attributes, children)
+    elif isinstance(obj, (list, tuple)):
+        return [_markSlots(item, isAttribute) for item in obj]
+    return obj
+
+
+def escapeAttribute(value):
+    """
+    Escape a string for use as an attribute value, exactly as Nevow does.
+    """
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return value.replace('&', '&amp;').replace('<', '&lt;') \
+            .replace('>', '&gt;').replace('"', '&quot;')
+
+
+def escapeText(value):
+    """
+    Escape a string, or number, for use as text, exactly as Nevow does.
+    CannotRenderString is raised for anything else.
+    """
+    return _flatString(value).replace('&', '&amp;').replace('<', '&lt;') \
+            .replace('>', '&gt;')
+
+
+class CannotRenderString(Exception):
+    """
+    Raised by renderTag, and a widget's renderString, for a value that only
+    Nevow's flattener can render, e.g. stan.
+    """
+
+
+# Tags that Nevow closes with ' />' when empty.
+_singletons = frozenset(flatstan.allowSingleton)
+
+
+def renderTag(tagName, attributes, text=None):
+    """
+    Return the markup of a tag exactly as Nevow flattens
+    T.<tagName>(**attributes)[text], or an empty tag if text is None.
+
+    Attributes whose value is None are left out. Attribute values and text
+    must be strings or numbers, otherwise CannotRenderString is raised.
+    """
+    markup = renderStartTag(tagName, attributes)
+    if text is not None:
+        return ''.join((markup, escapeText(text), '</', tagName, '>'))
+    elif tagName in _singletons:
+        return markup[:-1] + ' />'
+    return ''.join((markup, '</', tagName, '>'))
+
+
+def renderStartTag(tagName, attributes):
+    """
+    Return the start tag of renderTag(tagName, attributes), for a tag whose
+    content is rendered separately.
+    """
+    markup = ['<', tagName]
+    for name, value in sorted(attributes.iteritems()):
+        if value is None:
+            continue
+        markup.extend((' ', name, '="', escapeAttribute(_flatString(value)),
+            '"'))
+    markup.append('>')
+    return ''.join(markup)
+
+
+def _flatString(value):
+    if isinstance(value, str):
+        return value
+    elif isinstance(value, unicode):
+        return value.encode('utf-8')
+    elif isinstance(value, (int, long, float)):
+        # Includes bool, which Nevow also renders using str().
+        return str(value)
+    raise CannotRenderString(value)
+
+
+class LRUCache(object):
+    """
+    A cache that holds at most maxSize items, discarding the least recently
+    used item to make room, and optionally discards items that are older than
+    a time-to-live.
+
+    maxSize:
+        The maximum number of items.
+    ttl:
+        The default number of seconds an item is kept for, or None to keep
+        items until they are evicted.
+    clock:
+        A callable returning the current time in seconds, time.time by
+        default.
+    """
+
+    def __init__(self, maxSize=1000, ttl=None, clock=None):
+        self.maxSize = maxSize
+        self.ttl = ttl
+        if clock is None:
+            clock = time.time
+        self.clock = clock
+        self._items = OrderedDict()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, default=None):
+        """
+        Return the item for the key, or default if there is no such item or
+        it has expired.
+        """
+        try:
+            expires, value = self._items.pop(key)
+        except KeyError:
+            return default
+        if expires is not None and expires <= self.clock():
+            return default
+        # Reinsert to mark the item as the most recently used.
+        self._items[key] = (expires, value)
+        return value
+
+    def set(self, key, value, ttl=None):
+        """
+        Store an item, using ttl, if given, rather than the cache's default
+        time-to-live.
+        """
+        if ttl is None:
+            ttl = self.ttl
+        if ttl is None:
+            expires = None
+        else:
+            expires = self.clock() + ttl
+        items = self._items
+        items.pop(key, None)
+        items[key] = (expires, value)
+        while len(items) > self.maxSize:
+            items.popitem(last=False)
+
+    def delete(self, key):
+        self._items.pop(key, None)
+
+    def clear(self):
+        self._items.clear()
+
+
+
 def validIdentifier(name):
     """
     Test that name is a valid Python identifier.
@@ -81,3 +342,214 @@ class LazyResource(object):
         if self._resource is None:
             self._resource = self.factory()
         return self._resource
+
+
+class JSONResource(object):
+    """
+    A resource that renders its data as an uncacheable JSON document.
+    """
+    implements(inevow.IResource)
+
+    def __init__(self, data, code=None):
+        self.data = data
+        self.code = code
+
+    def locateChild(self, ctx, segments):
+        return appserver.NotFound
+
+    def renderHTTP(self, ctx):
+        request = inevow.IRequest(ctx)
+        if self.code is not None:
+            request.setResponseCode(self.code)
+        request.setHeader('content-type', 'application/json; charset=utf-8')
+        request.setHeader('cache-control', 'no-cache')
+        return json.dumps(self.data, separators=(',', ':'))
+
+
+class FileResource(object):
+    """
+    A resource that streams the content of a file-like, in chunks, so that
+    serving a large file does not need to hold it in memory.
+
+    If the size of the content can be found, i.e. the file-like is a real file
+    or is seekable, the Content-Length is sent and a single byte range can be
+    requested. The file-like is closed once it has been sent.
+    """
+    implements(inevow.IResource)
+
+    def __init__(self, filelike, mimetype=None, size=None):
+        self.filelike = filelike
+        self.mimetype = mimetype or 'application/octet-stream'
+        if size is None:
+            size = _contentSize(filelike)
+        self.size = size
+
+    def locateChild(self, ctx, segments):
+        return appserver.NotFound
+
+    def renderHTTP(self, ctx):
+        request = inevow.IRequest(ctx)
+        filelike, size = self.filelike, self.size
+        request.setHeader('content-type', self.mimetype)
+
+        length = size
+        if size is not None:
+            request.setHeader('accept-ranges', 'bytes')
+            byteRange = _parseRange(request.getHeader('range'), size)
+            if byteRange is _unsatisfiable:
+                filelike.close()
+                request.setResponseCode(416)
+                request.setHeader('content-range', 'bytes */%d' % (size,))
+                return ''
+            if byteRange is not None:
+                start, end = byteRange
+                filelike.seek(start)
+                length = end - start + 1
+                request.setResponseCode(206)
+                request.setHeader('content-range', 'bytes %d-%d/%d' %
+                        (start, end, size))
+            request.setHeader('content-length', str(length))
+
+        if request.method == 'HEAD':
+            filelike.close()
+            return ''
+        return _FileProducer(filelike, length, request).deferred
+
+
+class _FileProducer(object):
+    """
+    Write a file-like, or length bytes of it, to the request a chunk at a time
+    as the transport asks for more. The deferred fires once it is done.
+    """
+    implements(IPullProducer)
+
+    chunkSize = 64 * 1024
+
+    def __init__(self, filelike, length, request):
+        self.filelike = filelike
+        self.remaining = length
+        self.request = request
+        self.deferred = defer.Deferred()
+        request.registerProducer(self, False)
+
+    def resumeProducing(self):
+        if self.request is None:
+            return
+        size = self.chunkSize
+        if self.remaining is not None:
+            size = min(size, self.remaining)
+        data = size and self.filelike.read(size)
+        if data:
+            self.request.write(data)
+            if self.remaining is not None:
+                self.remaining -= len(data)
+        if not data or self.remaining == 0:
+            self.request.unregisterProducer()
+            self._done()
+
+    def stopProducing(self):
+        self._done()
+
+    def _done(self):
+        if self.request is None:
+            return
+        self.request = None
+        self.filelike.close()
+        self.deferred.callback('')
+
+
+_unsatisfiable = object()
+
+
+def _parseRange(header, size):
+    """
+    Parse a Range header against content of the given size, returning an
+    inclusive (start, end) tuple, _unsatisfiable or None if the whole content
+    should be sent, i.e. there is no header or it cannot be handled.
+    """
+    if not header:
+        return None
+    try:
+        unit, spec = header.split('=', 1)
+    except ValueError:
+        return None
+    if unit.strip().lower() != 'bytes' or ',' in spec:
+        # Multiple ranges are allowed to be answered with the whole content.
+        return None
+    try:
+        start, end = [part.strip() for part in spec.split('-', 1)]
+        if not start:
+            # The last end bytes.
+            length = int(end)
+            if length <= 0:
+                return _unsatisfiable
+            start, end = max(size - length, 0), size - 1
+        else:
+            start = int(start)
+            if end:
+                end = min(int(end), size - 1)
+            else:
+                end = size - 1
+    except ValueError:
+        return None
+    if start >= size or start > end:
+        return _unsatisfiable
+    return start, end
+
+
+def _contentSize(filelike):
+    """
+    Return the number of bytes left to read from a file-like, or None if that
+    cannot be found without reading it.
+    """
+    try:
+        size = os.fstat(filelike.fileno()).st_size
+        return size - filelike.tell()
+    except (AttributeError, IOError, OSError, ValueError):
+        pass
+    try:
+        position = filelike.tell()
+        filelike.seek(0, 2)
+        size = filelike.tell()
+        filelike.seek(position)
+        return size - position
+    except (AttributeError, IOError, ValueError):
+        return None
+
+
+# Leading bytes of common file formats and their MIME types. Formats that
+# can be recognised this way are worth checking, by content rather than by
+# name, before a file is accepted, e.g. executables.
+_MAGIC = [
+    ('\x89PNG\r\n\x1a\n', 'image/png'),
+    ('\xff\xd8\xff', 'image/jpeg'),
+    ('GIF87a', 'image/gif'),
+    ('GIF89a', 'image/gif'),
+    ('II*\x00', 'image/tiff'),
+    ('MM\x00*', 'image/tiff'),
+    ('%PDF-', 'application/pdf'),
+    ('PK\x03\x04', 'application/zip'),
+    ('\x1f\x8b', 'application/x-gzip'),
+    ('MZ', 'application/x-msdownload'),
+    ('\x7fELF', 'application/x-executable'),
+    ('\xca\xfe\xba\xbe', 'application/x-mach-binary'),
+    ('\xce\xfa\xed\xfe', 'application/x-mach-binary'),
+    ('\xcf\xfa\xed\xfe', 'application/x-mach-binary'),
+    ('#!', 'application/x-sh'),
+    ]
+
+# The number of leading bytes sniffMimeType needs.
+SNIFF_BYTES = 16
+
+
+def sniffMimeType(data):
+    """
+    Return the MIME type of a file from its first SNIFF_BYTES bytes, or None
+    if the format is not recognised.
+    """
+    for magic, mimetype in _MAGIC:
+        if data.startswith(magic):
+            return mimetype
+    if data.startswith('RIFF') and data[8:12] == 'WEBP':
+        return 'image/webp'
+    return None
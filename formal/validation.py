@@ -1,6 +1,12 @@
+import copy
+import mimetypes
+import os.path
 import re
 from zope.interface import implements
+from twisted.internet import defer
+from twisted.python import failure
 from formal import iformal
+from formal.util import LRUCache, SNIFF_BYTES, sniffMimeType, _contentSize
 
 
 class FormsError(Exception):
@@ -51,6 +57,7 @@ class FieldRequiredError(FieldValidationError):
     
 class RequiredValidator(object):
     implements(iformal.IValidator)
+    synchronous = True
     
     def validate(self, field, value):
         if value is None:
@@ -61,6 +68,7 @@ class LengthValidator(object):
     """Validate the length of the value is within a given range. 
     """
     implements(iformal.IValidator)
+    synchronous = True
     
     def __init__(self, min=None, max=None):
         self.min = min
@@ -88,6 +96,7 @@ class RangeValidator(object):
     """Validate the size of the value is within is given range.
     """
     implements(iformal.IValidator)
+    synchronous = True
     
     def __init__(self, min=None, max=None):
         self.min = min
@@ -117,6 +126,7 @@ class PatternValidator(object):
     compiled automatically if necessary.
     """
     implements(iformal.IValidator)
+    synchronous = True
     
     def __init__(self, regex):
         self.regex = regex
@@ -132,6 +142,111 @@ class PatternValidator(object):
 
 
 
+class FileValidator(object):
+    """Validate an uploaded file's size and type.
+
+    The value is a (mimetype, filelike, fileName) tuple, as produced by
+    FileUploadWidget, or a (fileName, filelike) tuple, as produced by
+    FileUploadRaw.
+
+    maxBytes:
+        The largest file allowed, in bytes.
+    mimeTypes:
+        The MIME types allowed. A type may end with '/*' to allow any subtype,
+        e.g. 'image/*'.
+    extensions:
+        The file name extensions allowed, e.g. ['.png', '.jpg'].
+
+    The type of the file is found from its content when it is a recognised
+    format, see formal.util.sniffMimeType, so that the name cannot be used to
+    disguise, say, an executable as an image. Otherwise the type is guessed
+    from the file name, falling back to the type the browser sent. Archives
+    are typed by name, so that zip based formats, e.g. OpenDocument, can be
+    allowed.
+    """
+    implements(iformal.IValidator)
+    synchronous = True
+
+    # Formats that other formats are built on.
+    containerTypes = ('application/zip',)
+
+    def __init__(self, maxBytes=None, mimeTypes=None, extensions=None):
+        self.maxBytes = maxBytes
+        self.mimeTypes = mimeTypes
+        if extensions is not None:
+            extensions = [e.lower() for e in extensions]
+        self.extensions = extensions
+        assert maxBytes is not None or mimeTypes is not None or \
+                extensions is not None
+
+    def validate(self, field, value):
+        if value is None:
+            return
+        if len(value) == 2:
+            (fileName, filelike), mimetype = value, None
+        else:
+            mimetype, filelike, fileName = value
+        if filelike is None or not fileName:
+            # Nothing uploaded.
+            return
+        if self.extensions is not None:
+            extension = os.path.splitext(fileName or '')[1].lower()
+            if extension not in self.extensions:
+                raise FieldValidationError, 'File type is not allowed'
+        if self.maxBytes is not None:
+            size = _fileSize(filelike)
+            if size is not None and size > self.maxBytes:
+                raise FieldValidationError, \
+                        'Must be smaller than %r bytes'%(self.maxBytes,)
+        if self.mimeTypes is not None:
+            if not self._allowed(self.fileType(mimetype, filelike, fileName)):
+                raise FieldValidationError, 'File type is not allowed'
+
+    def fileType(self, mimetype, filelike, fileName):
+        """
+        Return the MIME type of the file, see the class docstring.
+        """
+        guessed = mimetypes.guess_type(fileName or '')[0] or mimetype
+        sniffed = _sniffFile(filelike)
+        if sniffed is None or (sniffed in self.containerTypes and guessed):
+            return guessed
+        return sniffed
+
+    def _allowed(self, mimetype):
+        if mimetype is None:
+            return False
+        for allowed in self.mimeTypes:
+            if allowed == mimetype or (allowed.endswith('/*') and
+                    mimetype.startswith(allowed[:-1])):
+                return True
+        return False
+
+
+def _fileSize(filelike):
+    """
+    Return the size of a whole file-like, or None if it cannot be found.
+    """
+    try:
+        filelike.seek(0)
+    except (AttributeError, IOError, ValueError):
+        return None
+    return _contentSize(filelike)
+
+
+def _sniffFile(filelike):
+    """
+    Sniff the type of a file-like from its first bytes, leaving it positioned
+    at the start.
+    """
+    try:
+        filelike.seek(0)
+        data = filelike.read(SNIFF_BYTES)
+        filelike.seek(0)
+    except (AttributeError, IOError, ValueError):
+        return None
+    return sniffMimeType(data)
+
+
 class CallableValidator(object):
     """
     A validator that delegates the validation of non-None values to a callable
@@ -148,13 +263,173 @@ class CallableValidator(object):
     def validate(self, field, value):
         if value is None:
             return
-        self.callable(field, value)
-        
-            
-    
+        return self.callable(field, value)
+
+
+class ValidatorCache(object):
+    """
+    A cache of validator outcomes, keyed by validator and value, for validators
+    that are expensive to run, e.g. because they do remote lookups.
+
+    A cache is assigned to a form using the form's validatorCache attribute and
+    applies to the form's validators that have a true cacheable attribute. Any
+    validator can also be wrapped in a CachingValidator.
+
+    A validator with a cacheKey attribute, a hashable value that identifies
+    what it checks, e.g. the table a lookup searches, is known by its class
+    and cacheKey. Outcomes are then shared by all such validators, including
+    those of forms that are made for each request. Any other validator is
+    known by the instance itself, so only a validator that is shared, e.g. by
+    the forms of a FormSchema, benefits, and it is kept alive until its
+    outcomes are discarded.
+
+    maxSize:
+        The maximum number of outcomes remembered. The least recently used
+        outcome is discarded to make room.
+    ttl:
+        The number of seconds a successful outcome is remembered for, or None
+        to remember it until it is discarded.
+    negativeTTL:
+        The number of seconds a FieldError is remembered for, defaults to ttl.
+        Use 0 to not remember failures. Any other exception is never
+        remembered.
+    clock:
+        A callable returning the current time in seconds, time.time by
+        default.
+
+    Values that cannot be hashed, e.g. lists, are always validated. Identical
+    checks made while the first is still running wait for its outcome rather
+    than running again.
+    """
+
+    implements(iformal.IValidatorCache)
+
+    def __init__(self, maxSize=1000, ttl=300, negativeTTL=None, clock=None):
+        self.cache = LRUCache(maxSize, ttl, clock)
+        if negativeTTL is None:
+            negativeTTL = ttl
+        self.negativeTTL = negativeTTL
+        self.pending = {}
+        self.hits = 0
+        self.misses = 0
+
+    def validate(self, validator, field, value, scheduler=None):
+        """
+        Validate the value, using a remembered outcome if there is one. On a
+        miss the validator is called via the scheduler, if given.
+        """
+        key = (_validatorKey(validator), value)
+        try:
+            outcome = self.cache.get(key, _missing)
+        except TypeError:
+            # Unhashable value.
+            return self._call(validator, field, value, scheduler)
+        if outcome is not _missing:
+            self.hits += 1
+            return _replay(outcome)
+        waiters = self.pending.get(key)
+        if waiters is not None:
+            self.hits += 1
+            d = defer.Deferred().addCallback(_replay)
+            waiters.append(d)
+            return d
+
+        self.misses += 1
+        try:
+            result = self._call(validator, field, value, scheduler)
+        except FieldError, e:
+            self._remember(key, copy.copy(e))
+            raise
+        if not isinstance(result, defer.Deferred):
+            self._remember(key, None)
+            return result
+        self.pending[key] = []
+        return result.addBoth(self._cbValidated, key)
+
+    def clear(self):
+        """
+        Forget all remembered outcomes.
+        """
+        self.cache.clear()
+
+    def _call(self, validator, field, value, scheduler):
+        if scheduler is None:
+            return validator.validate(field, value)
+        return scheduler.schedule(validator, field, value)
+
+    def _cbValidated(self, result, key):
+        waiters = self.pending.pop(key)
+        if isinstance(result, failure.Failure):
+            if not result.check(FieldError):
+                # Not an outcome of validation; pass it on but don't keep it.
+                for d in waiters:
+                    d.errback(result)
+                return result
+            outcome = copy.copy(result.value)
+            self._remember(key, outcome)
+        else:
+            outcome = None
+            self._remember(key, outcome)
+        for d in waiters:
+            d.callback(outcome)
+        return result
+
+    def _remember(self, key, outcome):
+        if outcome is None:
+            self.cache.set(key, outcome)
+        elif self.negativeTTL != 0:
+            self.cache.set(key, outcome, self.negativeTTL)
+
+
+class CachingValidator(object):
+    """
+    A validator that remembers the outcomes of another validator using a
+    ValidatorCache, a new one with the default limits if not given.
+
+    Any attribute not defined here, e.g. the cost or priority used by a
+    ValidationScheduler, is taken from the wrapped validator.
+    """
+
+    implements(iformal.IValidator)
+
+    def __init__(self, validator, cache=None):
+        if cache is None:
+            cache = ValidatorCache()
+        self.validator = validator
+        self.cache = cache
+
+    def __getattr__(self, name):
+        if name.startswith('__') or name == 'validator':
+            raise AttributeError(name)
+        return getattr(self.validator, name)
+
+    def validate(self, field, value):
+        return self.cache.validate(self.validator, field, value)
+
+
+_missing = object()
+
+
+def _validatorKey(validator):
+    cacheKey = getattr(validator, 'cacheKey', None)
+    if cacheKey is None:
+        return validator
+    return (validator.__class__, cacheKey)
+
+
+def _replay(outcome):
+    """
+    Reproduce a remembered outcome. A fresh copy of a remembered error is
+    raised so that it can be updated, e.g. with a field name, without affecting
+    the cached copy.
+    """
+    if outcome is not None:
+        raise copy.copy(outcome)
+
+
 __all__ = [
     'FormError', 'FieldError', 'FieldValidationError', 'FieldRequiredError',
     'RequiredValidator', 'LengthValidator', 'RangeValidator', 'PatternValidator',
-    'CallableValidator',
+    'FileValidator', 'CallableValidator', 'ValidatorCache', 'CachingValidator',
     ]
 
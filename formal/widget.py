@@ -4,13 +4,18 @@ certain format.
 """
 
 import itertools
-from nevow import inevow, loaders, tags as T, util, url, static, rend
+from nevow import appserver, inevow, loaders, tags as T, util, url, rend
 from nevow.i18n import _
 from formal import converters, iformal, validation
-from formal.util import render_cssid
-from formal.form import widgetResourceURL, widgetResourceURLFromContext
+from formal.util import render_cssid, partNamer, FileResource, JSONResource, \
+        renderTag, renderStartTag, CannotRenderString
+from formal.options import OptionSet, OptionSource, convertOptions
+from formal.form import widgetResourceURL, widgetResourceURLFromContext, \
+        _validationContext
+from formal.resourcemanager import fileNameFromResourceId, UploadOffsetError
 from zope.interface import implements
 from twisted.internet import defer
+from twisted.python import context as pycontext
 
 
 # Marker object for args that are not supplied
@@ -25,35 +30,50 @@ class TextInput(object):
     """
     implements( iformal.IWidget )
 
+    # The markup only depends on the form's data, see RenderCache.
+    cacheable = True
+
     inputType = 'text'
     showValueOnFailure = True
 
     def __init__(self, original):
         self.original = original
 
-    def _renderTag(self, ctx, key, value, readonly):
-        tag=T.input(type=self.inputType, name=key, id=render_cssid(key), value=value)
+    def _attributes(self, key, cssid, value, readonly):
+        attributes = {'type': self.inputType, 'name': key, 'id': cssid,
+                'value': value}
         if readonly:
-            tag(class_='readonly', readonly='readonly')
-        return tag
+            attributes.update({'class': 'readonly', 'readonly': 'readonly'})
+        return attributes
 
-    def render(self, ctx, key, args, errors):
-        if errors:
+    def _renderTag(self, ctx, key, value, readonly):
+        return T.input(**self._attributes(key, render_cssid(key), value, readonly))
+
+    def _value(self, key, args, errors, immutable):
+        if errors and not immutable:
             value = args.get(key, [''])[0]
         else:
             value = iformal.IStringConvertible(self.original).fromType(args.get(key))
-        if not self.showValueOnFailure:
+        if not self.showValueOnFailure and not immutable:
             value = None
+        return value
+
+    def render(self, ctx, key, args, errors):
+        value = self._value(key, args, errors, False)
         return self._renderTag(ctx, key, value, False)
 
     def renderImmutable(self, ctx, key, args, errors):
-        value = iformal.IStringConvertible(self.original).fromType(args.get(key))
+        value = self._value(key, args, errors, True)
         return self._renderTag(ctx, key, value, True)
 
+    def renderString(self, ctx, key, args, errors, cssid, immutable=False):
+        value = self._value(key, args, errors, immutable)
+        return renderTag('input', self._attributes(key, cssid, value, immutable))
+
     def processInput(self, ctx, key, args):
         value = args.get(key, [''])[0].decode(util.getPOSTCharset(ctx))
         value = iformal.IStringConvertible(self.original).toType(value)
-        return self.original.validate(value)
+        return self.original.check(value)
 
 
 class Checkbox(object):
@@ -64,34 +84,46 @@ class Checkbox(object):
     """
     implements( iformal.IWidget )
 
+    cacheable = True
+
     def __init__(self, original):
         self.original = original
 
-    def _renderTag(self, ctx, key, value, disabled):
-        tag = T.input(type='checkbox', name=key, id=render_cssid(key), value='True')
+    def _attributes(self, key, cssid, value, disabled):
+        attributes = {'type': 'checkbox', 'name': key, 'id': cssid,
+                'value': 'True'}
         if value == 'True':
-            tag(checked='checked')
+            attributes['checked'] = 'checked'
         if disabled:
-            tag(class_='disabled', disabled='disabled')
-        return tag
+            attributes.update({'class': 'disabled', 'disabled': 'disabled'})
+        return attributes
+
+    def _renderTag(self, ctx, key, value, disabled):
+        return T.input(**self._attributes(key, render_cssid(key), value, disabled))
+
+    def _value(self, key, args, errors, immutable):
+        if errors and not immutable:
+            return args.get(key, [''])[0]
+        return iformal.IBooleanConvertible(self.original).fromType(args.get(key))
 
     def render(self, ctx, key, args, errors):
-        if errors:
-            value = args.get(key, [''])[0]
-        else:
-            value = iformal.IBooleanConvertible(self.original).fromType(args.get(key))
+        value = self._value(key, args, errors, False)
         return self._renderTag(ctx, key, value, False)
 
     def renderImmutable(self, ctx, key, args, errors):
-        value = iformal.IBooleanConvertible(self.original).fromType(args.get(key))
+        value = self._value(key, args, errors, True)
         return self._renderTag(ctx, key, value, True)
 
+    def renderString(self, ctx, key, args, errors, cssid, immutable=False):
+        value = self._value(key, args, errors, immutable)
+        return renderTag('input', self._attributes(key, cssid, value, immutable))
+
     def processInput(self, ctx, key, args):
         value = args.get(key, [None])[0]
         if not value:
             value = 'False'
         value = iformal.IBooleanConvertible(self.original).toType(value)
-        return self.original.validate(value)
+        return self.original.check(value)
 
 
 class Password(TextInput):
@@ -112,6 +144,8 @@ class TextArea(object):
     """
     implements( iformal.IWidget )
 
+    cacheable = True
+
     cols = 48
     rows = 6
 
@@ -122,27 +156,38 @@ class TextArea(object):
         if rows is not None:
             self.rows = rows
 
-    def _renderTag(self, ctx, key, value, readonly):
-        tag=T.textarea(name=key, id=render_cssid(key), cols=self.cols, rows=self.rows)[value or '']
+    def _attributes(self, key, cssid, readonly):
+        attributes = {'name': key, 'id': cssid, 'cols': self.cols,
+                'rows': self.rows}
         if readonly:
-            tag(class_='readonly', readonly='readonly')
-        return tag
+            attributes.update({'class': 'readonly', 'readonly': 'readonly'})
+        return attributes
+
+    def _renderTag(self, ctx, key, value, readonly):
+        return T.textarea(**self._attributes(key, render_cssid(key), readonly))[value or '']
+
+    def _value(self, key, args, errors, immutable):
+        if errors and not immutable:
+            return args.get(key, [''])[0]
+        return iformal.IStringConvertible(self.original).fromType(args.get(key))
 
     def render(self, ctx, key, args, errors):
-        if errors:
-            value = args.get(key, [''])[0]
-        else:
-            value = iformal.IStringConvertible(self.original).fromType(args.get(key))
+        value = self._value(key, args, errors, False)
         return self._renderTag(ctx, key, value, False)
 
     def renderImmutable(self, ctx, key, args, errors):
-        value = iformal.IStringConvertible(self.original).fromType(args.get(key))
+        value = self._value(key, args, errors, True)
         return self._renderTag(ctx, key, value, True)
 
+    def renderString(self, ctx, key, args, errors, cssid, immutable=False):
+        value = self._value(key, args, errors, immutable)
+        return renderTag('textarea', self._attributes(key, cssid, immutable),
+                value or '')
+
     def processInput(self, ctx, key, args):
         value = args.get(key, [''])[0].decode(util.getPOSTCharset(ctx))
         value = iformal.IStringConvertible(self.original).fromType(value)
-        return self.original.validate(value)
+        return self.original.check(value)
 
 
 class TextAreaList(object):
@@ -152,6 +197,8 @@ class TextAreaList(object):
     """
     implements( iformal.IWidget )
 
+    cacheable = True
+
     cols = 48
     rows = 6
 
@@ -203,7 +250,7 @@ class TextAreaList(object):
         converter = iformal.IStringConvertible(self.original.type)
         values = [converter.toType(v) for v in values]
         # Validate and return
-        return self.original.validate(values)
+        return self.original.check(values)
 
 
 class CheckedPassword(object):
@@ -212,6 +259,8 @@ class CheckedPassword(object):
     """
     implements( iformal.IWidget )
 
+    cacheable = True
+
     def __init__(self, original):
         self.original = original
 
@@ -239,7 +288,22 @@ class CheckedPassword(object):
 
     def processInput(self, ctx, key, args):
         charset = util.getPOSTCharset(ctx)
-        pwds = [pwd.decode(charset) for pwd in args.get(key, [])]
+        return self._check([pwd.decode(charset) for pwd in args.get(key, [])])
+
+    def processRecordValue(self, value):
+        # The password and its confirmation, as a list of two strings.
+        if value is None:
+            pwds = []
+        elif isinstance(value, (list, tuple)):
+            pwds = list(value)
+        else:
+            pwds = [value]
+        for pwd in pwds:
+            if not isinstance(pwd, basestring):
+                raise validation.FieldValidationError('Invalid value')
+        return self._check(pwds)
+
+    def _check(self, pwds):
         if len(pwds) == 0:
             pwd = ''
         elif len(pwds) == 1:
@@ -247,7 +311,8 @@ class CheckedPassword(object):
         else:
             if pwds[0] != pwds[1]:
                 raise validation.FieldValidationError('Passwords do not match.')
-        return self.original.validate(pwds[0])
+            pwd = pwds[0]
+        return self.original.check(pwd)
 
 
 class ChoiceBase(object):
@@ -258,7 +323,10 @@ class ChoiceBase(object):
     options:
         A sequence of objects adaptable to IKey and ILabel. IKey is used as the
         <option>'s value attribute; ILabel is used as the <option>'s child.
-        IKey and ILabel adapters for tuple are provided.
+        IKey and ILabel adapters for tuple are provided. An OptionSet is
+        prepared once, rather than on every render, and only its options are
+        accepted as input. An OptionSource provides an OptionSet shared by
+        all the widgets using the source.
     noneOption:
         An object adaptable to IKey and ILabel that is used to identify when
         nothing has been selected.
@@ -277,11 +345,62 @@ class ChoiceBase(object):
     def processInput(self, ctx, key, args):
         charset = util.getPOSTCharset(ctx)
         value = args.get(key, [''])[0].decode(charset)
-        value = iformal.IStringConvertible(self.original).toType(value)
+        return self._process(
+                iformal.IStringConvertible(self.original).toType(value))
+
+    def processRecordValue(self, value):
+        """
+        Convert and validate a value of a record, e.g. of a JSON body, as
+        processInput does the request's input.
+        """
+        return self._process(converters.convertRecordValue(value,
+            iformal.IStringConvertible(self.original)))
+
+    def _process(self, value):
         if self.noneOption is not None and \
                 value == iformal.IKey(self.noneOption).key():
             value = None
-        return self.original.validate(value)
+        options = self.options
+        if value is not None and isinstance(options, OptionSource):
+            options = options.getOptions()
+            if isinstance(options, defer.Deferred):
+                return options.addCallback(self._check, value)
+        return self._check(options, value)
+
+    def _check(self, options, value):
+        if value is not None and isinstance(options, OptionSet) and \
+                not options.hasKey(value):
+            raise validation.FieldValidationError('Invalid choice')
+        return self.original.check(value)
+
+    def _value(self, converter, key, args, errors, immutable):
+        if errors and not immutable:
+            return args.get(key, [''])[0]
+        return converter.fromType(args.get(key))
+
+    def _noneOption(self):
+        return (iformal.IKey(self.noneOption).key(),
+                iformal.ILabel(self.noneOption).label())
+
+    def _currentOptions(self):
+        """
+        Return the options, for renderString. The options must be a plain
+        sequence or an OptionSource that has loaded its options; anything that
+        Nevow would need to resolve, e.g. a callable or a Deferred, cannot be
+        rendered to a string.
+        """
+        options = self.options
+        if isinstance(options, OptionSource):
+            options = options.getOptions()
+        if options is not None and \
+                not isinstance(options, (list, tuple, OptionSet)):
+            raise CannotRenderString(options)
+        return options
+
+    def _iterOptions(self, options, converter):
+        if options is None:
+            return iter(())
+        return convertOptions(options, converter)
 
 
 class SelectChoice(ChoiceBase):
@@ -295,6 +414,8 @@ class SelectChoice(ChoiceBase):
     """
     implements( iformal.IWidget )
 
+    cacheable = True
+
     noneOption = ('', '')
 
     def _renderTag(self, ctx, key, value, converter, disabled):
@@ -304,10 +425,13 @@ class SelectChoice(ChoiceBase):
                 yield T.option(value=iformal.IKey(self.noneOption).key())[iformal.ILabel(self.noneOption).label()]
             if data is None:
                 return
-            for item in data:
-                optValue = iformal.IKey(item).key()
-                optLabel = iformal.ILabel(item).label()
-                optValue = converter.fromType(optValue)
+            if isinstance(data, OptionSet):
+                try:
+                    yield T.xml(data.converted(converter).renderOptions(value))
+                    return
+                except CannotRenderString:
+                    pass
+            for optValue, optLabel in convertOptions(data, converter):
                 option = T.option(value=optValue)[optLabel]
                 if optValue == value:
                     option = option(selected='selected')
@@ -320,17 +444,37 @@ class SelectChoice(ChoiceBase):
 
     def render(self, ctx, key, args, errors):
         converter = iformal.IStringConvertible(self.original)
-        if errors:
-            value = args.get(key, [''])[0]
-        else:
-            value = converter.fromType(args.get(key))
+        value = self._value(converter, key, args, errors, False)
         return self._renderTag(ctx, key, value, converter, False)
 
     def renderImmutable(self, ctx, key, args, errors):
         converter = iformal.IStringConvertible(self.original)
-        value = converter.fromType(args.get(key))
+        value = self._value(converter, key, args, errors, True)
         return self._renderTag(ctx, key, value, converter, True)
 
+    def renderString(self, ctx, key, args, errors, cssid, immutable=False):
+        converter = iformal.IStringConvertible(self.original)
+        value = self._value(converter, key, args, errors, immutable)
+        attributes = {'name': key, 'id': cssid}
+        if immutable:
+            attributes.update({'class': 'disabled', 'disabled': 'disabled'})
+        markup = [renderStartTag('select', attributes)]
+        # The none option is never marked as selected.
+        if self.noneOption is not None:
+            optValue, optLabel = self._noneOption()
+            markup.append(renderTag('option', {'value': optValue}, optLabel))
+        options = self._currentOptions()
+        if isinstance(options, OptionSet):
+            markup.append(options.converted(converter).renderOptions(value))
+        else:
+            for optValue, optLabel in self._iterOptions(options, converter):
+                option = {'value': optValue}
+                if optValue == value:
+                    option['selected'] = 'selected'
+                markup.append(renderTag('option', option, optLabel))
+        markup.append('</select>')
+        return ''.join(markup)
+
 
 class SelectOtherChoice(object):
     """
@@ -346,6 +490,8 @@ class SelectOtherChoice(object):
     """
     implements(iformal.IWidget)
 
+    cacheable = True
+
     options = None
     noneOption = ('', '')
     otherOption = ('...', 'Other ...')
@@ -442,7 +588,7 @@ class SelectOtherChoice(object):
         value = iformal.IStringConvertible(self.original).toType(value)
         if self.noneOption is not None and value == iformal.IKey(self.noneOption).key():
             value = None
-        return self.original.validate(value)
+        return self.original.check(value)
 
 
 class RadioChoice(ChoiceBase):
@@ -453,6 +599,8 @@ class RadioChoice(ChoiceBase):
     """
     implements( iformal.IWidget )
 
+    cacheable = True
+
     def _renderTag(self, ctx, key, value, converter, disabled):
 
         def renderOption(ctx, itemKey, itemLabel, num, selected):
@@ -473,27 +621,51 @@ class RadioChoice(ChoiceBase):
                 yield renderOption(ctx, itemKey, itemLabel, idCounter.next(), itemKey==value)
             if not data:
                 return
-            for item in data:
-                itemKey = iformal.IKey(item).key()
-                itemLabel = iformal.ILabel(item).label()
-                itemKey = converter.fromType(itemKey)
+            for itemKey, itemLabel in convertOptions(data, converter):
                 yield renderOption(ctx, itemKey, itemLabel, idCounter.next(), itemKey==value)
 
         return T.invisible(data=self.options)[renderOptions]
 
     def render(self, ctx, key, args, errors):
         converter = iformal.IStringConvertible(self.original)
-        if errors:
-            value = args.get(key, [''])[0]
-        else:
-            value = converter.fromType(args.get(key))
+        value = self._value(converter, key, args, errors, False)
         return self._renderTag(ctx, key, value, converter, False)
 
     def renderImmutable(self, ctx, key, args, errors):
         converter = iformal.IStringConvertible(self.original)
-        value = converter.fromType(args.get(key))
+        value = self._value(converter, key, args, errors, True)
         return self._renderTag(ctx, key, value, converter, True)
 
+    def renderString(self, ctx, key, args, errors, cssid, immutable=False):
+        converter = iformal.IStringConvertible(self.original)
+        value = self._value(converter, key, args, errors, immutable)
+        current = self._currentOptions()
+        options = self._iterOptions(current, converter)
+        if self.noneOption is not None:
+            options = itertools.chain([self._noneOption()], options)
+        if isinstance(current, OptionSet):
+            # Only the none option, if any, is rendered below.
+            first = int(self.noneOption is not None)
+            radios = current.converted(converter).renderRadios(key,
+                    cssid, value, immutable, first)
+            options = itertools.islice(options, first)
+        else:
+            radios = ''
+        markup = []
+        for num, (itemKey, itemLabel) in enumerate(options):
+            optionid = '%s-%d' % (cssid, num)
+            attributes = {'name': key, 'type': 'radio', 'id': optionid,
+                    'value': itemKey}
+            if itemKey == value:
+                attributes['checked'] = 'checked'
+            if immutable:
+                attributes['disabled'] = 'disabled'
+            markup.extend(('<div class="radiobutton">',
+                renderTag('input', attributes),
+                renderTag('label', {'for': optionid}, itemLabel), '</div>'))
+        markup.append(radios)
+        return ''.join(markup)
+
 
 class DatePartsSelect(object):
     """
@@ -511,6 +683,8 @@ class DatePartsSelect(object):
     """    
     implements( iformal.IWidget )
 
+    cacheable = True
+
     dayFirst = False
     days = [ (d,d) for d in xrange(1,32) ]
     months = [ (m,m) for m in xrange(1,13) ]
@@ -532,9 +706,7 @@ class DatePartsSelect(object):
             self.noneOption = noneOption
 
     def _namer(self, prefix):
-        def _(part):
-            return '%s__%s' % (prefix,part)
-        return _
+        return partNamer(prefix)
 
     def _renderTag(self, ctx, year, month, day, namer, readonly):
         years = [(v,v) for v in xrange(self.yearFrom,self.yearTo)]
@@ -618,7 +790,7 @@ class DatePartsSelect(object):
             except ValueError, e:
                 raise validation.FieldValidationError("Invalid date")
         ymd = iformal.IDateTupleConvertible(self.original).toType(ymd)
-        return self.original.validate(ymd)
+        return self.original.check(ymd)
     
     
 class DatePartsInput(object):
@@ -651,6 +823,8 @@ class DatePartsInput(object):
     """
     implements( iformal.IWidget )
 
+    cacheable = True
+
     dayFirst = False
     twoCharCutoffYear = None
 
@@ -662,42 +836,55 @@ class DatePartsInput(object):
             self.twoCharCutoffYear = twoCharCutoffYear
 
     def _namer(self, prefix):
-        def _(part):
-            return '%s__%s' % (prefix,part)
-        return _
+        return partNamer(prefix)
 
-    def _renderTag(self, ctx, year, month, day, namer, readonly):
-        yearTag = T.input(type="text", name=namer('year'), value=year, size=4)
-        monthTag = T.input(type="text", name=namer('month'), value=month, size=2)
-        dayTag = T.input(type="text", name=namer('day'), value=day, size=2)
+    def _attributes(self, year, month, day, namer, readonly):
+        attributes = [
+            {'type': 'text', 'name': namer('year'), 'value': year, 'size': 4},
+            {'type': 'text', 'name': namer('month'), 'value': month, 'size': 2},
+            {'type': 'text', 'name': namer('day'), 'value': day, 'size': 2},
+            ]
         if readonly:
-            tags = (yearTag, monthTag, dayTag)
-            for tag in tags:
-                tag(class_='readonly', readonly='readonly')
+            for attrs in attributes:
+                attrs.update({'class': 'readonly', 'readonly': 'readonly'})
+        return attributes
 
+    def _arrange(self, yearTag, monthTag, dayTag):
         if self.dayFirst:
             return dayTag, ' / ', monthTag, ' / ', yearTag, ' ', _('(day/month/year)')
         else:
             return monthTag, ' / ', dayTag, ' / ', yearTag, ' ', _('(month/day/year)')
 
+    def _renderTag(self, ctx, year, month, day, namer, readonly):
+        yearTag, monthTag, dayTag = [T.input(**attrs) for attrs in
+                self._attributes(year, month, day, namer, readonly)]
+        return self._arrange(yearTag, monthTag, dayTag)
+
+    def _value(self, key, args, errors, namer, immutable):
+        if errors and not immutable:
+            return [args.get(namer(part), [''])[0]
+                    for part in ('year', 'month', 'day')]
+        return iformal.IDateTupleConvertible(self.original).fromType(args.get(key))
+
     def render(self, ctx, key, args, errors):
-        converter = iformal.IDateTupleConvertible(self.original)
         namer = self._namer(key)
-        if errors:
-            year = args.get(namer('year'), [''])[0]
-            month = args.get(namer('month'), [''])[0]
-            day = args.get(namer('day'), [''])[0]
-        else:
-            year, month, day = converter.fromType(args.get(key))
-
+        year, month, day = self._value(key, args, errors, namer, False)
         return self._renderTag(ctx, year, month, day, namer, False)
 
     def renderImmutable(self, ctx, key, args, errors):
-        converter = iformal.IDateTupleConvertible(self.original)
         namer = self._namer(key)
-        year, month, day = converter.fromType(args.get(key))
+        year, month, day = self._value(key, args, errors, namer, True)
         return self._renderTag(ctx, year, month, day, namer, True)
 
+    def renderString(self, ctx, key, args, errors, cssid, immutable=False):
+        namer = self._namer(key)
+        year, month, day = self._value(key, args, errors, namer, immutable)
+        yearTag, monthTag, dayTag = [renderTag('input', attrs) for attrs in
+                self._attributes(year, month, day, namer, immutable)]
+        # The format hint is left to Nevow so that it is still translated.
+        parts = self._arrange(yearTag, monthTag, dayTag)
+        return [T.xml(''.join(parts[:-1])), parts[-1]]
+
     def processInput(self, ctx, key, args):
         namer = self._namer(key)
         # Get the form field values as a (y,m,d) tuple
@@ -734,7 +921,7 @@ class DatePartsInput(object):
             except ValueError, e:
                 raise validation.FieldValidationError("Invalid date")
         ymd = iformal.IDateTupleConvertible(self.original).toType(ymd)
-        return self.original.validate(ymd)
+        return self.original.check(ymd)
 
 
 class MMYYDatePartsInput(object):
@@ -743,6 +930,8 @@ class MMYYDatePartsInput(object):
     """
     implements( iformal.IWidget )
 
+    cacheable = True
+
     cutoffYear = 70
 
     def __init__(self, original, cutoffYear=None):
@@ -751,9 +940,7 @@ class MMYYDatePartsInput(object):
             self.cutoffYear = cutoffYear
 
     def _namer(self, prefix):
-        def _(part):
-            return '%s__%s' % (prefix,part)
-        return _
+        return partNamer(prefix)
 
     def _renderTag(self, ctx, year, month, namer, readonly):
         yearTag = T.input(type="text", name=namer('year'), value=year, size=2)
@@ -810,15 +997,20 @@ class MMYYDatePartsInput(object):
                 value[0] = 2000 + value[0]
             value.append(1)
         value = iformal.IDateTupleConvertible(self.original).toType( value )
-        return self.original.validate(value)
+        return self.original.check(value)
 
 
 class CheckboxMultiChoice(object):
     """
     Multiple choice list, rendered as a list of checkbox fields.
+
+    The options can be a sequence, an OptionSet or an OptionSource, as for
+    ChoiceBase.
     """
     implements( iformal.IWidget )
 
+    cacheable = True
+
     options = None
 
     def __init__(self, original, options=None):
@@ -829,10 +1021,8 @@ class CheckboxMultiChoice(object):
     def _renderTag(self, ctx, key, values, converter, disabled):
         def renderer(ctx, options):
             # loops through checkbox options and renders
-            for n,item in enumerate(options):
-                optValue = iformal.IKey(item).key()
-                optLabel = iformal.ILabel(item).label()
-                optValue = converter.fromType(optValue)
+            for n, (optValue, optLabel) in enumerate(
+                    convertOptions(options, converter)):
                 optid = render_cssid(key, n)
                 checkbox = T.input(type='checkbox', name=key, value=optValue,
                         id=optid)
@@ -876,12 +1066,28 @@ class CheckboxMultiChoice(object):
         values = [v.decode(charset) for v in args.get(key, [])]
         converter = iformal.IStringConvertible(self.original.type)
         values = [converter.toType(v) for v in values]
-        return self.original.validate(values)
+        return self.original.check(values)
+
+
+def _checkOversized(fileitem):
+    """
+    Fail a file that formal.upload.UploadFieldStorage stopped spooling because
+    it was larger than its maxFileSize.
+    """
+    if getattr(fileitem, 'oversized', False):
+        raise validation.FieldValidationError('File is too large')
 
 
 class FileUploadRaw(object):
     implements( iformal.IWidget )
 
+    # The value is an open file, which is never the same from one render to
+    # the next.
+    cacheable = False
+    # The input is an upload, which only makes sense as part of the whole
+    # form, see Form.validateFields.
+    validatesAlone = False
+
     def __init__(self, original):
         self.original = original
 
@@ -904,25 +1110,28 @@ class FileUploadRaw(object):
 
     def processInput(self, ctx, key, args):
         fileitem = inevow.IRequest(ctx).fields[key]
+        _checkOversized(fileitem)
         name = fileitem.filename.decode(util.getPOSTCharset(ctx))
         value = (name, fileitem.file)
 
         value = iformal.IFileConvertible(self.original).fromType(value)
-        return self.original.validate(value)
+        return self.original.check(value)
 
 
 class FileUpload(object):
     implements( iformal.IWidget )
 
+    # The markup depends on the files uploaded so far.
+    cacheable = False
+    validatesAlone = False
+
     def __init__(self, original, fileHandler, preview=None):
         self.original = original
         self.fileHandler = fileHandler
         self.preview = preview
 
     def _namer(self, prefix):
-        def _(part):
-            return '%s__%s' % (prefix,part)
-        return _
+        return partNamer(prefix)
 
     def _renderTag(self, ctx, key, value, namer, disabled):
 
@@ -972,7 +1181,7 @@ class FileUpload(object):
            value = args.get(namer('value'))[0]
 
         value = iformal.IStringConvertible(self.original).fromType(value)
-        return self.original.validate(value)
+        return self.original.check(value)
 
 
 class FileUploadWidget(object):
@@ -987,22 +1196,26 @@ class FileUploadWidget(object):
     """
     implements( iformal.IWidget )
 
+    # The markup depends on the files uploaded so far.
+    cacheable = False
+    validatesAlone = False
+
     FROM_RESOURCE_MANAGER = 'rm'
     FROM_CONVERTIBLE = 'cf'
+    UPLOAD = 'upload'
 
     convertibleFactory = converters.NullConverter
 
     def _namer(self, prefix):
-        def _(part):
-            return '%s__%s' % (prefix,part)
-        return _
+        return partNamer(prefix)
 
-    def __init__( self, original, convertibleFactory=None, originalKeyIsURL=False, removeable=False ):
+    def __init__( self, original, convertibleFactory=None, originalKeyIsURL=False, removeable=False, chunked=False ):
         self.original = original
         if convertibleFactory is not None:
             self.convertibleFactory = convertibleFactory
         self.originalKeyIsURL = originalKeyIsURL
         self.removeable = removeable
+        self.chunked = chunked
 
     def _blankField( self, field ):
         """
@@ -1063,8 +1276,8 @@ class FileUploadWidget(object):
         if resourceId:
             # Have an uploaded file, so render a link to the uploaded file
             tmpURL = widgetResourceURL(form.name).child(key).child( self.FROM_RESOURCE_MANAGER ).child(resourceId)
-            value = form.resourceManager.getResourceForWidget( key )
-            yield [ T.p[T.a(href=tmpURL)[value[2]]], removeableHtml]
+            fileName = fileNameFromResourceId( resourceId )
+            yield [ T.p[T.a(href=tmpURL)[fileName]], removeableHtml]
         elif originalKey:
             # The is no uploaded file, but there is an original, so render a
             # URL to it
@@ -1073,14 +1286,20 @@ class FileUploadWidget(object):
                 yield [ T.p[T.img(src=tmpURL)], removeableHtml ]
             else:
                 # Copy the data to the resource manager and render from there
-                resourceId = self._storeInResourceManager(ctx, key, originalKey)
-                tmpURL = widgetResourceURL(form.name).child(key).child( self.FROM_RESOURCE_MANAGER ).child(resourceId)
-                yield [ T.p[T.a(href=tmpURL)[originalKey[2]]], removeableHtml]
+                d = self._storeInResourceManager(ctx, key, originalKey)
+                d.addCallback( lambda resourceId: [
+                    T.p[T.a(href=self._resourceURL(form, key, resourceId))[originalKey[2]]],
+                    removeableHtml] )
+                yield d
         else:
             # No uploaded file, no original
             yield T.p[T.strong['Nothing uploaded']]
 
-        yield T.input(name=key, id=render_cssid(key),type='file')
+        fileInput = T.input(name=key, id=render_cssid(key),type='file')
+        if self.chunked:
+            fileInput(**{'data-upload-url':
+                widgetResourceURL(form.name).child(key).child(self.UPLOAD)})
+        yield fileInput
 
         # Id of uploaded file in the resource manager
         yield T.input(name=resourceIdName,value=resourceId,type='hidden')
@@ -1109,9 +1328,10 @@ class FileUploadWidget(object):
                 yield T.p[T.img(src=tmpURL)]
             else:
                 # Store the file in the resource manager and render from there
-                resourceId = self._storeInResourceManager(ctx, key, originalKey)
-                tmpURL = widgetResourceURL(form.name).child(key).child( self.FROM_RESOURCE_MANAGER ).child(resourceId)
-                yield [ T.p[T.a(href=tmpURL)[originalKey[2]]]]
+                d = self._storeInResourceManager(ctx, key, originalKey)
+                d.addCallback( lambda resourceId: [
+                    T.p[T.a(href=self._resourceURL(form, key, resourceId))[originalKey[2]]]] )
+                yield d
         else:
             # No uploaded file, no original
             yield T.p[T.strong['Nothing uploaded']]
@@ -1124,9 +1344,13 @@ class FileUploadWidget(object):
         """
             Process the request, storing any uploaded file in the
             resource manager.
+
+            The file is stored and then opened on the resource manager's
+            thread pool so a Deferred is returned.
         """
 
-        resourceManager = iformal.IForm( ctx ).resourceManager
+        form = iformal.IForm( ctx )
+        resourceManager = form.resourceManager
 
         # Ping the resource manager with any resource ids that I know
         self._registerWithResourceManager( key, args, resourceManager )
@@ -1134,22 +1358,36 @@ class FileUploadWidget(object):
         fileitem = inevow.IRequest(ctx).fields[key]
         name = fileitem.filename.decode(util.getPOSTCharset(ctx))
         if name:
+            # Reject a file that the type does not allow before it is stored.
+            _checkOversized( fileitem )
+            for validator in self.original.validators:
+                if isinstance( validator, validation.FileValidator ):
+                    validator.validate( self.original,
+                            (fileitem.type, fileitem.file, name) )
             # Store the uploaded file in the resource manager
-            resourceManager.setResource( key, fileitem.file, name )
+            d = resourceManager.deferSetResource( key, fileitem.file, name )
+        else:
+            d = defer.succeed( None )
 
         # Validating against an uploaded file. Should the fact that there is
         # original file meet a required field validation?
-        value = resourceManager.getResourceForWidget( key )
+        d.addCallback( lambda _: resourceManager.deferGetResourceForWidget( key ) )
+        return d.addCallback( self._check, key, args, _validationContext( form ) )
+
+    def _check( self, value, key, args, validationContext ):
         value = self.convertibleFactory(self.original).toType( value )
-        
-        # check to see if we should remove this      
+
+        # check to see if we should remove this
         if self.removeable is True:
             remove = args.get('%s_remove'%key, [None])[0]
             if remove is not None:
                 value = (None,None,None)
-        
-        
-        return self.original.validate( value )
+
+        # The check runs after the file operations, i.e. outside of the
+        # validation context the form processed the field in.
+        if validationContext is not None:
+            return pycontext.call( validationContext, self.original.check, value )
+        return self.original.check( value )
 
     def _registerWithResourceManager( self, key, args, resourceManager ):
         """
@@ -1171,38 +1409,153 @@ class FileUploadWidget(object):
         """
 
         if segments[0] == self.FROM_RESOURCE_MANAGER:
-            # Resource manager can provide a path so return a static.File
-            # instance that points to the file
+            # Stream the resource from the resource manager's storage
             rm = iformal.IForm( ctx ).resourceManager
-            (mimetype, path, fileName) = rm.getResourcePath( segments[1] )
-            inevow.IRequest(ctx).setHeader('Cache-Control',
-                    'no-cache, must-revalidate, no-store')
-            return static.Data(file(path).read(), str(mimetype)), ()
+
+            def opened( resource ):
+                # The resource may have been removed, or never existed.
+                if resource is None:
+                    return appserver.NotFound
+                (mimetype, filelike, fileName) = resource
+                inevow.IRequest(ctx).setHeader('Cache-Control',
+                        'no-cache, must-revalidate, no-store')
+                return FileResource( filelike, mimetype ), ()
+
+            return rm.deferOpenResource( segments[1] ).addCallback( opened )
 
         elif segments[0] == self.FROM_CONVERTIBLE:
-            # The convertible can provide a file like object so create a
-            # static.Data instance with the data from the convertible.
+            # The convertible can provide a file like object so stream the
+            # data from the convertible.
 
             def _( result ):
 
                 mimetype, filelike, fileName = result
-                data = filelike.read()
-                filelike.close()
-                return static.Data( data, mimetype ), []
+                return FileResource( filelike, mimetype ), []
 
             d = defer.maybeDeferred( self.convertibleFactory(self.original).fromType, segments[1], context=ctx )
             d.addCallback( _ )
             return d
+        elif segments[0] == self.UPLOAD and self.chunked:
+            # Chunked uploads of a file for the widget
+            rm = iformal.IForm( ctx ).resourceManager
+            maxBytes = None
+            for validator in self.original.validators:
+                if isinstance( validator, validation.FileValidator ):
+                    maxBytes = validator.maxBytes
+            return ChunkedUploadResource( rm, maxBytes ), segments[1:]
         else:
             return None
 
 
     def _storeInResourceManager(self, ctx, key, originalKey):
+        """
+            Store the original file in the resource manager, returning a
+            Deferred that fires with its resource id.
+        """
         resourceManager = iformal.IForm( ctx ).resourceManager
-        resourceManager.setResource( key, originalKey[1], originalKey[2] )
-        resourceId = resourceManager.getResourceId( key )
-        return resourceId
+        return resourceManager.deferSetResource( key, originalKey[1], originalKey[2] )
+
+    def _resourceURL(self, form, key, resourceId):
+        return widgetResourceURL(form.name).child(key).child( self.FROM_RESOURCE_MANAGER ).child(resourceId)
+
+
 
+class ChunkedUploadResource(object):
+    """
+    Upload a file a chunk at a time, see FileUploadWidget's chunked option.
+
+    Relative to the resource's URL, the protocol is:
+
+    POST ?name=<file name>
+        Begin an upload. Returns {"uploadId": <id>, "offset": 0}.
+    GET <id>
+        Return the upload's offset, i.e. the number of bytes received, so
+        that an interrupted upload can be resumed: {"offset": <n>}.
+    PUT <id>?offset=<n>, with the chunk as the body
+        Append a chunk, which must start at the upload's offset, returning
+        the new offset. A 409 response carries the actual offset if the chunk
+        does not start at it. A 413 is returned if the file would be larger
+        than maxBytes.
+    POST <id>/complete
+        Move the completed file into the resource manager, returning
+        {"resourceId": <id>, "fileName": <name>}.
+
+    Unknown uploads get a 404. All responses are JSON. The file operations
+    run on the resource manager's thread pool.
+    """
+    implements(inevow.IResource)
+
+    def __init__(self, resourceManager, maxBytes=None, segments=()):
+        self.resourceManager = resourceManager
+        self.maxBytes = maxBytes
+        self.segments = segments
+
+    def locateChild(self, ctx, segments):
+        return ChunkedUploadResource(self.resourceManager, self.maxBytes,
+                tuple(segments)), ()
+
+    def renderHTTP(self, ctx):
+        request = inevow.IRequest(ctx)
+        segments, method = self.segments, request.method
+        if not segments and method == 'POST':
+            return self._begin(ctx, request)
+        elif len(segments) == 1 and method == 'GET':
+            return self._status(ctx, segments[0])
+        elif len(segments) == 1 and method == 'PUT':
+            return self._append(ctx, request, segments[0])
+        elif segments[1:] == ('complete',) and method == 'POST':
+            return self._complete(ctx, segments[0])
+        return self._respond(ctx, {'error': 'Not found'}, 404)
+
+    def _begin(self, ctx, request):
+        name = request.args.get('name', [''])[0].decode(util.getPOSTCharset(ctx))
+        if not name:
+            return self._respond(ctx, {'error': 'No file name'}, 400)
+        d = self.resourceManager.deferBeginUpload(name)
+        return d.addCallback(lambda uploadId: self._respond(ctx,
+            {'uploadId': uploadId, 'offset': 0}))
+
+    def _status(self, ctx, uploadId):
+        def status(offset):
+            if offset is None:
+                return self._respond(ctx, {'error': 'Not found'}, 404)
+            return self._respond(ctx, {'offset': offset})
+        d = self.resourceManager.deferGetUploadOffset(uploadId)
+        return d.addCallback(status)
+
+    def _append(self, ctx, request, uploadId):
+        try:
+            offset = int(request.args.get('offset', [''])[0])
+        except ValueError:
+            return self._respond(ctx, {'error': 'No offset'}, 400)
+        request.content.seek(0)
+        data = request.content.read()
+        if self.maxBytes is not None and offset + len(data) > self.maxBytes:
+            return self._respond(ctx, {'error': 'File is too large'}, 413)
+
+        def appended(offset):
+            if offset is None:
+                return self._respond(ctx, {'error': 'Not found'}, 404)
+            return self._respond(ctx, {'offset': offset})
+
+        def offsetError(failure):
+            failure.trap(UploadOffsetError)
+            return self._respond(ctx, {'offset': failure.value.offset}, 409)
+
+        d = self.resourceManager.deferAppendUpload(uploadId, offset, data)
+        return d.addCallbacks(appended, offsetError)
+
+    def _complete(self, ctx, uploadId):
+        def completed(resourceId):
+            if resourceId is None:
+                return self._respond(ctx, {'error': 'Not found'}, 404)
+            return self._respond(ctx, {'resourceId': resourceId,
+                'fileName': fileNameFromResourceId(resourceId)})
+        d = self.resourceManager.deferCompleteUpload(uploadId)
+        return d.addCallback(completed)
+
+    def _respond(self, ctx, data, code=None):
+        return JSONResource(data, code).renderHTTP(ctx)
 
 
 class Hidden(object):
@@ -1211,27 +1564,38 @@ class Hidden(object):
     """
     __implements__ = iformal.IWidget,
 
+    cacheable = True
+
     inputType = 'hidden'
 
     def __init__(self, original):
         self.original = original
 
-    def render(self, ctx, key, args, errors):
+    def _value(self, key, args, errors):
         if errors:
             value = args.get(key, [''])
             if isinstance(value, list):
                 value = value[0]
         else:
             value = iformal.IStringConvertible(self.original).fromType(args.get(key))
+        return value
+
+    def render(self, ctx, key, args, errors):
+        value = self._value(key, args, errors)
         return T.input(type=self.inputType, name=key, id=render_cssid(key), value=value)
 
     def renderImmutable(self, ctx, key, args, errors):
         return self.render(ctx, key, args, errors)
 
+    def renderString(self, ctx, key, args, errors, cssid, immutable=False):
+        value = self._value(key, args, errors)
+        return renderTag('input', {'type': self.inputType, 'name': key,
+            'id': cssid, 'value': value})
+
     def processInput(self, ctx, key, args):
         value = args.get(key, [''])[0].decode(util.getPOSTCharset(ctx))
         value = iformal.IStringConvertible(self.original).toType(value)
-        return self.original.validate(value)
+        return self.original.check(value)
 
 
 __all__ = [
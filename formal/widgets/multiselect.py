@@ -1,6 +1,7 @@
 from zope.interface import implements
 from nevow import tags as T
 from formal import iformal
+from formal.options import convertOptions
 from formal.util import render_cssid
 
 _UNSET = object()
@@ -15,7 +16,8 @@ class MultichoiceBase(object):
     options:
         A sequence of objects adaptable to IKey and ILabel. IKey is used as the
         <option>'s value attribute; ILabel is used as the <option>'s child.
-        IKey and ILabel adapters for tuple are provided.
+        IKey and ILabel adapters for tuple are provided. An OptionSet or an
+        OptionSource can also be used, see ChoiceBase.
     noneOption:
         An object adaptable to IKey and ILabel that is used to identify when
         nothing has been selected. Defaults to ('', '')
@@ -52,6 +54,8 @@ class MultiselectChoice(MultichoiceBase):
     """
     implements( iformal.IWidget )
 
+    cacheable = True
+
     noneOption = ('', '')
 
     def _renderTag(self, ctx, key, value, converter, disabled):
@@ -61,10 +65,7 @@ class MultiselectChoice(MultichoiceBase):
                 yield T.option(value=iformal.IKey(self.noneOption).key())[iformal.ILabel(self.noneOption).label()]
             if data is None:
                 return
-            for item in data:
-                optValue = iformal.IKey(item).key()
-                optLabel = iformal.ILabel(item).label()
-                optValue = converter.fromType(optValue)
+            for optValue, optLabel in convertOptions(data, converter):
                 option = T.option(value=optValue)[optLabel]
 
                 if value and optValue in value:
@@ -4,7 +4,7 @@ Rich text area widget.
 
 from nevow import inevow, loaders, rend, tags as T, util
 from formal import iformal, widget, types
-from formal.util import render_cssid
+from formal.util import render_cssid, partNamer
 from zope.interface import Interface
 
 class RichTextArea(widget.TextArea):
@@ -17,9 +17,7 @@ class RichTextArea(widget.TextArea):
         self.parsers = parsers
 
     def _namer(self, prefix):
-        def _(part):
-            return '%s__%s' % (prefix,part)
-        return _
+        return partNamer(prefix)
 
     def _renderTag(self, ctx, tparser, tvalue, namer, readonly):
         tag=T.invisible()
@@ -77,7 +75,7 @@ class RichTextArea(widget.TextArea):
     def processInput(self, ctx, key, args):
         namer = self._namer(key)
         value = [args.get(namer(part), [''])[0].strip().decode(util.getPOSTCharset(ctx)) for part in ('tparser', 'tvalue')]
-        return self.original.validate(types.RichText(*value))
+        return self.original.check(types.RichText(*value))
 
 
 
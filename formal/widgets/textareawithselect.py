@@ -61,4 +61,4 @@ class TextAreaWithSelect(object):
     def processInput(self, ctx, key, args):
         value = args.get(key, [''])[0].decode(util.getPOSTCharset(ctx))
         value = iformal.IStringConvertible(self.original).fromType(value)
-        return self.original.validate(value)
+        return self.original.check(value)